@@ -1,13 +1,20 @@
 import os
 import json
 import argparse
-from tqdm import tqdm
+import functools
 import openai
 from DeepEL.openai_key import OPENAI_API_KEY
 from DeepEL.dataset_reader import dataset_loader
 openai.api_key = OPENAI_API_KEY
 openai.api_base = "https://api.chatnio.net/v1"
-from DeepEL.openai_function import openai_chatgpt, openai_completion
+from DeepEL.openai_function import openai_chatgpt, openai_completion, openai_chatgpt_structured
+from DeepEL.openai_async import run_batch_by_document
+from DeepEL.token_budget import get_prompt_budget
+from DeepEL.cascade import get_cascade
+from DeepEL.generation_profiles import GENERATION_PROFILES
+from DeepEL.structured_output import get_max_reasks
+from DeepEL.mention_descriptions import split_sections, mentions_prompt, describe_mentions, mention_signature
+from DeepEL.llm_config import add_llm_arguments, configure_llm, run_offline_batch, report_llm
 import jsonlines
 
 
@@ -69,6 +76,44 @@ def parse_args():
         choices=['gpt-4o-mini','gpt-3.5-turbo', 'text-curie-001', 'text-davinci-003', 'gpt-4'],
         type=str,
     )
+    parser.add_argument(
+        "--description_characters",
+        help="length of the descriptions asked for, e.g. the --num_context_characters of "
+             "Blink_for_changed_sentence.py, which reads no more of them; enforced by the instructions, max_tokens "
+             "and a stop sequence. 0 lets the model write freely (Make_initial_choice and Reselect reuse the full "
+             "descriptions as explanations)",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--describe_mode",
+        help="mention: one prompt per mention; document: one structured request describing all the mentions of a "
+             "document (or of a section of a long document), mentions missing from the answer are asked again",
+        default='mention',
+        choices=['mention', 'document'],
+        type=str,
+    )
+    parser.add_argument(
+        "--max_section_characters",
+        help="with --describe_mode document, longest text sent in one request; longer documents are split into "
+             "sections at mention boundaries",
+        default=4000,
+        type=int,
+    )
+    parser.add_argument(
+        "--dedup_mentions",
+        help="describe once the mentions of the whole corpus that have the same surface form and the same context "
+             "(ignoring case, spacing and digits), and share the description",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--dedup_context_characters",
+        help="with --dedup_mentions, context characters on each side of a mention compared, "
+             "0 means --num_context_characters",
+        default=0,
+        type=int,
+    )
+    add_llm_arguments(parser)
 
     args = parser.parse_args()
 
@@ -80,6 +125,7 @@ def parse_args():
 
 def main():
     args = parse_args()
+    configure_llm(args)
     input_file = args.input_file
     mode=args.mode
     if mode == 'jsonl':
@@ -100,6 +146,17 @@ def main():
         openai_function = openai_completion
     else:
         raise ValueError('Unknown gpt mode')
+    by_document = args.describe_mode == 'document'
+    description_characters = args.description_characters
+    describe_profile = 'describe'
+    length_instruction = ''
+    if description_characters:
+        # about 4 characters per token, with room to finish the last word; a --generation_profiles file wins
+        GENERATION_PROFILES['short_describe'].setdefault('max_tokens', description_characters // 4 + 8)
+        describe_profile = 'short_describe'
+        length_instruction = f" Answer in one sentence of at most {description_characters} characters."
+    if by_document and openai_mode != 'chatgpt':
+        raise ValueError('--describe_mode document needs --openai_mode chatgpt')
 
     # consider continue querying when bug occurs
     if os.path.isfile(output_file):
@@ -109,7 +166,19 @@ def main():
     else:
         exist_doc_names = []
 
-    for doc_name, instance in tqdm(doc_name2instance.items()):
+    prompt_budget = get_prompt_budget()
+    doc_name2prompts = dict()
+    # with --describe_mode document: the document requests of each document, and the blocks of mentions and the
+    # per-mention prompts (asked when a mention is still missing from the answers) of each request
+    doc_name2document_prompts = dict()
+    document_prompt2job = dict()
+    # the mention (doc_name, index) described for each mention, itself unless --dedup_mentions finds an earlier
+    # mention of the corpus with the same signature, and the prompts sent for each document
+    signature2owner = dict()
+    doc_name2owners = dict()
+    doc_name2sent_prompts = dict()
+    dedup_context_characters = args.dedup_context_characters or num_context_characters
+    for doc_name, instance in doc_name2instance.items():
         if doc_name in exist_doc_names and 'prompt_results' in exist_doc_name2instance[doc_name]['entities']:
             doc_name2instance[doc_name]['entities'] = exist_doc_name2instance[doc_name]['entities']
             continue
@@ -118,7 +187,6 @@ def main():
         starts = entities['starts']
         ends = entities['ends']
         sentence = instance['sentence']
-        prompt_results = []
         prompts = []
         for (
                 entity_mention,
@@ -129,20 +197,148 @@ def main():
             starts,
             ends,
         ):
-            prompt_sentence = sentence[max(0, start - num_context_characters): start] + entity_mention + sentence[
-                                                                                                         end: end + num_context_characters]
-            prompt = prompt_sentence + " \n What does " + entity_mention + " in this sentence referring to?"
+            left_context = sentence[max(0, start - num_context_characters): start]
+            right_context = sentence[end: end + num_context_characters]
+            question = " \n What does " + entity_mention + " in this sentence referring to?" + length_instruction
+            # the context is trimmed to the prompt budget, keeping the characters closest to the mention
+            trimmed_left, right_context = prompt_budget.fit([left_context, right_context], fixed=entity_mention + question)
+            left_context = left_context[len(left_context) - len(trimmed_left):]
+            prompt_sentence = left_context + entity_mention + right_context
+            prompt = prompt_sentence + question
+            if not by_document:
+                prompt_budget.account(prompt)
             prompts.append(prompt)
-            complete_output = openai_function(prompt, model=openai_model)
-            prompt_results.append(complete_output)
+        doc_name2prompts[doc_name] = prompts
+        doc_name2owners[doc_name] = [
+            signature2owner.setdefault(mention_signature(sentence, start, end, dedup_context_characters), (doc_name, index))
+            for index, (start, end) in enumerate(zip(starts, ends))
+        ] if args.dedup_mentions else [(doc_name, index) for index in range(len(prompts))]
+        doc_name2sent_prompts[doc_name] = [
+            doc_name2prompts[owner][owner_index] for owner, owner_index in doc_name2owners[doc_name]
+        ]
+        if by_document:
+            # only the mentions described for themselves are put in the document requests
+            owned = [
+                index for index, owner in enumerate(doc_name2owners[doc_name]) if owner == (doc_name, index)
+            ]
+            document_prompts = []
+            for section_start, section_end, section_indices in split_sections(
+                sentence, [starts[index] for index in owned], [ends[index] for index in owned],
+                num_context_characters, args.max_section_characters,
+            ):
+                indices = [owned[position] for position in section_indices]
+                block = (
+                    sentence[section_start: section_end],
+                    [(index, starts[index] - section_start, ends[index] - section_start) for index in indices],
+                )
+                document_prompt = mentions_prompt([block], max_characters=description_characters)
+                prompt_budget.account(document_prompt)
+                document_prompt2job[document_prompt] = ([block], {index: prompts[index] for index in indices})
+                document_prompts.append(document_prompt)
+            doc_name2document_prompts[doc_name] = document_prompts
 
-        entities['prompts'] = prompts
+    def save_document(doc_name, prompt_results):
+        entities = doc_name2instance[doc_name]['entities']
+        entities['prompts'] = doc_name2prompts[doc_name]
         entities['prompt_results'] = prompt_results
         doc_name2instance[doc_name]['entities'] = entities
 
         with open(output_file, 'w') as writer:
             json.dump(doc_name2instance, writer, indent=4)
 
+    def describe_document(document_prompt, model, profile):
+        """Descriptions of the mentions of a document request, each as (mention index, description)"""
+        blocks, index2prompt = document_prompt2job[document_prompt]
+        ask = functools.partial(openai_chatgpt_structured, profile=profile, schema='descriptions')
+        if cascade is not None:
+            # the fast model describes the document first, like the per-mention prompts
+            ask = cascade.wrap(ask, lambda prompt, result: cascade.descriptions_reason(result))
+        descriptions = describe_mentions(
+            blocks,
+            lambda prompt: ask(prompt, model=model),
+            max_reasks=get_max_reasks(),
+            max_characters=description_characters,
+        )
+        # mentions the document requests could not describe are asked on their own
+        return [
+            (
+                index,
+                descriptions[index] if index in descriptions
+                else openai_function(prompt, model=model, profile=describe_profile),
+            )
+            for index, prompt in index2prompt.items()
+        ], len(index2prompt) - len(descriptions)
+
+    def save_document_descriptions(doc_name, document_results):
+        doc_name2descriptions[doc_name] = dict()
+        for descriptions, num_asked_again in document_results:
+            document_stats['mentions'] += len(descriptions)
+            document_stats['asked_again'] += num_asked_again
+            doc_name2descriptions[doc_name].update(descriptions)
+        doc_name2instance[doc_name]['entities']['document_prompts'] = doc_name2document_prompts[doc_name]
+        # a document is saved once the earlier documents it shares mentions with are described as well
+        waiting_doc_names.append(doc_name)
+        for doc_name in list(waiting_doc_names):
+            owners = doc_name2owners[doc_name]
+            if all(owner in doc_name2descriptions for owner, _ in owners):
+                waiting_doc_names.remove(doc_name)
+                save_document(doc_name, [doc_name2descriptions[owner][index] for owner, index in owners])
+
+    if by_document:
+        run_offline_batch(
+            args, openai_chatgpt_structured, doc_name2document_prompts,
+            model=openai_model, profile='describe', schema='descriptions',
+        )
+    else:
+        run_offline_batch(args, openai_function, doc_name2sent_prompts, model=openai_model, profile=describe_profile)
+
+    cascade = get_cascade()
+    if cascade is not None:
+        openai_function = cascade.wrap(openai_function, lambda prompt, reply: cascade.description_reason(reply))
+
+    if by_document:
+        document_stats = dict(mentions=0, asked_again=0)
+        doc_name2descriptions = dict()
+        waiting_doc_names = []
+        num_requests = run_batch_by_document(
+            describe_document,
+            doc_name2document_prompts,
+            save_document_descriptions,
+            max_in_flight=args.max_in_flight,
+            desc='Describing documents',
+            dedupe=args.dedup_mentions,
+            model=openai_model,
+            profile='describe',
+        )
+        print(
+            f"Described {document_stats['mentions']} mentions with {num_requests} document requests, "
+            f"{document_stats['asked_again']} mentions asked on their own"
+        )
+        if args.dedup_mentions:
+            num_mentions = sum(len(prompts) for prompts in doc_name2prompts.values())
+            print(
+                f"Deduplicated {num_mentions} mentions into {document_stats['mentions']} descriptions "
+                f"(dedup ratio {1 - document_stats['mentions'] / num_mentions if num_mentions else 0:.2%})"
+            )
+    else:
+        num_requests = run_batch_by_document(
+            openai_function,
+            doc_name2sent_prompts,
+            save_document,
+            max_in_flight=args.max_in_flight,
+            desc='Describing mentions',
+            dedupe=args.dedup_mentions,
+            model=openai_model,
+            profile=describe_profile,
+        )
+        if args.dedup_mentions:
+            num_mentions = sum(len(prompts) for prompts in doc_name2prompts.values())
+            print(
+                f"Deduplicated {num_mentions} mentions into {num_requests} descriptions "
+                f"(dedup ratio {1 - num_requests / num_mentions if num_mentions else 0:.2%})"
+            )
+    report_llm(output_file)
+
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
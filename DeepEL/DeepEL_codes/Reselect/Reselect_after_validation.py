@@ -2,17 +2,60 @@ import os
 import json
 import time
 import argparse
-from tqdm import tqdm
 import openai
 from DeepEL.openai_key import OPENAI_API_KEY
 openai.api_key = OPENAI_API_KEY
 openai.api_base = "https://api.chatnio.net/v1"
-import re
-from DeepEL.openai_function import openai_chatgpt, openai_completion
+from DeepEL.openai_function import openai_chatgpt, openai_completion, openai_chatgpt_structured
+from DeepEL.structured_output import choice_index, schema_instructions
+from DeepEL.openai_async import run_batch_by_document
+from DeepEL.token_budget import get_prompt_budget
+from DeepEL.cascade import get_cascade
+from DeepEL.prompt_layout import LayeredPrompt
+from DeepEL.llm_config import add_llm_arguments, configure_llm, run_offline_batch, report_llm
+
+# shared prefix of the reselection prompts with --prefix_first_layout: like in Make_initial_choice, only these
+# instructions are shared, too short for the hosted prompt caches (see prompt_layout.PROVIDER_MIN_PREFIX_TOKENS)
+RESELECTION_INSTRUCTIONS = (
+    'A previous choice of entity for a mention was judged wrong. Read the candidate entities, the original '
+    'explanation of the mention and the judgment below, then choose the candidate the mention refers to. '
+    'Return a number to represent your answer.'
+)
 
 def extract_answer_from_output(output):
-    match = re.search(r'\b(\d+)\b', output)
-    return int(match.group(1)) if match else None
+    return choice_index(output)
+
+def save_reselections(entities, jobs, complete_outputs, structured=False):
+    """
+    Store the answers of the reselection ``jobs`` (validation, entity index, prompt) of a document in its
+    ``entities``. With ``structured``, the outputs are (reply, answer) and the confidences of the answers go to
+    ``multi_choice_confidences``, which is created when the initial choice was not structured.
+    """
+    multi_choice_prompts = entities.get('multi_choice_prompts', [])
+    multi_choice_prompt_results = entities.get('multi_choice_prompt_results', [])
+    multi_choice_confidences = list(entities.get('multi_choice_confidences') or [])
+    multi_choice_confidences += [None] * (len(multi_choice_prompt_results) - len(multi_choice_confidences))
+
+    for (validation, entity_idx, multi_choice_prompt), complete_output in zip(jobs, complete_outputs):
+        if structured:
+            complete_output, answer = complete_output
+            if answer is not None:
+                # keep the chosen number as the reply, so later stages read it as before
+                complete_output = str(answer['answer'])
+                if entity_idx < len(multi_choice_confidences):
+                    multi_choice_confidences[entity_idx] = answer['confidence']
+        if entity_idx < len(multi_choice_prompt_results):
+            multi_choice_prompt_results[entity_idx] = complete_output
+
+        if entity_idx < len(multi_choice_prompts):
+            multi_choice_prompts[entity_idx] = multi_choice_prompt
+
+        validation['validation_result'] = "Yes"
+
+    entities['multi_choice_prompts'] = multi_choice_prompts
+    entities['multi_choice_prompt_results'] = multi_choice_prompt_results
+    if structured:
+        entities['multi_choice_confidences'] = multi_choice_confidences
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -57,6 +100,7 @@ def parse_args():
         ],
         type=str,
     )
+    add_llm_arguments(parser)
     args = parser.parse_args()
     os.makedirs(args.output_dir, exist_ok=True)
     args.output_file = os.path.join(args.output_dir, args.output_file)
@@ -65,9 +109,17 @@ def parse_args():
 
 def main():
     args = parse_args()
+    configure_llm(args)
     openai_model = args.openai_model
     openai_mode = args.openai_mode
     openai_function = openai_chatgpt if openai_mode == 'chatgpt' else openai_completion
+    llm_kwargs = dict(model=openai_model, profile='choice')
+    structured = args.structured_output != 'off'
+    if structured:
+        if openai_mode != 'chatgpt':
+            raise ValueError('--structured_output needs --openai_mode chatgpt')
+        openai_function = openai_chatgpt_structured
+        llm_kwargs = dict(model=openai_model, profile='structured_choice', schema='choice')
 
     input_file = args.input_file
     output_file = args.output_file
@@ -84,14 +136,16 @@ def main():
         exist_doc_name2instance = {}
         exist_doc_names = set()
 
-    for doc_name, instance in tqdm(doc_name2instance.items()):
+    prompt_budget = get_prompt_budget()
+    doc_name2jobs = dict()
+    prompt2num_choices = dict()
+    for doc_name, instance in doc_name2instance.items():
         if doc_name in exist_doc_names and 'multi_choice_prompts' in exist_doc_name2instance[doc_name]['entities']:
             continue
 
         entities = instance['entities']
-        multi_choice_prompts = entities.get('multi_choice_prompts', [])
-        multi_choice_prompt_results = entities.get('multi_choice_prompt_results', [])
 
+        jobs = []
         validation_data = instance.get('validation_data', [])
         for validation in validation_data:
             if validation.get('validation_result') != "No":
@@ -106,47 +160,83 @@ def main():
             validation_prompt = validation['validation_reply']
             prompt_result = entities['prompt_results'][entity_idx]
 
+            entity_candidates = entities['entity_candidates'][entity_idx]
+            entity_candidates_description = entities['entity_candidates_descriptions'][entity_idx]
+            entity_candidates = entity_candidates[:len(entity_candidates_description)]
+            descriptions = [
+                entity_candidate_description[:num_entity_description_characters]
+                for entity_candidate_description in entity_candidates_description[:len(entity_candidates)]
+            ]
+            question = (
+                f"Which of the following entities is {entity_mention} in this sentence? "
+                f"Return a number to represent your answer. "
+            )
+            answer_format = '\n' + schema_instructions('choice') if structured else ''
+            question += answer_format
+            # the explanations and the descriptions are trimmed to the prompt budget, the question and names are kept
+            fixed = "Original explanation: " + question + ''.join(
+                f'({index + 1}).  {entity_candidate}\n' for index, entity_candidate in enumerate(entity_candidates)
+            )
+            prompt_result, validation_prompt, *descriptions = prompt_budget.fit(
+                [prompt_result.strip(), validation_prompt.strip()] + descriptions, fixed=fixed,
+            )
+
             combined_prompt = (
                 f"Original explanation: {prompt_result.strip()}\n\n"
                 f"{validation_prompt.strip()}\n\n"
             )
 
-            entity_candidates = entities['entity_candidates'][entity_idx]
-            entity_candidates_description = entities['entity_candidates_descriptions'][entity_idx]
-
             multi_choice_prompt = ''
-            for index, (entity_candidate, entity_candidate_description) in enumerate(zip(entity_candidates, entity_candidates_description)):
-                description = entity_candidate + ' ' + entity_candidate_description[:num_entity_description_characters]
+            for index, (entity_candidate, entity_candidate_description) in enumerate(zip(entity_candidates, descriptions)):
+                description = entity_candidate + ' ' + entity_candidate_description
                 multi_choice_prompt += f'({index + 1}). {description}\n'
 
-            multi_choice_prompt = (
-                f"{combined_prompt}\n\nWhich of the following entities is {entity_mention} in this sentence? "
-                f"Return a number to represent your answer. \n\n{multi_choice_prompt}"
-            )
-
-      
-            complete_output = openai_function(multi_choice_prompt, model=openai_model)
-
-     
-            if entity_idx < len(multi_choice_prompt_results):
-                multi_choice_prompt_results[entity_idx] = complete_output
-            
-
-            if entity_idx < len(multi_choice_prompts):
-                multi_choice_prompts[entity_idx] = multi_choice_prompt
-            
-
-
-            validation['validation_result'] = "Yes"
-
-        entities['multi_choice_prompts'] = multi_choice_prompts
-        entities['multi_choice_prompt_results'] = multi_choice_prompt_results
+            if args.prefix_first_layout:
+                multi_choice_prompt = LayeredPrompt(
+                    RESELECTION_INSTRUCTIONS + answer_format + '\n\n',
+                    f"Candidate entities:\n{multi_choice_prompt}\n{combined_prompt}"
+                    f"Which of the candidate entities is {entity_mention} in this sentence?",
+                )
+            else:
+                multi_choice_prompt = (
+                    f"{combined_prompt}\n\n{question}\n\n{multi_choice_prompt}"
+                )
+            prompt_budget.account(multi_choice_prompt)
+            prompt2num_choices[multi_choice_prompt] = len(entity_candidates)
+
+            jobs.append((validation, entity_idx, multi_choice_prompt))
+
+        doc_name2jobs[doc_name] = jobs
+
+    def save_document(doc_name, complete_outputs):
+        instance = doc_name2instance[doc_name]
+        entities = instance['entities']
+        save_reselections(entities, doc_name2jobs[doc_name], complete_outputs, structured=structured)
         doc_name2instance[doc_name]['entities'] = entities
         exist_doc_name2instance[doc_name] = instance
 
         with open(output_file, 'w') as writer:
             json.dump(exist_doc_name2instance, writer, indent=4)
 
+    doc_name2prompts = {doc_name: [prompt for _, _, prompt in jobs] for doc_name, jobs in doc_name2jobs.items()}
+    run_offline_batch(args, openai_function, doc_name2prompts, **llm_kwargs)
+
+    cascade = get_cascade()
+    if cascade is not None:
+        openai_function = cascade.wrap(
+            openai_function, lambda prompt, result: cascade.choice_reason(result, prompt2num_choices[prompt]),
+        )
+
+    run_batch_by_document(
+        openai_function,
+        doc_name2prompts,
+        save_document,
+        max_in_flight=args.max_in_flight,
+        desc='Reselecting entities',
+        **llm_kwargs,
+    )
+    report_llm(output_file)
+
 
 if __name__ == '__main__':
     main()
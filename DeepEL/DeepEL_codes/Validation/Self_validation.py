@@ -2,9 +2,16 @@ import json
 import argparse
 import os
 import openai
-import time
-import re
-from tqdm import tqdm
+from collections import Counter
+from DeepEL.openai_async import run_batch_by_document
+from DeepEL.openai_function import openai_chatgpt, openai_chatgpt_structured
+from DeepEL.structured_output import choice_index, is_positive_verdict, schema_instructions
+from DeepEL.token_budget import get_prompt_budget
+from DeepEL.cascade import get_cascade
+from DeepEL.prompt_layout import LayeredPrompt
+from DeepEL.llm_config import add_llm_arguments, configure_llm, run_offline_batch, report_llm
+
+VALIDATION_MODEL = 'gpt-3.5-turbo'
 
 def main():
     # Parse command line arguments
@@ -14,12 +21,14 @@ def main():
     parser.add_argument('--output_file', type=str, required=True, help='Output file name')
     parser.add_argument('--api_base', type=str, default='', help='API base URL')
     parser.add_argument('--api_key', type=str, default='', help='API key')
+    add_llm_arguments(parser)
     
     args = parser.parse_args()
     
     # Set up API configuration
     openai.api_base = args.api_base
     openai.api_key = args.api_key
+    configure_llm(args)
     
     # Create output directory if it doesn't exist
     if not os.path.exists(args.output_dir):
@@ -35,13 +44,20 @@ def main():
     processed_data = process_and_replace_entities(data)
     
     # Step 2: Validate replacements using LLM
-    validation_results = validate_replacements(processed_data)
+    validation_results = validate_replacements(
+        processed_data,
+        max_in_flight=args.max_in_flight,
+        llm_args=args,
+        prefix_first=args.prefix_first_layout,
+        structured=args.structured_output != 'off',
+    )
     
     # Step 3: Save final results
     with open(output_file_path, 'w', encoding='utf-8') as f:
         json.dump(validation_results, f, ensure_ascii=False, indent=4)
     
     print(f"Processing complete. Results saved to '{output_file_path}'.")
+    report_llm(output_file_path)
 
 def process_and_replace_entities(data):
     """
@@ -85,77 +101,108 @@ def process_and_replace_entities(data):
     
     return data
 
-def validate_replacements(data):
+def build_validation_items(doc_value, prefix_first=False, structured=False):
     """
-    Validate entity replacements using LLM
+    Build one (predicted_entity, is_replacement_correct, prompt) item per predicted entity of a document.
+    The prompt is None for entities that are not validated.
+    With ``prefix_first``, the sentences and the entity descriptions form a prefix shared by all the prompts of
+    the document, and only the question about one entity follows it.
+    With ``structured``, the prompts end with the instructions of the JSON verdict, see structured_output.
     """
-    llm_correct = 0
-    llm_incorrect = 0
-    total_cases = 0
-    false_positives = 0
-    false_negatives = 0
-    true_positives = 0
-    true_negatives = 0
-    
-    def retry_request(prompt, retries=100, delay=5):
-        """Retry OpenAI API call"""
-        for _ in range(retries):
-            try:
-                response = openai.ChatCompletion.create(
-                    model='gpt-3.5-turbo',
-                    messages=[{"role": "user", "content": prompt}],
-                )
-                return response['choices'][0]['message']['content'].strip()
-            except Exception as e:
-                print(f"Error occurred: {e}. Retrying...")
-                time.sleep(delay)
-        print("Max retries reached, skipping this entity.")
-        return None
-    
-    for doc_key, doc_value in tqdm(data.items(), desc='Validating replacements', total=len(data)):
-        sentence = doc_value['sentence']
-        new_sentence = doc_value['new_sentence']
-        entity_mentions = doc_value['entities']['entity_mentions']
-        processed_entity_names = doc_value['entities'].get('processed_entity_names', [])
-        predict_entity_names = doc_value['entities'].get('predict_entity_names', [])
-        entity_candidates_descriptions = doc_value['entities'].get('entity_candidates_descriptions', [])
-        multi_choice_prompt_results = doc_value['entities'].get('multi_choice_prompt_results', [])
-        
-        # Ensure consistent lengths
-        max_len = max(len(processed_entity_names), len(predict_entity_names))
-        processed_entity_names.extend([''] * (max_len - len(processed_entity_names)))
-        predict_entity_names.extend([''] * (max_len - len(predict_entity_names)))
+    sentence = doc_value['sentence']
+    new_sentence = doc_value['new_sentence']
+    entity_mentions = doc_value['entities']['entity_mentions']
+    processed_entity_names = doc_value['entities'].get('processed_entity_names', [])
+    predict_entity_names = doc_value['entities'].get('predict_entity_names', [])
+    entity_candidates_descriptions = doc_value['entities'].get('entity_candidates_descriptions', [])
+    multi_choice_prompt_results = doc_value['entities'].get('multi_choice_prompt_results', [])
+    
+    # Ensure consistent lengths
+    max_len = max(len(processed_entity_names), len(predict_entity_names))
+    processed_entity_names.extend([''] * (max_len - len(processed_entity_names)))
+    predict_entity_names.extend([''] * (max_len - len(predict_entity_names)))
+    
+    # Map predicted entity names to descriptions
+    entity_descriptions = {}
+    for idx, result in enumerate(multi_choice_prompt_results):
+        choice = choice_index(result)
+        if choice:
+            choice_idx = choice - 1
+            if 0 <= choice_idx < len(entity_candidates_descriptions[idx]):
+                description = entity_candidates_descriptions[idx][choice_idx]
+                predicted_entity = predict_entity_names[idx]
+                entity_descriptions[predicted_entity] = description
+        else:
+            continue
+    
+    answer_format = '\n' + schema_instructions('verdict') + '\n' if structured else ''
+    prompt_budget = get_prompt_budget()
+
+    def judgment_question(predicted_entity, original_entity):
+        # per-entity part of the prompts with prefix_first
+        return f"""
+
+Please judge whether the entity '{predicted_entity}' in the new sentence ('Sentence after replacement')
+correctly refers to the same entity as '{original_entity}' in the original sentence ('Original sentence').
+Please base your judgment on the entity descriptions above.
+Answer "Yes" or "No" and briefly explain your reasoning.
+If you are not sure about your answer, you should also state that.
+""" + answer_format
+
+    if prefix_first:
+        document_header = f"""
+Original sentence: {sentence}
+Sentence after replacement: {new_sentence}
+
+Entities in the sentence:"""
+        # trimmed once per document, so that every validation of the document shares the same prefix; the fixed
+        # text is the prefix without the descriptions followed by the longest question of the document
+        questions = [
+            judgment_question(predicted_entity, entity_mentions[idx])
+            for idx, predicted_entity in enumerate(predict_entity_names)
+            if predicted_entity and processed_entity_names[idx]
+        ]
+        entity_descs = prompt_budget.fit(
+            [entity_descriptions.get(entity_name, "No description available.") for entity_name in predict_entity_names],
+            fixed=document_header + ''.join(f"\n- {entity_name}: " for entity_name in predict_entity_names)
+            + max(questions, key=prompt_budget.count, default=''),
+        )
+        document_prefix = document_header + ''.join(
+            f"\n- {entity_name}: {entity_desc}" for entity_name, entity_desc in zip(predict_entity_names, entity_descs)
+        )
+    items = []
+    for idx, predicted_entity in enumerate(predict_entity_names):
+        if not predicted_entity or not processed_entity_names[idx]:
+            items.append((predicted_entity, False, None))
+            continue
         
-        # Map predicted entity names to descriptions
-        entity_descriptions = {}
-        for idx, result in enumerate(multi_choice_prompt_results):
-            match = re.search(r'\d+', result)
-            if match:
-                choice_idx = int(match.group(0)) - 1
-                if 0 <= choice_idx < len(entity_candidates_descriptions[idx]):
-                    description = entity_candidates_descriptions[idx][choice_idx]
-                    predicted_entity = predict_entity_names[idx]
-                    entity_descriptions[predicted_entity] = description
-            else:
-                continue
+        original_entity = entity_mentions[idx]
+        is_replacement_correct = (processed_entity_names[idx] == predicted_entity) if (processed_entity_names[idx] and predicted_entity) else False
         
-        # Validate each entity
-        validation_data = []
-        for idx, predicted_entity in enumerate(predict_entity_names):
-            if not predicted_entity or not processed_entity_names[idx]:
-                validation_data.append({
-                    'entity': '',
-                    'validation_prompt': '',
-                    'validation_reply': '',
-                    'validation_result': 'Yes'
-                })
-                continue
-            
-            original_entity = entity_mentions[idx]
-            is_replacement_correct = (processed_entity_names[idx] == predicted_entity) if (processed_entity_names[idx] and predicted_entity) else False
-            
-            description = entity_descriptions.get(predicted_entity, "No description available.")
-            prompt = f"""
+        if prefix_first:
+            prompt = LayeredPrompt(document_prefix, judgment_question(predicted_entity, original_entity))
+            prompt_budget.account(prompt)
+            items.append((predicted_entity, is_replacement_correct, prompt))
+            continue
+
+        description = entity_descriptions.get(predicted_entity, "No description available.")
+        entity_descs = [entity_descriptions.get(entity_name, "No description available.") for entity_name in predict_entity_names]
+        # the descriptions are trimmed to the prompt budget, the sentences and the question are kept
+        fixed = f"""
+Original sentence: {sentence}
+Sentence after replacement: {new_sentence}
+
+Please judge whether the entity '{predicted_entity}' in the new sentence ('Sentence after replacement')
+correctly refers to the same entity as '{original_entity}' in the original sentence ('Original sentence').
+Please base your judgment on the following entity descriptions in the sentence.
+Answer "Yes" or "No" and briefly explain your reasoning.
+If you are not sure about your answer, you should also state that.
+
+Entities in the sentence:
+{predicted_entity}: 
+""" + ''.join(f"\n- {entity_name}: " for entity_name in predict_entity_names) + ('\n' + answer_format if answer_format else '')
+        description, *entity_descs = prompt_budget.fit([description] + entity_descs, fixed=fixed)
+        prompt = f"""
 Original sentence: {sentence}
 Sentence after replacement: {new_sentence}
 
@@ -168,42 +215,120 @@ If you are not sure about your answer, you should also state that.
 Entities in the sentence:
 {predicted_entity}: {description}
 """
+        
+        for entity_name, entity_desc in zip(predict_entity_names, entity_descs):
+            prompt += f"\n- {entity_name}: {entity_desc}"
+        if answer_format:
+            prompt += '\n' + answer_format
+        prompt_budget.account(prompt)
+        
+        items.append((predicted_entity, is_replacement_correct, prompt))
+    
+    return items
+
+def validate_replacements(data, max_in_flight=32, llm_args=None, prefix_first=False, structured=False):
+    """
+    Validate entity replacements using LLM
+    """
+    stats = Counter()
+    if structured:
+        llm_function = openai_chatgpt_structured
+        llm_kwargs = dict(model=VALIDATION_MODEL, role='user', profile='structured_verdict', schema='verdict')
+    else:
+        llm_function = openai_chatgpt
+        llm_kwargs = dict(model=VALIDATION_MODEL, role='user', profile='verdict')
+    cascade = get_cascade()
+    ask = llm_function
+    if cascade is not None:
+        ask = cascade.wrap(llm_function, lambda prompt, result: cascade.verdict_reason(result))
+    
+    def request_validation(prompt):
+        """Call the LLM, retried by the shared retry policy of openai_function; returns (reply, structured answer)"""
+        try:
+            if structured:
+                response, answer = ask(prompt, **llm_kwargs)
+            else:
+                response, answer = ask(prompt, **llm_kwargs), None
+            return response.strip(), answer
+        except Exception as e:
+            print(f"Error occurred: {e}. Skipping this entity.")
+            return None
+    
+    doc_key2items = {
+        doc_key: build_validation_items(doc_value, prefix_first=prefix_first, structured=structured)
+        for doc_key, doc_value in data.items()
+    }
+    doc_key2prompts = {
+        doc_key: [prompt for _, _, prompt in items if prompt is not None]
+        for doc_key, items in doc_key2items.items()
+    }
+    
+    def fold_document(doc_key, llm_replies):
+        llm_replies = iter(llm_replies)
+        validation_data = []
+        for predicted_entity, is_replacement_correct, prompt in doc_key2items[doc_key]:
+            if prompt is None:
+                validation_data.append({
+                    'entity': '',
+                    'validation_prompt': '',
+                    'validation_reply': '',
+                    'validation_result': 'Yes'
+                })
+                continue
             
-            for entity_name in predict_entity_names:
-                entity_desc = entity_descriptions.get(entity_name, "No description available.")
-                prompt += f"\n- {entity_name}: {entity_desc}"
-            
-            llm_reply = retry_request(prompt)
-            if not llm_reply:
+            llm_result = next(llm_replies)
+            if not llm_result or not llm_result[0]:
                 continue
+            llm_reply, answer = llm_result
             
-            llm_judgment = "yes" in llm_reply.lower()
+            llm_judgment = answer['verdict'] == 'yes' if answer is not None else is_positive_verdict(llm_reply)
             
-            validation_data.append({
+            validation = {
                 'entity': predicted_entity,
                 'validation_prompt': prompt.strip(),
                 'validation_reply': llm_reply.strip(),
                 'validation_result': 'Yes' if llm_judgment else 'No'
-            })
+            }
+            if answer is not None:
+                validation['validation_confidence'] = answer['confidence']
+            validation_data.append(validation)
             
             # Update statistics
             if llm_judgment and is_replacement_correct:
-                llm_correct += 1
-                true_positives += 1
+                stats['llm_correct'] += 1
+                stats['true_positives'] += 1
             elif not llm_judgment and not is_replacement_correct:
-                llm_correct += 1
-                true_negatives += 1
+                stats['llm_correct'] += 1
+                stats['true_negatives'] += 1
             elif llm_judgment and not is_replacement_correct:
-                llm_incorrect += 1
-                false_positives += 1
+                stats['llm_incorrect'] += 1
+                stats['false_positives'] += 1
             elif not llm_judgment and is_replacement_correct:
-                llm_incorrect += 1
-                false_negatives += 1
+                stats['llm_incorrect'] += 1
+                stats['false_negatives'] += 1
             
-            total_cases += 1
-            time.sleep(3)
+            stats['total_cases'] += 1
         
-        doc_value['validation_data'] = validation_data
+        data[doc_key]['validation_data'] = validation_data
+    
+    if llm_args is not None:
+        run_offline_batch(llm_args, llm_function, doc_key2prompts, **llm_kwargs)
+    
+    run_batch_by_document(
+        request_validation,
+        doc_key2prompts,
+        fold_document,
+        max_in_flight=max_in_flight,
+        desc='Validating replacements',
+    )
+    
+    llm_correct = stats['llm_correct']
+    llm_incorrect = stats['llm_incorrect']
+    total_cases = stats['total_cases']
+    false_positives = stats['false_positives']
+    false_negatives = stats['false_negatives']
+    true_positives = stats['true_positives']
+    true_negatives = stats['true_negatives']
     
     # Print evaluation results
     print(f"\nTotal test cases: {total_cases}")
@@ -1,14 +1,34 @@
 import os
 import json
-import time
 import argparse
-from tqdm import tqdm
 import openai
 from DeepEL.openai_key import OPENAI_API_KEY
 openai.api_key = OPENAI_API_KEY
 openai.api_base="https://api.chatnio.net/v1"
 # import random
-from DeepEL.openai_function import openai_chatgpt, openai_completion
+from DeepEL.openai_function import (
+    openai_chatgpt,
+    openai_completion,
+    openai_chatgpt_logprobs,
+    openai_completion_logprobs,
+    openai_chatgpt_structured,
+)
+from DeepEL.choice_scoring import choice_probabilities
+from DeepEL.structured_output import schema_instructions
+from DeepEL.token_budget import get_prompt_budget
+from DeepEL.cascade import get_cascade
+from DeepEL.prompt_layout import LayeredPrompt
+from DeepEL.openai_async import run_batch_by_document
+from DeepEL.llm_config import add_llm_arguments, configure_llm, run_offline_batch, report_llm
+
+# shared prefix of the selection prompts with --prefix_first_layout: the candidates and the explanation differ for
+# every mention, so only these instructions (about 60 tokens) are shared, far below the PROVIDER_MIN_PREFIX_TOKENS
+# of the hosted prompt caches; the layout gains nothing with the API, only with local engines caching short prefixes
+SELECTION_INSTRUCTIONS = (
+    'Read the candidate entities and the explanation of a mention below, then decide which candidate the mention '
+    'refers to. Return a number to represent your answer.' + '\n' + 'If you cannot determine the correct answer, '
+    'or if none of the options match the entity, return "none" or 0.'
+)
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -66,6 +86,15 @@ def parse_args():
         ],
         type=str,
     )
+    parser.add_argument(
+        "--selection_mode",
+        help="generate: parse the number out of a short reply; "
+             "logprobs: score every candidate from the top logprobs of a single answer token",
+        default='generate',
+        choices=['generate', 'logprobs'],
+        type=str,
+    )
+    add_llm_arguments(parser)
 
     args = parser.parse_args()
 
@@ -77,14 +106,24 @@ def parse_args():
 
 def main():
     args = parse_args()
+    configure_llm(args)
     openai_model = args.openai_model
     openai_mode = args.openai_mode
+    use_logprobs = args.selection_mode == 'logprobs'
+    structured = args.structured_output != 'off'
+    if structured and (use_logprobs or openai_mode != 'chatgpt'):
+        raise ValueError('--structured_output needs --openai_mode chatgpt and --selection_mode generate')
     if openai_mode == 'chatgpt':
-        openai_function = openai_chatgpt
+        openai_function = openai_chatgpt_logprobs if use_logprobs else openai_chatgpt
     elif openai_mode == 'gpt':
-        openai_function = openai_completion
+        openai_function = openai_completion_logprobs if use_logprobs else openai_completion
     else:
         raise ValueError('Unknown gpt mode')
+    profile = 'single_token' if use_logprobs else 'choice'
+    llm_kwargs = dict(model=openai_model, profile=profile)
+    if structured:
+        openai_function = openai_chatgpt_structured
+        llm_kwargs = dict(model=openai_model, profile='structured_choice', schema='choice')
 
     input_file = args.input_file
     output_file = args.output_file
@@ -100,7 +139,10 @@ def main():
     else:
         exist_doc_names = []
 
-    for doc_name, instance in tqdm(doc_name2instance.items()):
+    prompt_budget = get_prompt_budget()
+    doc_name2prompts = dict()
+    prompt2num_choices = dict()
+    for doc_name, instance in doc_name2instance.items():
         if doc_name in exist_doc_names and 'multi_choice_prompts' in exist_doc_name2instance[doc_name]['entities']:
             doc_name2instance[doc_name]['entities'] = exist_doc_name2instance[doc_name]['entities']
             continue
@@ -108,7 +150,6 @@ def main():
         entities = instance['entities']
 
         multi_choice_prompts = []
-        multi_choice_prompt_results = []
 
         for (
             entity_mention, 
@@ -121,22 +162,61 @@ def main():
             entities['entity_candidates'],
             entities['entity_candidates_descriptions'],
         ):
-            
+            question = f'Which of the following entities is {entity_mention} in this sentence?Return a number to represent your answer.'+ '\n' + f'If you cannot determine the correct answer, or if none of the options match the entity，return "none" or 0.'
+            answer_format = '\nAnswer with the number only.' if use_logprobs else ''
+            if structured:
+                answer_format = '\n' + schema_instructions('choice')
+            entity_candidates = entity_candidates[:len(entity_candidates_description)]
+            descriptions = [
+                entity_candidate_description[:num_entity_description_characters]
+                for entity_candidate_description in entity_candidates_description[:len(entity_candidates)]
+            ]
+            # the explanation and the descriptions are trimmed to the prompt budget, the question and names are kept
+            fixed = question + answer_format + ''.join(f'({index + 1}). {entity_candidate} \n' for index, entity_candidate in enumerate(entity_candidates))
+            prompt_result, *descriptions = prompt_budget.fit([prompt_result] + descriptions, fixed=fixed)
+
             multi_choice_prompt = ''
-            for index, (entity_candidate, entity_candidate_description) in enumerate(zip(entity_candidates, entity_candidates_description)):
-                description = entity_candidate + ' ' + entity_candidate_description[:num_entity_description_characters]
+            for index, (entity_candidate, entity_candidate_description) in enumerate(zip(entity_candidates, descriptions)):
+                description = entity_candidate + ' ' + entity_candidate_description
                 multi_choice_prompt += f'({index + 1}). ' + description + '\n'
         
             
-            multi_choice_prompt = prompt_result + '\n\n' + f'Which of the following entities is {entity_mention} in this sentence?Return a number to represent your answer.'+ '\n' + f'If you cannot determine the correct answer, or if none of the options match the entity，return "none" or 0.' + '\n\n' + multi_choice_prompt
-
-            complete_output = openai_function(multi_choice_prompt, model=openai_model)
+            if args.prefix_first_layout:
+                multi_choice_prompt = LayeredPrompt(
+                    SELECTION_INSTRUCTIONS + answer_format + '\n\n',
+                    'Candidate entities:\n' + multi_choice_prompt + '\n' + prompt_result + '\n\n'
+                    + f'Which of the candidate entities is {entity_mention} in this sentence?',
+                )
+            else:
+                multi_choice_prompt = prompt_result + '\n\n' + question + '\n\n' + multi_choice_prompt + answer_format
+            prompt_budget.account(multi_choice_prompt)
+            prompt2num_choices[multi_choice_prompt] = len(entity_candidates)
 
             multi_choice_prompts.append(multi_choice_prompt)
-            multi_choice_prompt_results.append(complete_output)
-            time.sleep(3)
 
-        entities['multi_choice_prompts'] = multi_choice_prompts
+        doc_name2prompts[doc_name] = multi_choice_prompts
+
+    def save_document(doc_name, multi_choice_prompt_results):
+        entities = doc_name2instance[doc_name]['entities']
+        if use_logprobs:
+            # keep the best answer as the reply, so later stages parse it as before
+            multi_choice_probabilities = []
+            replies = []
+            for (reply, top_logprobs), entity_candidates in zip(multi_choice_prompt_results, entities['entity_candidates']):
+                probabilities = choice_probabilities(top_logprobs, len(entity_candidates))
+                multi_choice_probabilities.append(probabilities)
+                replies.append(reply if probabilities is None else str(probabilities.index(max(probabilities))))
+            multi_choice_prompt_results = replies
+            entities['multi_choice_probabilities'] = multi_choice_probabilities
+        elif structured:
+            # keep the chosen number as the reply, so later stages read it as before
+            entities['multi_choice_confidences'] = [
+                None if answer is None else answer['confidence'] for _, answer in multi_choice_prompt_results
+            ]
+            multi_choice_prompt_results = [
+                reply if answer is None else str(answer['answer']) for reply, answer in multi_choice_prompt_results
+            ]
+        entities['multi_choice_prompts'] = doc_name2prompts[doc_name]
         entities['multi_choice_prompt_results'] = multi_choice_prompt_results
         doc_name2instance[doc_name]['entities'] = entities
 
@@ -144,6 +224,24 @@ def main():
         with open(output_file, 'w') as writer:
             json.dump(doc_name2instance, writer, indent=4)
 
+    run_offline_batch(args, openai_function, doc_name2prompts, **llm_kwargs)
+
+    cascade = get_cascade()
+    if cascade is not None:
+        openai_function = cascade.wrap(
+            openai_function, lambda prompt, result: cascade.choice_reason(result, prompt2num_choices[prompt]),
+        )
+
+    run_batch_by_document(
+        openai_function,
+        doc_name2prompts,
+        save_document,
+        max_in_flight=args.max_in_flight,
+        desc='Selecting entities',
+        **llm_kwargs,
+    )
+    report_llm(output_file)
+
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,105 @@
+"""
+Adaptive (AIMD) concurrency limit of the LLM client.
+
+The number of requests allowed in flight grows by about one per window of successful, fast requests (additive
+increase) and is cut by ``decrease_factor`` when the upstream throttles us or times out (multiplicative
+decrease). Only one cut is made per window: failures of requests that were already in flight when the limit was
+last cut are the same congestion event and are not counted again.
+"""
+import time
+import threading
+from DeepEL.retry_policy import RATE_LIMIT, TIMEOUT
+
+CONGESTION_ERRORS = {RATE_LIMIT, TIMEOUT}
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Thread-safe AIMD limit on the number of concurrent requests.
+    """
+
+    def __init__(
+        self,
+        initial_limit=8,
+        min_limit=1,
+        max_limit=32,
+        decrease_factor=0.5,
+        latency_tolerance=2.0,
+        smoothing=0.1,
+    ):
+        """
+        :param initial_limit: requests allowed in flight at start
+        :param min_limit: the limit never goes below it
+        :param max_limit: the limit never goes above it (the --max_in_flight of the stage)
+        :param decrease_factor: the limit is multiplied by it on throttling or timeouts
+        :param latency_tolerance: successes slower than this many times the smoothed latency do not raise the limit
+        :param smoothing: weight of the newest latency in the smoothed latency
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+        self.smoothed_latency = None
+        self.in_flight = 0
+        self.lowest_limit = self.limit
+        self.highest_limit = self.limit
+        self.increases = 0
+        self.decreases = 0
+        self._last_decrease = float('-inf')
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Wait for a free slot and take it; returns the start time to pass back to release().
+        """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+        return time.monotonic()
+
+    def release(self, started, error_class=None, sent=True):
+        """
+        Give the slot back and adapt the limit to the outcome of the request.
+
+        :param started: value returned by acquire()
+        :param error_class: error class of retry_policy, None on success
+        :param sent: False when the request was given up before it was sent, the limit is left unchanged
+        """
+        now = time.monotonic()
+        with self._condition:
+            self.in_flight -= 1
+            if sent and error_class is None:
+                self._on_success(now - started)
+            elif sent and error_class in CONGESTION_ERRORS and started >= self._last_decrease:
+                self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                self._last_decrease = now
+                self.decreases += 1
+                self.lowest_limit = min(self.lowest_limit, self.limit)
+            self._condition.notify_all()
+
+    def _on_success(self, latency):
+        healthy = self.smoothed_latency is None or latency <= self.latency_tolerance * self.smoothed_latency
+        if self.smoothed_latency is None:
+            self.smoothed_latency = latency
+        else:
+            self.smoothed_latency += self.smoothing * (latency - self.smoothed_latency)
+        if healthy and self.limit < self.max_limit:
+            # about +1 per window of `limit` successful requests
+            self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self.increases += 1
+            self.highest_limit = max(self.highest_limit, self.limit)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'lowest_limit': int(self.lowest_limit),
+                'highest_limit': int(self.highest_limit),
+                'increases': self.increases,
+                'decreases': self.decreases,
+                'smoothed_latency': self.smoothed_latency,
+            }
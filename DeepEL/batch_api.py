@@ -0,0 +1,226 @@
+"""
+Offline Batch API mode of the LLM stages.
+
+Instead of answering prompts in real time, a stage writes the requests it would send as a batch JSONL file,
+submits it to the Batch API (``/files`` + ``/batches``), polls until the batch is done and stores every answer
+in the LLM response cache under the same key the real-time call uses. The stage then runs its usual pass, which
+reads the answers back from the cache and folds them into ``doc_name2instance``; requests the batch could not
+answer fall back to real-time calls.
+
+The id of a submitted batch is saved next to its input file, so an interrupted run resumes polling instead of
+paying for the batch again.
+"""
+import os
+import json
+import time
+import hashlib
+import openai
+import requests
+from DeepEL.llm_cache import request_key
+from DeepEL.openai_function import REQUEST_BUILDERS, get_llm_cache
+
+# Batch API endpoint of each API resource
+BATCH_ENDPOINTS = {
+    'ChatCompletion': '/v1/chat/completions',
+    'Completion': '/v1/completions',
+}
+MAX_BATCH_REQUESTS = 50000
+FINAL_STATUSES = {'completed', 'failed', 'expired', 'cancelled'}
+
+
+class BatchClient:
+    """
+    Minimal client of the Batch API; ``api_base`` and ``api_key`` default to the ones of the openai module.
+    """
+
+    def __init__(self, api_base=None, api_key=None, session=None):
+        self.api_base = (api_base or openai.api_base).rstrip('/')
+        self.api_key = api_key or openai.api_key
+        self.session = session or requests.Session()
+
+    def _request(self, method, path, **kwargs):
+        response = self.session.request(
+            method,
+            self.api_base + path,
+            headers={'Authorization': f'Bearer {self.api_key}'},
+            timeout=120,
+            **kwargs,
+        )
+        response.raise_for_status()
+        return response
+
+    def upload_file(self, file):
+        with open(file, 'rb') as reader:
+            response = self._request(
+                'POST',
+                '/files',
+                data={'purpose': 'batch'},
+                files={'file': (os.path.basename(file), reader, 'application/jsonl')},
+            )
+        return response.json()['id']
+
+    def create_batch(self, input_file_id, endpoint):
+        response = self._request(
+            'POST',
+            '/batches',
+            json={'input_file_id': input_file_id, 'endpoint': endpoint, 'completion_window': '24h'},
+        )
+        return response.json()
+
+    def retrieve_batch(self, batch_id):
+        return self._request('GET', f'/batches/{batch_id}').json()
+
+    def file_content(self, file_id):
+        return self._request('GET', f'/files/{file_id}/content').text
+
+
+def wait_for_batch(client, batch_id, num_requests, poll_interval):
+    """
+    Poll a batch until it reaches a final status; returns the batch, or None if the server does not know it.
+    """
+    while True:
+        try:
+            batch = client.retrieve_batch(batch_id)
+        except requests.HTTPError as error:
+            if error.response is not None and error.response.status_code == 404:
+                return None
+            raise
+        counts = batch.get('request_counts') or {}
+        print(
+            f"Batch {batch_id}: {batch['status']}, "
+            f"{counts.get('completed', 0)}/{counts.get('total', num_requests)} completed, {counts.get('failed', 0)} failed"
+        )
+        if batch['status'] in FINAL_STATUSES:
+            return batch
+        time.sleep(poll_interval)
+
+
+def is_finished(batch):
+    """
+    Whether a batch completed with results: an output file, or only an error file when every request failed.
+    """
+    return (
+        batch is not None and batch['status'] == 'completed'
+        and bool(batch.get('output_file_id') or batch.get('error_file_id'))
+    )
+
+
+def log_batch_errors(client, batch):
+    """
+    Print how many requests of a batch failed, and the first error, from its error file.
+    """
+    errors = [json.loads(row) for row in client.file_content(batch['error_file_id']).splitlines() if row.strip()]
+    if errors:
+        error = errors[0].get('error') or (errors[0].get('response') or {}).get('body')
+        print(f"Batch {batch['id']}: {len(errors)} requests failed (error file {batch['error_file_id']}), e.g. {error}")
+
+
+def run_batch_job(client, lines, batch_dir, endpoint, poll_interval=60):
+    """
+    Submit one batch (or resume the one already submitted for the same lines) and wait for it. A resumed batch
+    that ended failed, expired or cancelled is forgotten and submitted again; a new batch that ends that way
+    raises RuntimeError. A batch completed without any answered request (only an error file) gives an empty
+    dict, its requests are left to real-time calls.
+
+    :param client: BatchClient
+    :param lines: list of batch request lines ({"custom_id", "method", "url", "body"})
+    :param batch_dir: directory of the batch input files and their saved batch ids
+    :param endpoint: Batch API endpoint of the requests, e.g. '/v1/chat/completions'
+    :param poll_interval: seconds between two status checks
+    :return: dict, custom_id -> response body of every request answered with status 200
+    """
+    serialized = ''.join(json.dumps(line, ensure_ascii=False) + '\n' for line in lines)
+    digest = hashlib.sha256(serialized.encode('utf-8')).hexdigest()[:16]
+    input_file = os.path.join(batch_dir, f'batch_{digest}.jsonl')
+    state_file = os.path.join(batch_dir, f'batch_{digest}.state.json')
+
+    batch = None
+    if os.path.isfile(state_file):
+        with open(state_file) as reader:
+            batch_id = json.load(reader)['batch_id']
+        print(f'Resuming batch {batch_id} ({len(lines)} requests)')
+        batch = wait_for_batch(client, batch_id, len(lines), poll_interval)
+        if not is_finished(batch):
+            # a dead batch must not be resumed on every rerun: forget it and submit the requests again
+            status = batch['status'] if batch is not None else 'unknown to the server'
+            print(f'Batch {batch_id} ended {status} without output, submitting the requests again')
+            os.remove(state_file)
+            batch = None
+
+    if batch is None:
+        with open(input_file, 'w', encoding='utf-8') as writer:
+            writer.write(serialized)
+        input_file_id = client.upload_file(input_file)
+        batch_id = client.create_batch(input_file_id, endpoint)['id']
+        with open(state_file, 'w') as writer:
+            json.dump({'batch_id': batch_id, 'input_file_id': input_file_id}, writer)
+        print(f'Submitted batch {batch_id} ({len(lines)} requests)')
+        batch = wait_for_batch(client, batch_id, len(lines), poll_interval)
+        if not is_finished(batch):
+            os.remove(state_file)
+            status = batch['status'] if batch is not None else 'unknown to the server'
+            raise RuntimeError(f'batch {batch_id} ended {status} without output')
+
+    if batch.get('error_file_id'):
+        log_batch_errors(client, batch)
+    custom_id2body = dict()
+    if not batch.get('output_file_id'):
+        return custom_id2body
+    for row in client.file_content(batch['output_file_id']).splitlines():
+        if not row.strip():
+            continue
+        result = json.loads(row)
+        response = result.get('response') or {}
+        if response.get('status_code') == 200 and not result.get('error'):
+            custom_id2body[result['custom_id']] = response['body']
+    return custom_id2body
+
+
+def prefill_cache_with_batch_api(function, prompts, batch_dir, client=None, poll_interval=60, **kwargs):
+    """
+    Answer ``function(prompt, **kwargs)`` for all prompts through the Batch API and store the answers in the LLM
+    cache, skipping prompts that are already cached.
+
+    :param function: openai_chatgpt or openai_completion
+    :param prompts: list of prompts of the stage
+    :param batch_dir: directory of the batch input files and their saved batch ids
+    :param client: BatchClient, defaults to the api_base / api_key of the openai module
+    :param poll_interval: seconds between two status checks
+    :return: (number of submitted requests, number of answered requests)
+    """
+    cache = get_llm_cache()
+    if cache is None:
+        raise ValueError('the offline batch mode stores its answers in the LLM cache, enable --llm_cache')
+    if cache.bypass:
+        raise ValueError('the offline batch mode cannot be combined with --llm_cache_bypass')
+    builder = REQUEST_BUILDERS[function]
+    client = client or BatchClient()
+    os.makedirs(batch_dir, exist_ok=True)
+
+    lines = []
+    keys = set()
+    endpoint = None
+    for prompt in prompts:
+        api, request = builder(prompt, **kwargs)
+        endpoint = BATCH_ENDPOINTS[api.__name__]
+        key = request_key(api.__name__, request)
+        if key in keys or cache.contains(key):
+            continue
+        keys.add(key)
+        lines.append({'custom_id': key, 'method': 'POST', 'url': endpoint, 'body': request})
+
+    num_answered = 0
+    for offset in range(0, len(lines), MAX_BATCH_REQUESTS):
+        custom_id2body = run_batch_job(
+            client, lines[offset: offset + MAX_BATCH_REQUESTS], batch_dir, endpoint, poll_interval=poll_interval,
+        )
+        for key, body in custom_id2body.items():
+            cache.put(key, body)
+        num_answered += len(custom_id2body)
+
+    print(
+        f'Batch API: {len(prompts)} prompts, {len(prompts) - len(lines)} already cached or duplicated, '
+        f'{len(lines)} submitted, {num_answered} answered, '
+        f'{len(lines) - num_answered} left to real-time calls'
+    )
+    return len(lines), num_answered
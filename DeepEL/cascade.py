@@ -0,0 +1,169 @@
+"""
+Model cascade of the LLM stages: ask a fast, cheap model first and escalate to the model of the stage only when
+the fast answer is not trustworthy.
+
+Each stage tells the cascade why an answer should be escalated, from the signals it has:
+
+* ``malformed``: no usable answer (no candidate number, no yes / no, an empty description);
+* ``low_confidence``: the confidence of a structured answer, or the probability margin between the two best
+  candidates in the logprobs mode, is below the threshold;
+* ``uncertain``: the reply says it is not sure;
+* ``disagreement``: the chosen candidate is not the BLINK top-1 (candidate 1), with ``escalate_on_disagreement``.
+
+The escalation rate of every reason is reported at the end of the stage.
+"""
+import re
+import threading
+from collections import Counter
+from DeepEL.choice_scoring import choice_probabilities
+from DeepEL.structured_output import choice_index, parse_structured, StructuredOutputError
+
+# phrases of a reply admitting it does not know the answer
+UNCERTAIN_PATTERN = re.compile(
+    r"\b(not sure|unsure|uncertain|cannot determine|can't determine|unable to determine|not enough information|"
+    r"i don't know|i do not know)\b",
+    re.IGNORECASE,
+)
+
+
+class Cascade:
+    """
+    :param fast_model: model asked first
+    :param min_confidence: structured answers less confident than this are escalated
+    :param min_margin: in the logprobs mode, answers whose probability exceeds the second best by less than this
+        are escalated
+    :param escalate_on_disagreement: escalate the choices that are not the BLINK top-1 candidate
+    """
+
+    def __init__(self, fast_model, min_confidence=0.7, min_margin=0.2, escalate_on_disagreement=False):
+        self.fast_model = fast_model
+        self.min_confidence = min_confidence
+        self.min_margin = min_margin
+        self.escalate_on_disagreement = escalate_on_disagreement
+        self.calls = 0
+        self.escalations = Counter()
+        self._lock = threading.Lock()
+
+    def call(self, function, prompt, reason, model, **kwargs):
+        """
+        ``function(prompt, model=fast_model, **kwargs)``, asked again with ``model`` when ``reason(result)`` gives a
+        reason to escalate (a string) instead of None.
+        """
+        if model == self.fast_model:
+            return function(prompt, model=model, **kwargs)
+        result = function(prompt, model=self.fast_model, **kwargs)
+        escalation = reason(result)
+        with self._lock:
+            self.calls += 1
+            if escalation is not None:
+                self.escalations[escalation] += 1
+        if escalation is None:
+            return result
+        return function(prompt, model=model, **kwargs)
+
+    def wrap(self, function, reason):
+        """
+        Per-prompt function of run_batch_by_document going through the cascade; ``reason(prompt, result)``.
+        """
+        def cascaded(prompt, model, **kwargs):
+            return self.call(function, prompt, lambda result: reason(prompt, result), model, **kwargs)
+        return cascaded
+
+    def choice_reason(self, result, num_choices):
+        """
+        Reason to escalate a candidate choice: a reply (generate mode), (reply, top_logprobs) (logprobs mode) or
+        (reply, answer) (structured output).
+        """
+        confident, uncertain = True, False
+        if isinstance(result, str):
+            answer, uncertain = choice_index(result), bool(UNCERTAIN_PATTERN.search(result))
+        elif isinstance(result[1], dict):
+            answer, confident = result[1]['answer'], result[1]['confidence'] >= self.min_confidence
+        elif result[1]:
+            probabilities = choice_probabilities(result[1], num_choices)
+            if probabilities is None:
+                return 'malformed'
+            answer = probabilities.index(max(probabilities))
+            best, second = sorted(probabilities, reverse=True)[:2]
+            confident = best - second >= self.min_margin
+        else:
+            return 'malformed'
+        if answer is None or answer > num_choices:
+            return 'malformed'
+        if not confident:
+            return 'low_confidence'
+        if uncertain:
+            return 'uncertain'
+        if self.escalate_on_disagreement and answer != 1:
+            return 'disagreement'
+        return None
+
+    def verdict_reason(self, result):
+        """
+        Reason to escalate a validation: a reply or (reply, answer) of structured output.
+        """
+        if not isinstance(result, str):
+            _, answer = result
+            if answer is None:
+                return 'malformed'
+            return 'low_confidence' if answer['confidence'] < self.min_confidence else None
+        try:
+            answer = parse_structured('verdict', result)
+            return 'low_confidence' if answer['confidence'] < self.min_confidence else None
+        except StructuredOutputError:
+            pass
+        words = re.findall(r'[a-z]+', result.lower())
+        if not words or words[0] not in ('yes', 'no'):
+            return 'malformed'
+        if UNCERTAIN_PATTERN.search(result):
+            return 'uncertain'
+        return None
+
+    def description_reason(self, reply):
+        """
+        Reason to escalate the description of a mention.
+        """
+        if not reply or not reply.strip():
+            return 'malformed'
+        if UNCERTAIN_PATTERN.search(reply):
+            return 'uncertain'
+        return None
+
+    def descriptions_reason(self, result):
+        """
+        Reason to escalate the (reply, answer) of a request describing several mentions (schema ``descriptions``):
+        no answer, or one of its descriptions is empty or unsure. The mentions left out of the answer are not a
+        reason, they are asked again on their own.
+        """
+        _, answer = result
+        if answer is None:
+            return 'malformed'
+        for item in answer['descriptions']:
+            reason = self.description_reason(item['description'])
+            if reason is not None:
+                return reason
+        return None
+
+    def stats(self):
+        with self._lock:
+            escalated = sum(self.escalations.values())
+            return {
+                'fast_model': self.fast_model,
+                'calls': self.calls,
+                'escalations': escalated,
+                'escalation_rate': escalated / self.calls if self.calls else 0.0,
+                'reasons': dict(self.escalations),
+            }
+
+
+# cascade of the running stage, see set_cascade
+_cascade = None
+
+
+def set_cascade(cascade):
+    global _cascade
+    _cascade = cascade
+
+
+def get_cascade():
+    return _cascade
@@ -0,0 +1,121 @@
+"""
+Record / replay of LLM traffic ("cassettes").
+
+In record mode every request answered by openai_function is written to a SQLite file with its response and
+latency. In replay mode the requests are answered from that file only, without touching the network, either
+instantly or with the recorded latency, so full pipeline runs can be repeated to profile the non-LLM parts or
+to reproduce a regression. A request missing from the cassette raises CassetteMissError.
+"""
+import os
+import json
+import time
+import zlib
+import sqlite3
+import threading
+
+RECORD = 'record'
+REPLAY = 'replay'
+
+
+class CassetteMissError(LookupError):
+    """
+    A replayed request is not in the cassette.
+    """
+
+
+def _prompt_excerpt(request, length=120):
+    if 'messages' in request:
+        text = request['messages'][-1]['content']
+    else:
+        text = str(request.get('prompt', ''))
+    text = ' '.join(text.split())
+    return text if len(text) <= length else text[:length] + '...'
+
+
+class Cassette:
+    """
+    SQLite file of recorded requests, indexed by the request key of llm_cache.
+
+    :param path: cassette file
+    :param mode: 'record' (add every request and response) or 'replay' (answer from the cassette only)
+    :param replay_latency: in replay mode, wait the recorded latency before answering
+    """
+
+    def __init__(self, path, mode=RECORD, replay_latency=False):
+        if mode not in (RECORD, REPLAY):
+            raise ValueError(f'unknown cassette mode {mode!r}')
+        if mode == REPLAY and not os.path.isfile(path):
+            raise FileNotFoundError(f'cassette {path} does not exist, record it first')
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.mode = mode
+        self.replay_latency = replay_latency
+        self.recorded = 0
+        self.replayed = 0
+        self.missing = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS interactions ('
+            'key TEXT PRIMARY KEY, kind TEXT NOT NULL, request BLOB NOT NULL, response BLOB NOT NULL, '
+            'latency REAL NOT NULL, recorded REAL NOT NULL)'
+        )
+
+    @property
+    def replaying(self):
+        return self.mode == REPLAY
+
+    def record(self, key, kind, request, response, latency):
+        """
+        Store one answered request; a request recorded again keeps its latest response.
+        """
+        row = (
+            key,
+            kind,
+            zlib.compress(json.dumps(request, ensure_ascii=False).encode('utf-8')),
+            zlib.compress(json.dumps(response, ensure_ascii=False).encode('utf-8')),
+            latency,
+            time.time(),
+        )
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO interactions VALUES (?, ?, ?, ?, ?, ?)', row)
+            self.recorded += 1
+
+    def replay(self, key, request):
+        """
+        Recorded response of ``key``; raises CassetteMissError if it was never recorded.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT response, latency FROM interactions WHERE key = ?', (key,),
+            ).fetchone()
+            if row is None:
+                self.missing += 1
+            else:
+                self.replayed += 1
+        if row is None:
+            raise CassetteMissError(
+                f'request for model {request.get("model")} is not in cassette {self.path}: '
+                f'"{_prompt_excerpt(request)}"'
+            )
+        if self.replay_latency:
+            time.sleep(row[1])
+        return json.loads(zlib.decompress(row[0]))
+
+    def stats(self):
+        with self._lock:
+            size = self._connection.execute('SELECT COUNT(*) FROM interactions').fetchone()[0]
+            return {
+                'mode': self.mode,
+                'recorded': self.recorded,
+                'replayed': self.replayed,
+                'missing': self.missing,
+                'size': size,
+            }
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
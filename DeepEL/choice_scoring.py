@@ -0,0 +1,40 @@
+"""
+Scoring of multiple-choice answers from the logprobs of a single answer token.
+
+Instead of parsing a free-text reply, the selection stage asks for one token and turns the top logprobs of that
+token into a probability distribution over the answers 0 ("none") .. number of candidates.
+"""
+import math
+
+NONE_TOKENS = {'none', '0'}
+
+
+def answer_index(token, num_choices):
+    """
+    Answer a token stands for (0 for "none"), or None if it is not an answer.
+    """
+    token = token.strip().strip('().').lower()
+    if token in NONE_TOKENS:
+        return 0
+    if token.isdigit() and 1 <= int(token) <= num_choices:
+        return int(token)
+    return None
+
+
+def choice_probabilities(top_logprobs, num_choices):
+    """
+    Probability of every answer 0 .. ``num_choices`` given the top logprobs of the answer token, renormalized
+    over the tokens that are answers. Returns None when no top token is an answer.
+
+    :param top_logprobs: list of (token, logprob) of the first generated token
+    :param num_choices: number of candidates of the question
+    """
+    mass = [0.0] * (num_choices + 1)
+    for token, logprob in top_logprobs:
+        index = answer_index(token, num_choices)
+        if index is not None:
+            mass[index] += math.exp(logprob)
+    total = sum(mass)
+    if total == 0:
+        return None
+    return [probability / total for probability in mass]
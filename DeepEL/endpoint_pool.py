@@ -0,0 +1,143 @@
+"""
+Pool of LLM endpoints (api_base + api_key pairs) with load balancing and failover.
+
+Each request is routed to the healthy endpoint with the fewest outstanding requests per unit of weight. An
+endpoint failing ``failure_threshold`` times in a row is ejected for ``ejection_seconds`` (doubled on every
+further ejection, up to ``max_ejection_seconds``), and the retry policy sends the next attempt to another
+endpoint. The pool is read from a JSON file::
+
+    {
+        "failure_threshold": 3,
+        "ejection_seconds": 30,
+        "endpoints": [
+            {"name": "gateway-a", "api_base": "https://api.chatnio.net/v1", "api_key": "sk-...", "weight": 2,
+             "rate_limits": {"*": {"rpm": 3500, "tpm": 90000}}},
+            {"name": "gateway-b", "api_base": "https://api.openai.com/v1", "api_key_env": "OPENAI_API_KEY"}
+        ]
+    }
+"""
+import os
+import json
+import time
+import random
+import threading
+from DeepEL.rate_limiter import RateLimiter
+from DeepEL.retry_policy import BAD_REQUEST
+
+
+class Endpoint:
+    """
+    One api_base / api_key pair with its own rate limits and health state.
+    """
+
+    def __init__(self, api_base, api_key, name=None, weight=1.0, rate_limits=None):
+        self.api_base = api_base
+        self.api_key = api_key
+        self.name = name or api_base
+        self.weight = float(weight)
+        self.rate_limiter = RateLimiter(rate_limits) if rate_limits else None
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        # consecutive ejections, doubling the next ejection time; reset by a success
+        self.ejections = 0
+        self.total_ejections = 0
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.failures = 0
+
+    def is_healthy(self, now):
+        return now >= self.ejected_until
+
+
+class EndpointPool:
+    """
+    Weighted least-outstanding routing over endpoints, with automatic ejection of unhealthy ones.
+    """
+
+    def __init__(self, endpoints, failure_threshold=3, ejection_seconds=30.0, max_ejection_seconds=300.0):
+        if not endpoints:
+            raise ValueError('an endpoint pool needs at least one endpoint')
+        self.endpoints = endpoints
+        self.failure_threshold = failure_threshold
+        self.ejection_seconds = ejection_seconds
+        self.max_ejection_seconds = max_ejection_seconds
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, file):
+        with open(file) as reader:
+            config = json.load(reader)
+        endpoints = []
+        for endpoint in config['endpoints']:
+            api_key = endpoint.get('api_key')
+            if api_key is None and 'api_key_env' in endpoint:
+                api_key = os.environ[endpoint['api_key_env']]
+            endpoints.append(Endpoint(
+                endpoint['api_base'],
+                api_key,
+                name=endpoint.get('name'),
+                weight=endpoint.get('weight', 1.0),
+                rate_limits=endpoint.get('rate_limits'),
+            ))
+        return cls(
+            endpoints,
+            failure_threshold=config.get('failure_threshold', 3),
+            ejection_seconds=config.get('ejection_seconds', 30.0),
+            max_ejection_seconds=config.get('max_ejection_seconds', 300.0),
+        )
+
+    def acquire(self):
+        """
+        Pick the endpoint of the next request and count it as outstanding; pair every call with release().
+        When every endpoint is ejected, the one coming back first is used.
+        """
+        with self._lock:
+            now = time.monotonic()
+            candidates = [endpoint for endpoint in self.endpoints if endpoint.is_healthy(now)]
+            if not candidates:
+                candidates = [min(self.endpoints, key=lambda endpoint: endpoint.ejected_until)]
+            lowest = min((endpoint.outstanding + 1) / endpoint.weight for endpoint in candidates)
+            endpoint = random.choice([
+                endpoint for endpoint in candidates if (endpoint.outstanding + 1) / endpoint.weight == lowest
+            ])
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+        return endpoint
+
+    def release(self, endpoint, error_class=None, sent=True):
+        """
+        Record the outcome of a request routed to ``endpoint``; ``error_class`` is None on success and ``sent``
+        is False when the request was given up before reaching the endpoint.
+        Bad requests are the caller's fault and do not count against the endpoint.
+        """
+        with self._lock:
+            endpoint.outstanding -= 1
+            if not sent:
+                return
+            if error_class is None or error_class == BAD_REQUEST:
+                endpoint.consecutive_failures = 0
+                endpoint.ejections = 0
+                return
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+            if endpoint.consecutive_failures >= self.failure_threshold:
+                ejection = min(self.max_ejection_seconds, self.ejection_seconds * 2 ** endpoint.ejections)
+                endpoint.ejected_until = time.monotonic() + ejection
+                endpoint.ejections += 1
+                endpoint.total_ejections += 1
+                endpoint.consecutive_failures = 0
+                print(f'LLM endpoint {endpoint.name} ejected for {ejection:.0f}s after repeated {error_class} errors')
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            return [
+                {
+                    'name': endpoint.name,
+                    'requests': endpoint.requests,
+                    'failures': endpoint.failures,
+                    'ejections': endpoint.total_ejections,
+                    'healthy': endpoint.is_healthy(now),
+                }
+                for endpoint in self.endpoints
+            ]
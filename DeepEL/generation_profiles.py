@@ -0,0 +1,59 @@
+"""
+Generation profiles: the shape of the answer each LLM stage expects (max_tokens, stop sequences, temperature).
+
+Stages pick a profile by name (``openai_chatgpt(prompt, profile='choice')``) instead of letting every reply run
+to the default length. The profiles can be changed or extended from a JSON file with the same layout as
+GENERATION_PROFILES, see load_generation_profiles.
+"""
+import json
+
+# generation length of the completion API when a profile does not set max_tokens (the API default of 16 is
+# too short)
+DEFAULT_COMPLETION_MAX_TOKENS = 100
+
+GENERATION_PROFILES = {
+    # free text, e.g. the description of a mention by Chat_change
+    'describe': {},
+    # a description capped to what the retrieval reads, Chat_change --description_characters sets its max_tokens
+    'short_describe': {'stop': ['\n\n']},
+    # the index of a candidate entity (Make_initial_choice, Reselect)
+    'choice': {'max_tokens': 16, 'temperature': 0},
+    # a single answer token whose top logprobs are scored, see choice_scoring
+    'single_token': {'max_tokens': 1, 'temperature': 0},
+    # Yes / No and a short reason (Self_validation)
+    'verdict': {'max_tokens': 96, 'temperature': 0},
+    # JSON answers of structured_output: {"answer", "confidence"} and {"verdict", "confidence", "reason"}
+    'structured_choice': {'max_tokens': 32, 'temperature': 0},
+    'structured_verdict': {'max_tokens': 128, 'temperature': 0},
+}
+
+PROFILE_PARAMS = ('max_tokens', 'stop', 'temperature')
+
+
+def generation_params(profile):
+    """
+    Request parameters of a profile name, {} for None; a dict is taken as the parameters of an unnamed profile.
+    """
+    if profile is None:
+        return {}
+    if isinstance(profile, dict):
+        return {param: value for param, value in profile.items() if param in PROFILE_PARAMS and value is not None}
+    if profile not in GENERATION_PROFILES:
+        raise ValueError(f'unknown generation profile {profile!r}, expected one of {sorted(GENERATION_PROFILES)}')
+    return {
+        param: value for param, value in GENERATION_PROFILES[profile].items()
+        if param in PROFILE_PARAMS and value is not None
+    }
+
+
+def load_generation_profiles(file):
+    """
+    Update GENERATION_PROFILES from a JSON file, e.g. {"choice": {"max_tokens": 4, "stop": ["\\n"]}}.
+    """
+    with open(file) as reader:
+        profiles = json.load(reader)
+    for name, params in profiles.items():
+        unknown = set(params) - set(PROFILE_PARAMS)
+        if unknown:
+            raise ValueError(f'unknown parameters {sorted(unknown)} in generation profile {name!r}')
+        GENERATION_PROFILES.setdefault(name, {}).update(params)
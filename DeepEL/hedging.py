@@ -0,0 +1,102 @@
+"""
+Hedged LLM requests.
+
+A request that has not returned after a high percentile of the recently observed latencies is sent a second time,
+and whichever copy answers first wins. Only the network attempt is hedged, once the rate and concurrency limiters
+have let it through, so waiting on them or on a retry backoff never triggers a hedge. Hedges are capped to a fraction of all calls so a slow upstream does not
+double the load; the losing copy is not cancelled (the blocking client cannot be interrupted) but its answer is
+simply dropped.
+"""
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class Hedging:
+    """
+    Latency tracker and hedged execution of blocking calls.
+    """
+
+    def __init__(self, percentile=95.0, max_hedge_rate=0.05, min_samples=20, window=1000, max_workers=64):
+        """
+        :param percentile: a call is hedged once it has been running longer than this percentile of the latencies
+        :param max_hedge_rate: maximum fraction of calls that get a hedge
+        :param min_samples: no hedging before this many latencies have been observed
+        :param window: number of most recent latencies the percentile is computed on
+        :param max_workers: threads running the calls and their hedges
+        """
+        self.percentile = percentile
+        self.max_hedge_rate = max_hedge_rate
+        self.min_samples = min_samples
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='hedging')
+
+    def threshold(self):
+        """
+        Seconds after which a call is hedged, None while too few latencies have been observed.
+        """
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))]
+
+    def _timed(self, function):
+        started = time.monotonic()
+        result = function()
+        with self._lock:
+            self._latencies.append(time.monotonic() - started)
+        return result
+
+    def _take_hedge(self):
+        with self._lock:
+            if self.hedges + 1 > self.max_hedge_rate * self.calls:
+                return False
+            self.hedges += 1
+            return True
+
+    def call(self, function):
+        """
+        Return ``function()``, sending it a second time if the first call is slower than the threshold.
+        """
+        threshold = self.threshold()
+        with self._lock:
+            self.calls += 1
+        if threshold is None:
+            return self._timed(function)
+
+        primary = self._executor.submit(self._timed, function)
+        done, _ = wait([primary], timeout=threshold)
+        if done or not self._take_hedge():
+            return primary.result()
+
+        hedge = self._executor.submit(self._timed, function)
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        with self._lock:
+                            self.hedge_wins += 1
+                    return future.result()
+        # both copies failed
+        return primary.result()
+
+    def stats(self):
+        threshold = self.threshold()
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'hedges': self.hedges,
+                'hedge_wins': self.hedge_wins,
+                'threshold': threshold,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,54 @@
+"""
+Shared, pooled keep-alive HTTP session for the legacy (0.28) OpenAI client.
+
+By default the client builds one requests.Session per thread and closes it every few minutes, so the batch
+client's worker threads keep reopening connections and redoing TLS handshakes to ``api_base``. Installing one
+PooledSession makes every call of the process reuse the same connection pool.
+"""
+import openai
+import requests
+from requests.adapters import HTTPAdapter
+from openai.api_requestor import _requests_proxies_arg
+
+DEFAULT_POOL_SIZE = 64
+
+
+class PooledSession(requests.Session):
+    """
+    requests.Session with a large connection pool and a separate connect timeout.
+
+    :param pool_size: maximum number of keep-alive connections per host
+    :param connect_timeout: timeout of establishing a connection, in seconds; the read timeout stays the
+        ``request_timeout`` of each call
+    :param num_hosts: number of hosts (API endpoints) whose connection pools are kept at the same time
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, connect_timeout=10.0, num_hosts=4):
+        super().__init__()
+        self.connect_timeout = connect_timeout
+        # the client's default session applies openai.proxy, keep honouring it
+        self.proxies = _requests_proxies_arg(openai.proxy) or {}
+        adapter = HTTPAdapter(pool_connections=num_hosts, pool_maxsize=pool_size, pool_block=True)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        timeout = kwargs.get('timeout')
+        if self.connect_timeout and timeout is not None and not isinstance(timeout, tuple):
+            kwargs['timeout'] = (self.connect_timeout, timeout)
+        return super().request(method, url, **kwargs)
+
+    def close(self):
+        # the legacy client closes its thread's session every MAX_SESSION_LIFETIME_SECS; keep the shared pool
+        pass
+
+    def shutdown(self):
+        super().close()
+
+
+def install_session(session):
+    """
+    Make the OpenAI client send every request through ``session``; pass None to restore its default.
+    """
+    openai.requestssession = session
+    return session
@@ -0,0 +1,132 @@
+"""
+Persistent, content-addressed cache of LLM responses.
+
+Responses are stored in a SQLite file keyed by a hash of the endpoint kind, the model, the prompt and the
+generation parameters, so re-running a stage (or running a dataset split that shares prompts with another one)
+does not pay for the same request twice. The file is size-capped and evicts the least recently used entries.
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+# request parameters that change how a request is sent, not what is generated
+TRANSPORT_PARAMS = {
+    'api_key', 'api_base', 'api_type', 'api_version', 'organization', 'request_timeout', 'timeout', 'prompt_cache_key',
+}
+
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'DeepEL', 'llm_cache.sqlite')
+
+
+def request_key(kind, request):
+    """
+    Hash an LLM request into a cache key.
+
+    :param kind: endpoint kind, e.g. 'ChatCompletion' or 'Completion'
+    :param request: keyword arguments of the create call (model, messages / prompt, generation parameters)
+    :return: hex digest
+    """
+    payload = {key: value for key, value in request.items() if key not in TRANSPORT_PARAMS}
+    payload['kind'] = kind
+    serialized = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+class LLMCache:
+    """
+    SQLite-backed LRU cache of LLM responses.
+
+    :param path: SQLite file, created if it does not exist
+    :param max_size_mb: size cap of the stored responses; least recently used entries are evicted beyond it
+    :param bypass: skip lookups (every request goes to the LLM) but still store the fresh responses
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_FILE, max_size_mb=1024, bypass=False):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)'
+        )
+        self._connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self._size = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def get(self, key):
+        """
+        Return the cached response of ``key``, or None on a miss (always None when bypassed).
+        """
+        if self.bypass:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            row = self._connection.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._connection.execute('UPDATE responses SET accessed = ? WHERE key = ?', (time.time(), key))
+        return json.loads(row[0])
+
+    def contains(self, key):
+        """
+        Whether ``key`` is cached, without touching the counters or the LRU order.
+        """
+        with self._lock:
+            row = self._connection.execute('SELECT 1 FROM responses WHERE key = ?', (key,)).fetchone()
+        return row is not None
+
+    def put(self, key, response):
+        serialized = json.dumps(response, ensure_ascii=False)
+        size = len(serialized.encode('utf-8'))
+        with self._lock:
+            row = self._connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self._size -= row[0]
+            self._connection.execute(
+                'INSERT OR REPLACE INTO responses (key, response, size, accessed) VALUES (?, ?, ?, ?)',
+                (key, serialized, size, time.time()),
+            )
+            self._size += size
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        # drop least recently used entries until the cache is back under 90% of its cap
+        target = int(self.max_size * 0.9)
+        rows = self._connection.execute('SELECT key, size FROM responses ORDER BY accessed ASC').fetchall()
+        evicted = []
+        for key, size in rows:
+            if self._size <= target:
+                break
+            evicted.append((key,))
+            self._size -= size
+        self._connection.executemany('DELETE FROM responses WHERE key = ?', evicted)
+        self.evictions += len(evicted)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'size_mb': self._size / (1024 * 1024),
+            }
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
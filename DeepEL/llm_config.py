@@ -0,0 +1,565 @@
+"""
+Command line options shared by the LLM stages (Chat_change, Make_initial_choice, Self_validation, Reselect).
+"""
+import os
+import sys
+import json
+import openai
+from DeepEL.openai_async import DEFAULT_MAX_IN_FLIGHT, SCHEDULES, set_schedule, set_packing
+from DeepEL.prompt_packing import packing_stats
+from DeepEL.openai_function import (
+    set_llm_cache,
+    get_llm_cache,
+    set_rate_limiter,
+    set_retry_policy,
+    get_retry_policy,
+    set_single_flight,
+    get_single_flight,
+    set_endpoint_pool,
+    get_endpoint_pool,
+    set_concurrency_limiter,
+    get_concurrency_limiter,
+    set_hedging,
+    get_hedging,
+    set_llm_backend,
+    get_llm_backend,
+    set_cassette,
+    get_cassette,
+    set_telemetry,
+    get_telemetry,
+)
+from DeepEL.llm_cache import LLMCache, DEFAULT_CACHE_FILE
+from DeepEL.rate_limiter import RateLimiter
+from DeepEL.retry_policy import RetryPolicy
+from DeepEL.http_session import PooledSession, install_session
+from DeepEL.batch_api import BatchClient, prefill_cache_with_batch_api
+from DeepEL.single_flight import SingleFlight
+from DeepEL.endpoint_pool import EndpointPool
+from DeepEL.adaptive_concurrency import AdaptiveConcurrencyLimiter
+from DeepEL.hedging import Hedging
+from DeepEL.generation_profiles import load_generation_profiles
+from DeepEL.local_backend import ENGINES, make_local_backend
+from DeepEL.cassette import Cassette, RECORD, REPLAY
+from DeepEL.telemetry import Telemetry
+from DeepEL.prompt_layout import set_prompt_cache_keys
+from DeepEL.structured_output import set_structured_output, structured_stats
+from DeepEL.cascade import Cascade, set_cascade, get_cascade
+from DeepEL.token_budget import TOKENIZERS, PromptBudget, make_tokenizer, set_prompt_budget, get_prompt_budget
+
+
+def add_llm_arguments(parser):
+    """
+    Add the LLM client options to the argument parser of a stage script.
+    """
+    parser.add_argument(
+        "--llm_api_base",
+        help="OpenAI-compatible endpoint of this run instead of the one set by the stage, "
+             "e.g. the mock server of DeepEL/mock_llm_server.py",
+        default='',
+        type=str,
+    )
+    parser.add_argument(
+        "--llm_backend",
+        help="answer the prompts with the OpenAI API or with a local model (llama_cpp: GGUF file, "
+             "transformers: Hugging Face model), see --local_model",
+        default='openai',
+        choices=['openai'] + sorted(ENGINES),
+        type=str,
+    )
+    parser.add_argument(
+        "--local_model",
+        help="model of the local backend: path of a quantized GGUF file for llama_cpp, model name or directory "
+             "for transformers",
+        default='',
+        type=str,
+    )
+    parser.add_argument(
+        "--local_batch_size",
+        help="maximum number of requests the local backend generates together",
+        default=8,
+        type=int,
+    )
+    parser.add_argument(
+        "--local_threads",
+        help="CPU threads of the local backend, 0 lets the engine decide",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--max_in_flight",
+        help="maximum number of LLM requests outstanding at the same time",
+        default=DEFAULT_MAX_IN_FLIGHT,
+        type=int,
+    )
+    parser.add_argument(
+        "--schedule",
+        help="order of the documents sent to the LLM: document_order, or longest_first to start the documents "
+             "with the most prompt tokens first and fill the free slots with the small ones",
+        default='document_order',
+        choices=SCHEDULES,
+        type=str,
+    )
+    parser.add_argument(
+        "--pack_tokens",
+        help="send the free-text chat prompts several at a time, as the numbered questions of one request of at "
+             "most this many prompt tokens, e.g. for the one-sentence documents of KORE50, OKE or RSS-500; "
+             "structured, logprobs, completion and cascaded prompts are still sent on their own, with a warning; "
+             "0 sends every prompt on its own",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--adaptive_concurrency",
+        help="adapt the number of requests in flight between 1 and --max_in_flight: raise it while requests "
+             "succeed quickly, halve it on rate limits and timeouts",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--initial_in_flight",
+        help="requests in flight at start with --adaptive_concurrency",
+        default=8,
+        type=int,
+    )
+    parser.add_argument(
+        "--prompt_token_budget",
+        help="maximum tokens of a prompt; context, explanations and entity descriptions are trimmed longest-first "
+             "to fit, 0 means unlimited",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--tokenizer",
+        help="tokenizer counting the prompt tokens: tiktoken (exact, needs the tiktoken package), chars (4 "
+             "characters per token) or auto (tiktoken when installed and its encoding is cached, so that counting "
+             "never downloads it)",
+        default='auto',
+        choices=['auto'] + sorted(TOKENIZERS),
+        type=str,
+    )
+    parser.add_argument(
+        "--prefix_first_layout",
+        help="put the content shared by many prompts (instructions, document, candidates) first, in its own "
+             "system message, and the per-mention content last, so cached prompt prefixes are reused (hosted APIs "
+             "only cache prefixes of 1024 tokens or more, which only the document prefix of Self_validation can reach)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--prompt_cache_key",
+        help="with --prefix_first_layout, tag every request with a prompt_cache_key derived from its prefix "
+             "(only for endpoints accepting this parameter)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--structured_output",
+        help="ask for JSON answers following the schema of the stage (choice index, verdict, confidence) instead "
+             "of parsing free text: json_schema sends the schema, json_object only asks for JSON",
+        default='off',
+        choices=['off', 'json_schema', 'json_object'],
+        type=str,
+    )
+    parser.add_argument(
+        "--max_reasks",
+        help="with --structured_output, how many times a malformed answer is asked again",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--cascade_model",
+        help="fast model asked first; its answer is escalated to the model of the stage only when it is malformed, "
+             "not confident enough or unsure, e.g. gpt-4o-mini",
+        default='',
+        type=str,
+    )
+    parser.add_argument(
+        "--cascade_min_confidence",
+        help="with --cascade_model and --structured_output, escalate answers less confident than this",
+        default=0.7,
+        type=float,
+    )
+    parser.add_argument(
+        "--cascade_min_margin",
+        help="with --cascade_model and --selection_mode logprobs, escalate choices whose probability exceeds the "
+             "second best by less than this",
+        default=0.2,
+        type=float,
+    )
+    parser.add_argument(
+        "--escalate_on_disagreement",
+        help="with --cascade_model, also escalate the choices that are not the BLINK top-1 candidate",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--generation_profiles",
+        help="JSON file overriding the generation profiles (max_tokens, stop, temperature) the stages pick, "
+             "e.g. {\"choice\": {\"max_tokens\": 4}}",
+        default='',
+        type=str,
+    )
+    parser.add_argument(
+        "--model_prices",
+        help="JSON file of USD prices per 1K prompt and completion tokens, e.g. {\"gpt-4\": [0.03, 0.06]}, "
+             "overriding the built-in ones of the cost estimate",
+        default='',
+        type=str,
+    )
+    parser.add_argument(
+        "--record_cassette",
+        help="SQLite file recording every LLM request of the run with its response and latency",
+        default='',
+        type=str,
+    )
+    parser.add_argument(
+        "--replay_cassette",
+        help="answer every LLM request from a recorded cassette instead of the network; "
+             "a request missing from it is an error",
+        default='',
+        type=str,
+    )
+    parser.add_argument(
+        "--replay_latency",
+        help="with --replay_cassette, wait the recorded latency before each answer instead of answering at once",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--llm_cache",
+        help="SQLite file caching LLM responses across runs, pass an empty string to disable the cache",
+        default=DEFAULT_CACHE_FILE,
+        type=str,
+    )
+    parser.add_argument(
+        "--llm_cache_max_mb",
+        help="size cap of the LLM response cache, least recently used responses are evicted beyond it",
+        default=1024,
+        type=float,
+    )
+    parser.add_argument(
+        "--llm_cache_bypass",
+        help="do not read cached responses, but still store the fresh ones",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--no_request_coalescing",
+        help="send identical concurrent LLM requests separately instead of sharing one outstanding request",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--rate_limits",
+        help="JSON file of per-model budgets, e.g. {\"gpt-4\": {\"rpm\": 500, \"tpm\": 30000}, \"*\": {...}}",
+        default='',
+        type=str,
+    )
+    parser.add_argument(
+        "--requests_per_minute",
+        help="requests-per-minute budget used when --rate_limits has no \"*\" entry, 0 means unlimited",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--tokens_per_minute",
+        help="tokens-per-minute budget used when --rate_limits has no \"*\" entry, 0 means unlimited",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--endpoints",
+        help="JSON file of LLM endpoints (api_base, api_key, weight, rate_limits) to balance requests over, "
+             "with failover; by default every request goes to openai.api_base",
+        default='',
+        type=str,
+    )
+    parser.add_argument(
+        "--hedge_percentile",
+        help="send a duplicate of a request still running after this percentile of the observed latencies and "
+             "keep the first answer, 0 disables hedging",
+        default=0,
+        type=float,
+    )
+    parser.add_argument(
+        "--max_hedge_rate",
+        help="maximum fraction of requests that get a duplicate with --hedge_percentile",
+        default=0.05,
+        type=float,
+    )
+    parser.add_argument(
+        "--max_retries",
+        help="maximum number of retries of a failed LLM call (rate limits, server errors, timeouts)",
+        default=6,
+        type=int,
+    )
+    parser.add_argument(
+        "--retry_deadline",
+        help="total time budget of one LLM call including retries, in seconds, 0 means no deadline",
+        default=300,
+        type=float,
+    )
+    parser.add_argument(
+        "--request_timeout",
+        help="timeout of a single LLM request, in seconds",
+        default=60,
+        type=float,
+    )
+    parser.add_argument(
+        "--http_pool_size",
+        help="keep-alive connections shared by all LLM calls of the process, 0 means --max_in_flight (twice "
+             "that with --hedge_percentile, for the hedges and the losing copies still in flight)",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--connect_timeout",
+        help="timeout of opening a connection to the LLM API, in seconds",
+        default=10,
+        type=float,
+    )
+    parser.add_argument(
+        "--batch_api",
+        help="answer the prompts of the stage offline through the Batch API before the real-time pass",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--batch_api_base",
+        help="Batch API base URL, defaults to openai.api_base (e.g. a local stand-in for testing)",
+        default='',
+        type=str,
+    )
+    parser.add_argument(
+        "--batch_dir",
+        help="directory of the batch input files and their batch ids, defaults to <output_dir>/batch_api",
+        default='',
+        type=str,
+    )
+    parser.add_argument(
+        "--batch_poll_interval",
+        help="seconds between two status checks of a submitted batch",
+        default=60,
+        type=float,
+    )
+    return parser
+
+
+def configure_llm(args):
+    """
+    Set up the LLM client of this process from the parsed options of add_llm_arguments.
+    """
+    if args.llm_api_base:
+        openai.api_base = args.llm_api_base
+    if args.llm_backend == 'openai':
+        set_llm_backend(None)
+    else:
+        if not args.local_model:
+            raise ValueError(f'--llm_backend {args.llm_backend} needs --local_model')
+        set_llm_backend(make_local_backend(
+            args.llm_backend,
+            args.local_model,
+            max_batch_size=args.local_batch_size,
+            num_threads=args.local_threads or None,
+        ))
+    if args.record_cassette and args.replay_cassette:
+        raise ValueError('--record_cassette and --replay_cassette cannot be used together')
+    if args.replay_cassette:
+        set_cassette(Cassette(args.replay_cassette, mode=REPLAY, replay_latency=args.replay_latency))
+    elif args.record_cassette:
+        set_cassette(Cassette(args.record_cassette, mode=RECORD))
+    else:
+        set_cassette(None)
+    prices = dict()
+    if args.model_prices:
+        with open(args.model_prices) as reader:
+            prices = {model: tuple(price) for model, price in json.load(reader).items()}
+    set_telemetry(Telemetry(stage=os.path.splitext(os.path.basename(sys.argv[0]))[0], prices=prices))
+    set_prompt_cache_keys(args.prefix_first_layout and args.prompt_cache_key)
+    set_cascade(
+        Cascade(
+            args.cascade_model,
+            min_confidence=args.cascade_min_confidence,
+            min_margin=args.cascade_min_margin,
+            escalate_on_disagreement=args.escalate_on_disagreement,
+        ) if args.cascade_model else None
+    )
+    if args.structured_output != 'off':
+        set_structured_output(args.structured_output, max_reasks=args.max_reasks)
+    set_prompt_budget(PromptBudget(args.prompt_token_budget, make_tokenizer(args.tokenizer)))
+    set_schedule(args.schedule)
+    if args.pack_tokens and args.batch_api:
+        raise ValueError('--pack_tokens cannot be combined with --batch_api, which answers the prompts one by one')
+    set_packing(args.pack_tokens)
+    if args.generation_profiles:
+        load_generation_profiles(args.generation_profiles)
+    if args.llm_cache:
+        set_llm_cache(LLMCache(args.llm_cache, max_size_mb=args.llm_cache_max_mb, bypass=args.llm_cache_bypass))
+    else:
+        set_llm_cache(None)
+    set_single_flight(None if args.no_request_coalescing else SingleFlight())
+    set_concurrency_limiter(
+        AdaptiveConcurrencyLimiter(initial_limit=args.initial_in_flight, max_limit=args.max_in_flight)
+        if args.adaptive_concurrency else None
+    )
+
+    if args.rate_limits:
+        rate_limiter = RateLimiter.from_file(args.rate_limits)
+    else:
+        rate_limiter = RateLimiter({})
+    if args.requests_per_minute or args.tokens_per_minute:
+        rate_limiter.limits.setdefault('*', {'rpm': args.requests_per_minute, 'tpm': args.tokens_per_minute})
+    set_rate_limiter(rate_limiter if rate_limiter.limits else None)
+
+    set_retry_policy(RetryPolicy(
+        max_retries=args.max_retries,
+        deadline=args.retry_deadline,
+        request_timeout=args.request_timeout,
+    ))
+
+    set_hedging(
+        Hedging(percentile=args.hedge_percentile, max_hedge_rate=args.max_hedge_rate, max_workers=2 * args.max_in_flight)
+        if args.hedge_percentile else None
+    )
+
+    endpoint_pool = EndpointPool.from_file(args.endpoints) if args.endpoints else None
+    set_endpoint_pool(endpoint_pool)
+
+    # with hedging, a request and its hedge hold a connection each
+    max_requests = 2 * args.max_in_flight if args.hedge_percentile else args.max_in_flight
+    install_session(PooledSession(
+        pool_size=args.http_pool_size or max_requests,
+        connect_timeout=args.connect_timeout,
+        num_hosts=len(endpoint_pool.endpoints) + 1 if endpoint_pool is not None else 4,
+    ))
+
+
+def run_offline_batch(args, function, doc_name2prompts, **kwargs):
+    """
+    With --batch_api, answer all prompts of the stage through the Batch API and store them in the LLM cache,
+    so the real-time pass that follows only reads them back. Does nothing otherwise.
+
+    :param function: openai_chatgpt or openai_completion, as used by the stage
+    :param doc_name2prompts: dict, doc_name -> list of prompts of that document
+    :param kwargs: keyword arguments the stage passes to ``function`` (model, role, ...)
+    """
+    if not args.batch_api:
+        return
+    cascade = get_cascade()
+    if cascade is not None:
+        # the fast model answers every prompt first, the escalations are sent in real time
+        kwargs['model'] = cascade.fast_model
+    prompts = [prompt for doc_prompts in doc_name2prompts.values() for prompt in doc_prompts]
+    prefill_cache_with_batch_api(
+        function,
+        prompts,
+        batch_dir=args.batch_dir or os.path.join(args.output_dir, 'batch_api'),
+        client=BatchClient(api_base=args.batch_api_base or None),
+        poll_interval=args.batch_poll_interval,
+        **kwargs,
+    )
+
+
+def report_llm(output_file=None):
+    """
+    Print the counters of the LLM client at the end of a stage, and write the telemetry summary of the stage
+    next to its ``output_file`` (<output_file without extension>.llm_summary.json).
+    """
+    telemetry = get_telemetry()
+    cascade = get_cascade()
+    if telemetry is not None:
+        if output_file:
+            summary = telemetry.write_summary(
+                os.path.splitext(output_file)[0] + '.llm_summary.json',
+                extra={'cascade': cascade.stats()} if cascade is not None else None,
+            )
+        else:
+            summary = telemetry.summary()
+        for model, stats in summary['models'].items():
+            latency = stats['latency']
+            cost = stats['estimated_cost_usd']
+            print(
+                f"LLM calls to {model}: {stats['calls']} calls, {stats['network_calls']} sent, "
+                f"latency p50 {latency['p50']:.2f}s p95 {latency['p95']:.2f}s p99 {latency['p99']:.2f}s, "
+                f"{stats['prompt_tokens']} prompt + {stats['completion_tokens']} completion tokens"
+                + (f", ~${cost:.4f}" if cost is not None else '')
+            )
+        print(
+            f"LLM throughput: {summary['calls_per_second']:.2f} calls/s, {summary['tokens_per_second']:.1f} tokens/s"
+        )
+    stats = get_prompt_budget().stats()
+    if stats['prompts']:
+        print(
+            f"LLM prompts: {stats['prompts']} prompts, {stats['tokens']} tokens ({stats['tokenizer']}), "
+            f"{stats['mean_tokens']:.0f} per mention on average, {stats['max_tokens']} at most"
+            + (
+                f", {stats['trimmed']} trimmed to the {stats['budget']}-token budget, {stats['over_budget']} still over it"
+                if stats['budget'] else ''
+            )
+        )
+    if cascade is not None:
+        stats = cascade.stats()
+        reasons = ', '.join(f'{reason}: {count}' for reason, count in sorted(stats['reasons'].items()))
+        print(
+            f"LLM cascade: {stats['calls']} calls asked {stats['fast_model']} first, {stats['escalations']} escalated "
+            f"({stats['escalation_rate'] * 100:.1f}%)" + (f" ({reasons})" if reasons else '')
+        )
+    stats = packing_stats()
+    if stats['packs']:
+        print(
+            f"LLM packing: {stats['prompts']} prompts in {stats['packs']} packed requests "
+            f"({stats['prompts'] / stats['packs']:.1f} per request), {stats['asked_alone']} asked on their own"
+        )
+    stats = structured_stats()
+    if stats['replies']:
+        print(
+            f"LLM structured answers: {stats['replies']} replies, {stats['malformed']} malformed, "
+            f"{stats['reasks']} asked again, {stats['failed']} given up"
+        )
+    cassette = get_cassette()
+    if cassette is not None:
+        stats = cassette.stats()
+        if stats['mode'] == REPLAY:
+            print(f"LLM cassette: {stats['replayed']} requests replayed, {stats['missing']} missing from {cassette.path}")
+        else:
+            print(f"LLM cassette: {stats['recorded']} requests recorded to {cassette.path} ({stats['size']} in total)")
+    backend = get_llm_backend()
+    if backend is not None:
+        stats = backend.stats()
+        print(
+            f"LLM backend {backend.name}: {stats['requests']} requests in {stats['batches']} batches "
+            f"(mean batch size {stats['mean_batch_size']:.1f})"
+        )
+    cache = get_llm_cache()
+    if cache is not None:
+        stats = cache.stats()
+        print(
+            f"LLM cache: {stats['hits']} hits, {stats['misses']} misses "
+            f"(hit rate {stats['hit_rate'] * 100:.2f}%), {stats['evictions']} evictions, "
+            f"{stats['size_mb']:.1f} MB"
+        )
+    single_flight = get_single_flight()
+    if single_flight is not None:
+        stats = single_flight.stats()
+        print(f"LLM coalescing: {stats['coalesced']} calls shared an identical in-flight request")
+    concurrency_limiter = get_concurrency_limiter()
+    if concurrency_limiter is not None:
+        stats = concurrency_limiter.stats()
+        print(
+            f"LLM concurrency: limit {stats['limit']} (between {stats['lowest_limit']} and {stats['highest_limit']}), "
+            f"{stats['increases']} increases, {stats['decreases']} decreases"
+        )
+    hedging = get_hedging()
+    if hedging is not None:
+        stats = hedging.stats()
+        print(
+            f"LLM hedging: {stats['hedges']} of {stats['calls']} calls hedged, "
+            f"{stats['hedge_wins']} answered first by the hedge"
+        )
+    endpoint_pool = get_endpoint_pool()
+    if endpoint_pool is not None:
+        for stats in endpoint_pool.stats():
+            print(
+                f"LLM endpoint {stats['name']}: {stats['requests']} requests, {stats['failures']} failures, "
+                f"{stats['ejections']} ejections, {'healthy' if stats['healthy'] else 'ejected'}"
+            )
+    retry_policy = get_retry_policy()
+    if retry_policy is not None:
+        stats = retry_policy.stats()
+        errors = ', '.join(f'{error_class}: {count}' for error_class, count in sorted(stats['errors'].items()))
+        print(
+            f"LLM retries: {stats['retries']} retries over {stats['calls']} calls, "
+            f"{stats['failures']} failed calls" + (f" ({errors})" if errors else '')
+        )
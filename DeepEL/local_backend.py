@@ -0,0 +1,224 @@
+"""
+Local LLM backend: answers the requests of openai_function with a model running on this machine instead of the
+OpenAI API.
+
+Concurrent requests are queued and handed to the engine in batches: while the engine works on one batch, new
+requests queue up and form the next one, so the batch size follows the load (up to ``max_batch_size``).
+Requests of a batch are ordered by prompt so that requests sharing a prefix (same document, same instructions)
+run back to back and the engine can reuse the key/value state of the shared prefix.
+
+Two engines are provided, each an optional dependency:
+
+* LlamaCppEngine: a quantized GGUF model through llama-cpp-python (``pip install llama-cpp-python``), with a
+  RAM prefix cache;
+* TransformersEngine: a Hugging Face causal LM (``pip install transformers torch``), dynamically quantized to
+  int8 on CPU and run with padded batched generation.
+"""
+import time
+import queue
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+import openai
+
+CHAT = 'ChatCompletion'
+COMPLETION = 'Completion'
+
+
+def _openai_response(kind, model, text, prompt_tokens, completion_tokens, finish_reason):
+    """
+    Response of a local generation in the layout of the OpenAI API.
+    """
+    if kind == CHAT:
+        choice = {'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': finish_reason}
+    else:
+        choice = {'index': 0, 'text': text, 'finish_reason': finish_reason}
+    return {
+        'object': 'chat.completion' if kind == CHAT else 'text_completion',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [choice],
+        'usage': {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+        },
+    }
+
+
+def _truncate_at_stop(text, stop):
+    if not stop:
+        return text, False
+    if isinstance(stop, str):
+        stop = [stop]
+    positions = [text.find(sequence) for sequence in stop if sequence and sequence in text]
+    if not positions:
+        return text, False
+    return text[:min(positions)], True
+
+
+class LlamaCppEngine:
+    """
+    Quantized GGUF model run by llama.cpp; the prefix cache keeps the key/value state of recent prompts, so a
+    prompt sharing its beginning with a previous one only evaluates the new tokens.
+    """
+
+    def __init__(self, model_path, n_ctx=4096, num_threads=None, cache_mb=2048):
+        try:
+            from llama_cpp import Llama, LlamaRAMCache
+        except ImportError as error:
+            raise ImportError('the llama_cpp backend needs llama-cpp-python: pip install llama-cpp-python') from error
+        self.name = model_path
+        self.llm = Llama(model_path=model_path, n_ctx=n_ctx, n_threads=num_threads, verbose=False)
+        if cache_mb:
+            self.llm.set_cache(LlamaRAMCache(capacity_bytes=int(cache_mb * 1024 * 1024)))
+
+    def generate(self, kind, requests):
+        responses = []
+        for request in requests:
+            params = dict(
+                max_tokens=request.get('max_tokens') or 512,
+                temperature=request.get('temperature', 1.0),
+                stop=request.get('stop'),
+            )
+            if kind == CHAT:
+                output = self.llm.create_chat_completion(messages=request['messages'], **params)
+            else:
+                output = self.llm.create_completion(prompt=request['prompt'], **params)
+            output['model'] = self.name
+            responses.append(output)
+        return responses
+
+
+class TransformersEngine:
+    """
+    Hugging Face causal LM on CPU with int8 dynamic quantization of its linear layers; a batch is generated in
+    one padded ``generate`` call.
+    """
+
+    def __init__(self, model_name, quantize=True, num_threads=None):
+        try:
+            import torch
+            from transformers import AutoModelForCausalLM, AutoTokenizer
+        except ImportError as error:
+            raise ImportError('the transformers backend needs transformers and torch: pip install transformers torch') from error
+        self.torch = torch
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.name = model_name
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, padding_side='left')
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        model = AutoModelForCausalLM.from_pretrained(model_name)
+        if quantize:
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model = model.eval()
+
+    def _prompt(self, kind, request):
+        if kind == COMPLETION:
+            return request['prompt']
+        if getattr(self.tokenizer, 'chat_template', None):
+            return self.tokenizer.apply_chat_template(request['messages'], tokenize=False, add_generation_prompt=True)
+        return '\n'.join(f"{message['role']}: {message['content']}" for message in request['messages']) + '\nassistant:'
+
+    def generate(self, kind, requests):
+        # requests of a batch share their generation parameters, see LocalBackend
+        max_tokens = requests[0].get('max_tokens') or 512
+        temperature = requests[0].get('temperature', 1.0)
+        inputs = self.tokenizer([self._prompt(kind, request) for request in requests], return_tensors='pt', padding=True)
+        with self.torch.no_grad():
+            outputs = self.model.generate(
+                **inputs,
+                max_new_tokens=max_tokens,
+                do_sample=temperature > 0,
+                temperature=temperature if temperature > 0 else None,
+                pad_token_id=self.tokenizer.pad_token_id,
+            )
+        num_input_tokens = inputs['input_ids'].shape[1]
+        responses = []
+        for request, input_mask, output in zip(requests, inputs['attention_mask'], outputs):
+            generated = output[num_input_tokens:]
+            completion_tokens = int((generated != self.tokenizer.pad_token_id).sum())
+            text, stopped = _truncate_at_stop(self.tokenizer.decode(generated, skip_special_tokens=True), request.get('stop'))
+            finish_reason = 'stop' if stopped or completion_tokens < max_tokens else 'length'
+            responses.append(_openai_response(kind, self.name, text, int(input_mask.sum()), completion_tokens, finish_reason))
+        return responses
+
+
+class LocalBackend:
+    """
+    Queue of requests served in batches by a local engine, with the ``create`` interface openai_function uses.
+    """
+
+    def __init__(self, engine, max_batch_size=8):
+        self.engine = engine
+        self.name = f'local:{engine.name}'
+        self.max_batch_size = max_batch_size
+        self.batches = 0
+        self.requests = 0
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._serve, name='local-llm-backend', daemon=True)
+        self._worker.start()
+
+    def create(self, kind, request, timeout=None):
+        """
+        Answer one request of ``kind`` (ChatCompletion or Completion), blocking until it is generated.
+        """
+        future = Future()
+        self._queue.put((kind, request, future))
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise openai.error.Timeout(f'local generation did not finish within {timeout}s')
+
+    def _next_batch(self):
+        items = [self._queue.get()]
+        while len(items) < self.max_batch_size:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _serve(self):
+        while True:
+            items = [item for item in self._next_batch() if item[2].set_running_or_notify_cancel()]
+            # one engine call per kind and generation parameters, prompts sharing a prefix next to each other
+            groups = dict()
+            for kind, request, future in items:
+                params = (kind, request.get('max_tokens'), request.get('temperature'), repr(request.get('stop')))
+                groups.setdefault(params, []).append((request, future))
+            for (kind, *_), group in groups.items():
+                group.sort(key=lambda item: repr(item[0].get('messages') or item[0].get('prompt')))
+                try:
+                    responses = self.engine.generate(kind, [request for request, _ in group])
+                except Exception as error:
+                    for _, future in group:
+                        future.set_exception(error)
+                    continue
+                self.batches += 1
+                self.requests += len(group)
+                for (_, future), response in zip(group, responses):
+                    future.set_result(response)
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'batches': self.batches,
+            'mean_batch_size': self.requests / self.batches if self.batches else 0.0,
+        }
+
+
+ENGINES = {
+    'llama_cpp': LlamaCppEngine,
+    'transformers': TransformersEngine,
+}
+
+
+def make_local_backend(engine, model, max_batch_size=8, num_threads=None):
+    """
+    LocalBackend running ``model`` (a GGUF file for llama_cpp, a model name or directory for transformers).
+    """
+    if engine not in ENGINES:
+        raise ValueError(f'unknown local engine {engine!r}, expected one of {sorted(ENGINES)}')
+    return LocalBackend(ENGINES[engine](model, num_threads=num_threads), max_batch_size=max_batch_size)
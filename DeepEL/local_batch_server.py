@@ -0,0 +1,245 @@
+"""
+Local stand-in of the Batch API (``/files`` and ``/batches``) for testing the offline batch mode.
+
+Batches are executed in the background by sending each request line to a real-time, OpenAI-compatible upstream
+endpoint, e.g. a local mock server::
+
+    python -m DeepEL.local_batch_server --port 8100 --upstream_api_base http://127.0.0.1:8000/v1
+
+and then run a stage with ``--batch_api --batch_api_base http://127.0.0.1:8100/v1``.
+"""
+import json
+import time
+import uuid
+import argparse
+import threading
+import email.policy
+from email.parser import BytesParser
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+
+
+def forward_responder(upstream_api_base, api_key=''):
+    """
+    Responder executing a batch request line against a real-time endpoint; returns (status code, body).
+    """
+    session = requests.Session()
+    upstream_api_base = upstream_api_base.rstrip('/')
+
+    def respond(line):
+        url = line['url']
+        if url.startswith('/v1/'):
+            url = url[len('/v1'):]
+        response = session.post(
+            upstream_api_base + url,
+            json=line['body'],
+            headers={'Authorization': f'Bearer {api_key}'},
+            timeout=600,
+        )
+        try:
+            body = response.json()
+        except ValueError:
+            body = {'error': {'message': response.text}}
+        return response.status_code, body
+
+    return respond
+
+
+def parse_multipart(content_type, body):
+    """
+    Parse a multipart/form-data body into a dict, field name -> (filename, content bytes).
+    """
+    message = BytesParser(policy=email.policy.HTTP).parsebytes(
+        b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body
+    )
+    fields = dict()
+    for part in message.iter_parts():
+        name = part.get_param('name', header='content-disposition')
+        fields[name] = (part.get_filename(), part.get_payload(decode=True))
+    return fields
+
+
+class BatchStore:
+    """
+    In-memory files and batches of the stand-in server.
+    """
+
+    def __init__(self, responder, workers=8):
+        self.responder = responder
+        self.files = dict()
+        self.batches = dict()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def add_file(self, filename, content, purpose):
+        file_id = 'file-' + uuid.uuid4().hex[:24]
+        with self.lock:
+            self.files[file_id] = {'filename': filename, 'content': content, 'purpose': purpose}
+        return {'id': file_id, 'object': 'file', 'bytes': len(content), 'filename': filename, 'purpose': purpose}
+
+    def create_batch(self, input_file_id, endpoint, completion_window):
+        with self.lock:
+            if input_file_id not in self.files:
+                return None
+            lines = [json.loads(row) for row in self.files[input_file_id]['content'].decode('utf-8').splitlines() if row.strip()]
+            batch = {
+                'id': 'batch_' + uuid.uuid4().hex[:24],
+                'object': 'batch',
+                'endpoint': endpoint,
+                'input_file_id': input_file_id,
+                'completion_window': completion_window,
+                'status': 'in_progress',
+                'created_at': int(time.time()),
+                'output_file_id': None,
+                'error_file_id': None,
+                'request_counts': {'total': len(lines), 'completed': 0, 'failed': 0},
+            }
+            self.batches[batch['id']] = batch
+        threading.Thread(target=self._run, args=(batch, lines), daemon=True).start()
+        return dict(batch)
+
+    def _run_line(self, batch, line):
+        try:
+            status_code, body = self.responder(line)
+        except Exception as error:
+            status_code, body = 500, {'error': {'message': str(error)}}
+        with self.lock:
+            batch['request_counts']['completed' if status_code == 200 else 'failed'] += 1
+        return {
+            'id': 'batch_req_' + uuid.uuid4().hex[:24],
+            'custom_id': line['custom_id'],
+            'response': {'status_code': status_code, 'request_id': uuid.uuid4().hex, 'body': body},
+            'error': None if status_code == 200 else {'code': str(status_code), 'message': json.dumps(body)},
+        }
+
+    def _run(self, batch, lines):
+        results = list(self.executor.map(lambda line: self._run_line(batch, line), lines))
+        # like the Batch API: answered requests go to the output file, failed ones to the error file, and a
+        # file without any line is not created
+        file_ids = dict()
+        for kind, kind_results in (
+            ('output', [result for result in results if result['error'] is None]),
+            ('error', [result for result in results if result['error'] is not None]),
+        ):
+            if kind_results:
+                content = ''.join(json.dumps(result, ensure_ascii=False) + '\n' for result in kind_results)
+                file = self.add_file(f"{batch['id']}_{kind}.jsonl", content.encode('utf-8'), 'batch_output')
+                file_ids[kind] = file['id']
+        with self.lock:
+            batch['output_file_id'] = file_ids.get('output')
+            batch['error_file_id'] = file_ids.get('error')
+            batch['status'] = 'completed'
+            batch['completed_at'] = int(time.time())
+
+
+class BatchHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def store(self):
+        return self.server.batch_store
+
+    def _path(self):
+        path = self.path.split('?')[0].rstrip('/')
+        return path[len('/v1'):] if path.startswith('/v1/') else path
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_POST(self):
+        path = self._path()
+        body = self._read_body()
+        if path == '/files':
+            fields = parse_multipart(self.headers['Content-Type'], body)
+            filename, content = fields['file']
+            purpose = fields.get('purpose', (None, b'batch'))[1].decode('utf-8')
+            self._send_json(200, self.store.add_file(filename, content, purpose))
+        elif path == '/batches':
+            payload = json.loads(body)
+            batch = self.store.create_batch(
+                payload['input_file_id'], payload['endpoint'], payload.get('completion_window', '24h'),
+            )
+            if batch is None:
+                self._send_json(404, {'error': {'message': 'unknown input_file_id'}})
+            else:
+                self._send_json(200, batch)
+        else:
+            self._send_json(404, {'error': {'message': f'unknown path {self.path}'}})
+
+    def do_GET(self):
+        parts = self._path().strip('/').split('/')
+        with self.store.lock:
+            if len(parts) == 2 and parts[0] == 'batches' and parts[1] in self.store.batches:
+                payload = json.loads(json.dumps(self.store.batches[parts[1]]))
+            elif len(parts) == 3 and parts[0] == 'files' and parts[2] == 'content' and parts[1] in self.store.files:
+                content = self.store.files[parts[1]]['content']
+                payload = None
+            else:
+                self._send_json(404, {'error': {'message': f'unknown path {self.path}'}})
+                return
+        if payload is not None:
+            self._send_json(200, payload)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/jsonl')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(host='127.0.0.1', port=8100, responder=None, workers=8):
+    """
+    Build (but do not start) the stand-in server; call serve_forever() on the result.
+    """
+    server = ThreadingHTTPServer((host, port), BatchHandler)
+    server.daemon_threads = True
+    server.batch_store = BatchStore(responder, workers=workers)
+    return server
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='local stand-in of the Batch API, executing batches against a real-time endpoint.',
+        allow_abbrev=False,
+    )
+    parser.add_argument("--host", default='127.0.0.1', type=str)
+    parser.add_argument("--port", default=8100, type=int)
+    parser.add_argument(
+        "--upstream_api_base",
+        help="real-time OpenAI-compatible endpoint executing the batch requests",
+        required=True,
+        type=str,
+    )
+    parser.add_argument("--upstream_api_key", default='', type=str)
+    parser.add_argument(
+        "--workers",
+        help="number of batch requests executed at the same time",
+        default=8,
+        type=int,
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    server = make_server(
+        args.host, args.port, forward_responder(args.upstream_api_base, args.upstream_api_key), workers=args.workers,
+    )
+    print(f'Batch API stand-in listening on http://{args.host}:{server.server_address[1]}/v1')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
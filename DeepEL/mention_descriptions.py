@@ -0,0 +1,119 @@
+"""
+Descriptions of many mentions in one request.
+
+Instead of one "What does X in this sentence referring to?" prompt per mention, with overlapping context windows
+repeated in every prompt, the text is sent once with its mentions marked as ``[mention](#id)`` and the model
+describes all of them in one structured answer (schema ``descriptions`` of structured_output). The answers are
+split back per mention, and only the mentions missing from the answer are asked again.
+
+A block is a text and the mentions to describe in it: ``(text, [(id, start, end), ...])`` with character offsets
+in the text. A request holds the blocks of one document, or of a long document split into sections
+(split_sections), or several short documents packed together.
+
+mention_signature identifies mentions whose description can be shared across the corpus: the same surface form in
+the same context once case, spacing and digits are ignored (e.g. wire-story boilerplate).
+"""
+import re
+from DeepEL.structured_output import schema_instructions
+
+
+def normalize_context(text):
+    """
+    Context with case, runs of whitespace and digits ignored.
+    """
+    return re.sub(r'\d', '0', ' '.join(text.split()).lower())
+
+
+def mention_signature(sentence, start, end, context_characters=150):
+    """
+    Signature of a mention: its surface form and the ``context_characters`` on each side of it, all normalized.
+    """
+    # normalized before being cut, so that extra spaces do not shift the window
+    left_context = normalize_context(sentence[max(0, start - 2 * context_characters): start])
+    right_context = normalize_context(sentence[end: end + 2 * context_characters])
+    return (
+        normalize_context(sentence[start:end]),
+        left_context[max(0, len(left_context) - context_characters):],
+        right_context[:context_characters],
+    )
+
+
+def split_sections(sentence, starts, ends, context_characters=150, max_characters=4000):
+    """
+    Group the mentions of a document into sections whose text, from ``context_characters`` before their first
+    mention to ``context_characters`` after their last one, is at most ``max_characters`` long (a section holds at
+    least one mention). Returns a list of (section_start, section_end, mention indices), mentions in text order.
+    """
+    order = sorted(range(len(starts)), key=lambda index: (starts[index], ends[index]))
+    sections = []
+    for index in order:
+        start = max(0, starts[index] - context_characters)
+        end = min(len(sentence), ends[index] + context_characters)
+        if sections and end - sections[-1][0] <= max_characters:
+            sections[-1][1] = max(sections[-1][1], end)
+            sections[-1][2].append(index)
+        else:
+            sections.append([start, end, [index]])
+    return [(start, end, indices) for start, end, indices in sections]
+
+
+def mark_mentions(text, spans):
+    """
+    Text with every mention written as ``[mention](#id)``; a mention overlapping the previous one is not marked
+    (it is still listed in the question).
+    """
+    parts = []
+    last = 0
+    for item_id, start, end in sorted(spans, key=lambda span: (span[1], span[2])):
+        if start < last:
+            continue
+        parts.append(text[last:start])
+        parts.append(f'[{text[start:end]}](#{item_id})')
+        last = end
+    parts.append(text[last:])
+    return ''.join(parts)
+
+
+def mentions_prompt(blocks, asked=None, max_characters=0):
+    """
+    Prompt asking for the descriptions of the mentions of ``blocks`` whose id is in ``asked`` (all by default),
+    each in at most ``max_characters`` characters if set.
+    """
+    asked = None if asked is None else set(asked)
+    texts = []
+    questions = []
+    for position, (text, spans) in enumerate(blocks):
+        marked = mark_mentions(text, spans)
+        texts.append(f'Text {position + 1}:\n{marked}' if len(blocks) > 1 else marked)
+        questions += [
+            f'#{item_id}: {text[start:end]}' for item_id, start, end in spans if asked is None or item_id in asked
+        ]
+    return (
+        '\n\n'.join(texts)
+        + '\n\nThe mentions are marked as [mention](#id). What does each of the following mentions refer to in '
+        + ('its text' if len(blocks) > 1 else 'this text') + '?\n'
+        + '\n'.join(questions) + '\n'
+        + (f'Describe each mention in one sentence of at most {max_characters} characters.\n' if max_characters else '')
+        + schema_instructions('descriptions')
+    )
+
+
+def describe_mentions(blocks, ask, max_reasks=1, max_characters=0):
+    """
+    Descriptions of the mentions of ``blocks``, as a dict id -> description; the mentions still missing after
+    ``max_reasks`` requests for the missing ones only are left out.
+
+    :param ask: function(prompt) -> (reply, answer), e.g. openai_chatgpt_structured with schema='descriptions'
+    :param max_characters: length asked for each description, see mentions_prompt
+    """
+    ids = [item_id for _, spans in blocks for item_id, _, _ in spans]
+    descriptions = dict()
+    for reask in range(max_reasks + 1):
+        missing = [item_id for item_id in ids if item_id not in descriptions]
+        if not missing:
+            break
+        _, answer = ask(mentions_prompt(blocks, asked=None if reask == 0 else missing, max_characters=max_characters))
+        for item in (answer or {}).get('descriptions', []):
+            if item['id'] in missing and item['description'].strip():
+                descriptions[item['id']] = item['description'].strip()
+    return descriptions
@@ -0,0 +1,274 @@
+"""
+Deterministic mock of the OpenAI API with fault injection, for benchmarking the LLM stages offline.
+
+The server answers ``/v1/chat/completions`` and ``/v1/completions`` from a rule table (first regular expression
+matching the prompt wins) and falls back to answers derived from a hash of the prompt and the seed, so the same
+prompt always gets the same answer. It also serves the Batch API routes of local_batch_server with the same
+answers. Latency, rate limits (429 with Retry-After), server errors and timeouts are injected at configurable
+rates::
+
+    python -m DeepEL.mock_llm_server --port 8000 --latency lognormal:0.8,0.5 --rate_limit_rate 0.05 \\
+        --server_error_rate 0.01 --timeout_rate 0.005
+
+then point a stage at it with ``--llm_api_base http://127.0.0.1:8000/v1``, the option every stage takes from
+llm_config, and with ``--batch_api_base`` for the batch mode. A rule file is a JSON list such as::
+
+    [{"match": "Which of the following entities", "reply": "1"}, {"match": "Answer \\"Yes\\" or \\"No\\"", "reply": "Yes."}]
+"""
+import re
+import json
+import time
+import uuid
+import random
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer
+from DeepEL.local_batch_server import BatchHandler, BatchStore
+
+# answers of the pipeline prompts when no rule file is given
+DEFAULT_RULES = [
+    # structured answers, see structured_output
+    {'match': r'\{"answer": <number', 'reply': '{"answer": 1, "confidence": 0.9}'},
+    {'match': r'\{"verdict": "yes" or "no"', 'reply': '{"verdict": "yes", "confidence": 0.9, "reason": "Same entity."}'},
+    {'match': r'Which of the (following|candidate) entities', 'reply': '1'},
+    {'match': r'Answer "Yes" or "No"', 'reply': 'Yes. The entity in the new sentence refers to the same entity.'},
+]
+# mentions listed by a request describing several mentions at once, see mention_descriptions
+LISTED_MENTION_PATTERN = re.compile(r'^#(\d+): (.+)$', re.MULTILINE)
+# questions of a request packing several prompts, see prompt_packing
+PACKED_QUESTION_PATTERN = re.compile(r'^### Question (\d+)\n', re.MULTILINE)
+
+
+def parse_latency(spec):
+    """
+    Latency sampler of a spec: ``fixed:S``, ``uniform:LOW,HIGH`` or ``lognormal:MEDIAN,SIGMA`` (seconds).
+    """
+    kind, _, params = spec.partition(':')
+    values = [float(value) for value in params.split(',')] if params else []
+    if kind == 'fixed':
+        return lambda rng: values[0]
+    if kind == 'uniform':
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == 'lognormal':
+        median, sigma = values
+        return lambda rng: median * rng.lognormvariate(0, sigma)
+    raise ValueError(f'unknown latency distribution {spec!r}')
+
+
+class MockLLM:
+    """
+    Rule-based answers and fault injection of the mock server.
+    """
+
+    def __init__(
+        self,
+        rules=None,
+        seed=0,
+        latency='fixed:0',
+        rate_limit_rate=0.0,
+        server_error_rate=0.0,
+        timeout_rate=0.0,
+        timeout_seconds=120.0,
+        retry_after=1.0,
+    ):
+        self.rules = [(re.compile(rule['match']), rule['reply']) for rule in (DEFAULT_RULES if rules is None else rules)]
+        self.seed = seed
+        self.sample_latency = parse_latency(latency)
+        self.rate_limit_rate = rate_limit_rate
+        self.server_error_rate = server_error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_seconds = timeout_seconds
+        self.retry_after = retry_after
+        self.counts = {'requests': 0, 'rate_limited': 0, 'server_errors': 0, 'timeouts': 0}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def reply(self, prompt):
+        if '{"answers": [' in prompt:
+            # every packed question is answered as if it had been asked alone
+            sections = PACKED_QUESTION_PATTERN.split(prompt.rsplit('\n\n', 1)[0])
+            return json.dumps({'answers': [
+                {'id': int(item_id), 'answer': self.reply(question)}
+                for item_id, question in zip(sections[1::2], sections[2::2])
+            ]})
+        for pattern, reply in self.rules:
+            if pattern.search(prompt):
+                return reply
+        if '{"descriptions": [' in prompt:
+            return json.dumps({'descriptions': [
+                {'id': int(item_id), 'description': f'{mention} (mock description)'}
+                for item_id, mention in LISTED_MENTION_PATTERN.findall(prompt)
+            ]})
+        digest = hashlib.sha256(f'{self.seed}:{prompt}'.encode('utf-8')).hexdigest()
+        return f'Mock answer {digest[:8]}: ' + prompt.strip().splitlines()[-1][:200]
+
+    def response(self, path, request):
+        """
+        Successful response body of a chat or completion request.
+        """
+        if path == '/chat/completions':
+            prompt = '\n'.join(message['content'] for message in request['messages'])
+        else:
+            prompt = request['prompt']
+        text = self.reply(prompt)
+        words = text.split(' ')
+        if request.get('max_tokens'):
+            # one word per token is close enough for a mock
+            text = ' '.join(words[:request['max_tokens']])
+        prompt_tokens = len(prompt) // 4 + 1
+        completion_tokens = min(len(words), request.get('max_tokens') or len(words))
+        if path == '/chat/completions':
+            choice = {'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}
+            if request.get('logprobs'):
+                token = text.split(' ')[0]
+                choice['logprobs'] = {'content': [{
+                    'token': token, 'logprob': 0.0, 'top_logprobs': [{'token': token, 'logprob': 0.0}],
+                }]}
+        else:
+            choice = {'index': 0, 'text': text, 'finish_reason': 'stop', 'logprobs': None}
+        return {
+            'id': 'mock-' + uuid.uuid4().hex[:24],
+            'object': 'chat.completion' if path == '/chat/completions' else 'text_completion',
+            'created': int(time.time()),
+            'model': request.get('model'),
+            'choices': [choice],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+            },
+        }
+
+    def fault(self):
+        """
+        Draw the fault of the next real-time request: (latency, None | 'rate_limit' | 'server_error' | 'timeout').
+        """
+        with self._lock:
+            self.counts['requests'] += 1
+            latency = self.sample_latency(self._rng)
+            draw = self._rng.random()
+            if draw < self.rate_limit_rate:
+                self.counts['rate_limited'] += 1
+                return 0.0, 'rate_limit'
+            draw -= self.rate_limit_rate
+            if draw < self.server_error_rate:
+                self.counts['server_errors'] += 1
+                return latency, 'server_error'
+            draw -= self.server_error_rate
+            if draw < self.timeout_rate:
+                self.counts['timeouts'] += 1
+                return self.timeout_seconds, 'timeout'
+        return latency, None
+
+    def batch_responder(self, line):
+        """
+        Responder of the Batch API routes: same answers, no injected faults.
+        """
+        url = line['url'][len('/v1'):] if line['url'].startswith('/v1/') else line['url']
+        return 200, self.response(url, line['body'])
+
+
+class MockHandler(BatchHandler):
+
+    def do_POST(self):
+        path = self._path()
+        if path not in ('/chat/completions', '/completions'):
+            super().do_POST()
+            return
+        request = json.loads(self._read_body())
+        mock = self.server.mock
+        latency, fault = mock.fault()
+        time.sleep(latency)
+        if fault == 'timeout':
+            # the client gave up long ago; drop the connection without an answer
+            self.close_connection = True
+            return
+        if fault == 'rate_limit':
+            body = json.dumps({'error': {'message': 'Rate limit reached (mock)', 'type': 'requests'}}).encode('utf-8')
+            self.send_response(429)
+            self.send_header('Retry-After', f'{mock.retry_after:g}')
+        elif fault == 'server_error':
+            body = json.dumps({'error': {'message': 'The server had an error (mock)', 'type': 'server_error'}}).encode('utf-8')
+            self.send_response(500)
+        else:
+            body = json.dumps(mock.response(path, request)).encode('utf-8')
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_server(host='127.0.0.1', port=8000, mock=None, workers=8):
+    """
+    Build (but do not start) the mock server; call serve_forever() on the result.
+    """
+    mock = mock or MockLLM()
+    server = ThreadingHTTPServer((host, port), MockHandler)
+    server.daemon_threads = True
+    server.mock = mock
+    server.batch_store = BatchStore(mock.batch_responder, workers=workers)
+    return server
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='deterministic mock of the OpenAI API with latency and error injection.',
+        allow_abbrev=False,
+    )
+    parser.add_argument("--host", default='127.0.0.1', type=str)
+    parser.add_argument("--port", default=8000, type=int)
+    parser.add_argument(
+        "--rules",
+        help="JSON file of [{\"match\": regex, \"reply\": text}], first match wins; defaults answer the DeepEL prompts",
+        default='',
+        type=str,
+    )
+    parser.add_argument("--seed", help="seed of the fallback answers and of the injected faults", default=0, type=int)
+    parser.add_argument(
+        "--latency",
+        help="latency distribution: fixed:S, uniform:LOW,HIGH or lognormal:MEDIAN,SIGMA (seconds)",
+        default='fixed:0',
+        type=str,
+    )
+    parser.add_argument("--rate_limit_rate", help="fraction of requests answered with 429", default=0.0, type=float)
+    parser.add_argument("--retry_after", help="Retry-After of the 429 answers, in seconds", default=1.0, type=float)
+    parser.add_argument("--server_error_rate", help="fraction of requests answered with 500", default=0.0, type=float)
+    parser.add_argument("--timeout_rate", help="fraction of requests never answered", default=0.0, type=float)
+    parser.add_argument(
+        "--timeout_seconds",
+        help="how long an unanswered request is held before the connection is dropped",
+        default=120.0,
+        type=float,
+    )
+    parser.add_argument("--workers", help="number of batch requests executed at the same time", default=8, type=int)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    rules = None
+    if args.rules:
+        with open(args.rules) as reader:
+            rules = json.load(reader)
+    mock = MockLLM(
+        rules=rules,
+        seed=args.seed,
+        latency=args.latency,
+        rate_limit_rate=args.rate_limit_rate,
+        server_error_rate=args.server_error_rate,
+        timeout_rate=args.timeout_rate,
+        timeout_seconds=args.timeout_seconds,
+        retry_after=args.retry_after,
+    )
+    server = make_server(args.host, args.port, mock, workers=args.workers)
+    print(f'mock LLM API listening on http://{args.host}:{server.server_address[1]}/v1')
+    try:
+        server.serve_forever()
+    finally:
+        print(f'mock LLM API: {mock.counts}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+"""
+Asynchronous, bounded-concurrency batch client for the LLM stages.
+
+Each request still goes through the blocking functions of openai_function.py, which run on a worker thread
+pool driven by asyncio. Stages submit all of their prompts at once and get the results back in order, with at
+most ``max_in_flight`` requests outstanding.
+
+Prompts are dispatched in the order they are given. With the ``longest_first`` schedule (set_schedule),
+run_batch_by_document dispatches the documents with the most estimated work (prompt tokens) first, so that one
+large document started last does not set the completion time of the whole stage; the small documents fill the
+slots as the large ones finish.
+
+With packing (set_packing), run_batch_by_document sends the prompts of openai_chatgpt several at a time, as the
+numbered questions of one request up to a token budget, see prompt_packing.
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+from DeepEL.openai_function import openai_chatgpt, openai_completion, openai_chatgpt_structured
+from DeepEL.token_budget import get_prompt_budget
+from DeepEL.structured_output import get_max_reasks
+from DeepEL.prompt_packing import pack_prompts, ask_packed
+
+DEFAULT_MAX_IN_FLIGHT = 32
+SCHEDULES = ('document_order', 'longest_first')
+
+# order in which run_batch_by_document dispatches the documents, see set_schedule
+_schedule = 'document_order'
+# prompt tokens packed into one request by run_batch_by_document, 0 disables packing, see set_packing
+_pack_tokens = 0
+
+
+def set_schedule(schedule):
+    """
+    'document_order' dispatches the documents in the order of the stage, 'longest_first' the ones with the most
+    estimated work first.
+    """
+    global _schedule
+    if schedule not in SCHEDULES:
+        raise ValueError(f'unknown schedule {schedule!r}, expected one of {SCHEDULES}')
+    _schedule = schedule
+
+
+def set_packing(pack_tokens):
+    """
+    Pack the free-text chat prompts (openai_chatgpt) of run_batch_by_document into requests of at most
+    ``pack_tokens`` prompt tokens; 0 sends every prompt on its own. The other functions (completions, structured
+    or logprobs replies, the cascade) are sent one prompt per request, with a warning.
+    """
+    global _pack_tokens
+    _pack_tokens = pack_tokens
+
+
+def document_work(prompts):
+    """
+    Estimated work of the prompts of a document: their tokens, counted by the tokenizer of the prompt budget.
+    """
+    tokenizer = get_prompt_budget().tokenizer
+    return sum(tokenizer.count(str(prompt)) for prompt in prompts)
+
+
+async def arun_batch(function, prompts, max_in_flight=DEFAULT_MAX_IN_FLIGHT, on_result=None, desc=None, **kwargs):
+    """
+    Call ``function(prompt, **kwargs)`` for every prompt with at most ``max_in_flight`` calls outstanding.
+
+    :param function: blocking per-prompt function, e.g. openai_chatgpt or openai_completion
+    :param prompts: iterable of prompts
+    :param max_in_flight: maximum number of requests outstanding at the same time
+    :param on_result: optional callback ``on_result(index, result)``, invoked in completion order
+    :param desc: description of the progress bar
+    :return: list of results, in the same order as ``prompts``
+    """
+    prompts = list(prompts)
+    results = [None] * len(prompts)
+    if not prompts:
+        return results
+    if max_in_flight < 1:
+        raise ValueError('max_in_flight must be at least 1')
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max_in_flight)
+    executor = ThreadPoolExecutor(max_workers=max_in_flight)
+    progress = tqdm(total=len(prompts), desc=desc)
+
+    async def run_one(index, prompt):
+        async with semaphore:
+            result = await loop.run_in_executor(executor, functools.partial(function, prompt, **kwargs))
+        results[index] = result
+        progress.update(1)
+        if on_result is not None:
+            on_result(index, result)
+
+    tasks = [asyncio.ensure_future(run_one(index, prompt)) for index, prompt in enumerate(prompts)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    finally:
+        progress.close()
+        executor.shutdown(wait=True, cancel_futures=True)
+    return results
+
+
+def run_batch(function, prompts, max_in_flight=DEFAULT_MAX_IN_FLIGHT, on_result=None, desc=None, **kwargs):
+    """
+    Blocking wrapper of arun_batch for the stage scripts.
+    """
+    return asyncio.run(
+        arun_batch(function, prompts, max_in_flight=max_in_flight, on_result=on_result, desc=desc, **kwargs)
+    )
+
+
+def run_batch_by_document(
+    function,
+    doc_name2prompts,
+    on_document,
+    max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+    desc=None,
+    dedupe=False,
+    **kwargs,
+):
+    """
+    Run the prompts of many documents as one batch and hand back the results document by document.
+
+    ``on_document(doc_name, results)`` is called as soon as every prompt of that document has been answered,
+    so stages can keep saving their output incrementally and resume after a crash.
+
+    :param function: blocking per-prompt function, e.g. openai_chatgpt or openai_completion
+    :param doc_name2prompts: dict, doc_name -> list of prompts of that document
+    :param on_document: callback ``on_document(doc_name, results)``, results in the order of the prompts
+    :param max_in_flight: maximum number of requests outstanding at the same time
+    :param desc: description of the progress bar
+    :param dedupe: call ``function`` once per distinct prompt of the whole batch and hand its result to every
+        document asking it
+    """
+    prompts = []
+    # documents and positions each prompt of the batch answers
+    targets = []
+    prompt2index = dict()
+    doc_name2results = dict()
+    doc_names = list(doc_name2prompts)
+    if _schedule == 'longest_first':
+        doc_name2work = {doc_name: document_work(doc_name2prompts[doc_name]) for doc_name in doc_names}
+        doc_names.sort(key=lambda doc_name: -doc_name2work[doc_name])
+    for doc_name in doc_names:
+        doc_prompts = doc_name2prompts[doc_name]
+        doc_name2results[doc_name] = [None] * len(doc_prompts)
+        for position, prompt in enumerate(doc_prompts):
+            if dedupe and prompt in prompt2index:
+                targets[prompt2index[prompt]].append((doc_name, position))
+                continue
+            prompt2index[prompt] = len(prompts)
+            prompts.append(prompt)
+            targets.append([(doc_name, position)])
+
+    remaining = {doc_name: len(results) for doc_name, results in doc_name2results.items()}
+    for doc_name, num_prompts in remaining.items():
+        if num_prompts == 0:
+            on_document(doc_name, doc_name2results[doc_name])
+
+    def on_result(index, result):
+        for doc_name, position in targets[index]:
+            doc_name2results[doc_name][position] = result
+            remaining[doc_name] -= 1
+            if remaining[doc_name] == 0:
+                on_document(doc_name, doc_name2results[doc_name])
+
+    if _pack_tokens and function is not openai_chatgpt:
+        print(
+            f'Warning: --pack_tokens only packs the free-text chat prompts; the {len(prompts)} prompts of '
+            f'{getattr(function, "__name__", function)} are sent one per request'
+        )
+    if not _pack_tokens or function is not openai_chatgpt:
+        run_batch(function, prompts, max_in_flight=max_in_flight, on_result=on_result, desc=desc, **kwargs)
+        return len(prompts)
+
+    # prompts of the same or of neighbouring documents share a request
+    packs = pack_prompts(prompts, _pack_tokens)
+
+    def ask_pack(pack, **kwargs):
+        if len(pack) == 1:
+            return [function(prompts[pack[0]], **kwargs)]
+        return ask_packed(
+            [prompts[index] for index in pack],
+            lambda prompt, profile: openai_chatgpt_structured(prompt, **dict(kwargs, profile=profile), schema='answers'),
+            lambda prompt: function(prompt, **kwargs),
+            profile=kwargs.get('profile'),
+            max_reasks=get_max_reasks(),
+        )
+
+    def on_pack(pack_index, results):
+        for index, result in zip(packs[pack_index], results):
+            on_result(index, result)
+
+    run_batch(ask_pack, packs, max_in_flight=max_in_flight, on_result=on_pack, desc=desc, **kwargs)
+    return len(packs)
+
+
+def openai_chatgpt_batch(prompts, model="gpt-3.5-turbo", max_in_flight=DEFAULT_MAX_IN_FLIGHT, **kwargs):
+    return run_batch(openai_chatgpt, prompts, max_in_flight=max_in_flight, model=model, **kwargs)
+
+
+def openai_completion_batch(prompts, model="text-davinci-003", max_in_flight=DEFAULT_MAX_IN_FLIGHT, **kwargs):
+    return run_batch(openai_completion, prompts, max_in_flight=max_in_flight, model=model, **kwargs)
@@ -1,28 +1,426 @@
 import openai
 import time
 from tqdm import tqdm
+from DeepEL.llm_cache import request_key
+from DeepEL.rate_limiter import estimate_request_tokens
+from DeepEL.retry_policy import RetryPolicy, classify_error
+from DeepEL.single_flight import SingleFlight
+from DeepEL.prompt_layout import chat_messages, prefix_params
+from DeepEL.generation_profiles import generation_params, DEFAULT_COMPLETION_MAX_TOKENS
+from DeepEL import structured_output
+from DeepEL.structured_output import StructuredOutputError, parse_structured, reask_message, response_format_params
 
-def openai_chatgpt(prompt, model="gpt-3.5-turbo"):
-    openai_output = openai.ChatCompletion.create(
+# persistent response cache shared by every call in the process, see set_llm_cache
+_llm_cache = None
+# RPM / TPM budgets shared by every call in the process, see set_rate_limiter
+_rate_limiter = None
+# retry policy of every request sent to the API, see set_retry_policy
+_retry_policy = RetryPolicy()
+# de-duplication of identical requests that are in flight at the same time, see set_single_flight
+_single_flight = SingleFlight()
+# pool of api_base / api_key pairs requests are balanced over, see set_endpoint_pool
+_endpoint_pool = None
+# AIMD limit on the requests in flight, see set_concurrency_limiter
+_concurrency_limiter = None
+# duplicate requests sent for calls slower than the usual latency, see set_hedging
+_hedging = None
+# backend answering the requests instead of the OpenAI API, e.g. a local model, see set_llm_backend
+_llm_backend = None
+# record / replay of every request and response, see set_cassette
+_cassette = None
+# latency, queue wait, retries and tokens of every call, see set_telemetry
+_telemetry = None
+
+
+def set_llm_cache(cache):
+    """
+    Route every openai_chatgpt / openai_completion call through ``cache`` (an LLMCache); pass None to disable.
+    """
+    global _llm_cache
+    _llm_cache = cache
+
+
+def get_llm_cache():
+    return _llm_cache
+
+
+def set_rate_limiter(rate_limiter):
+    """
+    Pace every request sent to the API with ``rate_limiter`` (a RateLimiter); pass None to disable.
+    """
+    global _rate_limiter
+    _rate_limiter = rate_limiter
+
+
+def set_retry_policy(retry_policy):
+    """
+    Retry failed requests according to ``retry_policy`` (a RetryPolicy); pass None to disable retries.
+    """
+    global _retry_policy
+    _retry_policy = retry_policy
+
+
+def get_retry_policy():
+    return _retry_policy
+
+
+def set_single_flight(single_flight):
+    """
+    Share one outstanding request between concurrent identical calls with ``single_flight`` (a SingleFlight);
+    pass None to send every call on its own.
+    """
+    global _single_flight
+    _single_flight = single_flight
+
+
+def get_single_flight():
+    return _single_flight
+
+
+def set_endpoint_pool(endpoint_pool):
+    """
+    Balance requests over the endpoints of ``endpoint_pool`` (an EndpointPool) instead of openai.api_base /
+    openai.api_key; pass None to go back to the single global endpoint.
+    """
+    global _endpoint_pool
+    _endpoint_pool = endpoint_pool
+
+
+def get_endpoint_pool():
+    return _endpoint_pool
+
+
+def set_concurrency_limiter(concurrency_limiter):
+    """
+    Adapt the number of requests in flight with ``concurrency_limiter`` (an AdaptiveConcurrencyLimiter); pass None
+    to leave it to the max_in_flight of the batch.
+    """
+    global _concurrency_limiter
+    _concurrency_limiter = concurrency_limiter
+
+
+def get_concurrency_limiter():
+    return _concurrency_limiter
+
+
+def set_hedging(hedging):
+    """
+    Hedge slow requests with ``hedging`` (a Hedging); pass None to send every request once.
+    """
+    global _hedging
+    _hedging = hedging
+
+
+def get_hedging():
+    return _hedging
+
+
+def set_llm_backend(backend):
+    """
+    Answer every request with ``backend`` (e.g. a local_backend.LocalBackend) instead of the OpenAI API; pass None
+    to go back to the API.
+    """
+    global _llm_backend
+    _llm_backend = backend
+
+
+def get_llm_backend():
+    return _llm_backend
+
+
+def set_cassette(cassette):
+    """
+    Record every request and response to ``cassette`` (a cassette.Cassette), or answer from it in replay mode;
+    pass None to stop.
+    """
+    global _cassette
+    _cassette = cassette
+
+
+def get_cassette():
+    return _cassette
+
+
+def set_telemetry(telemetry):
+    """
+    Record every call in ``telemetry`` (a telemetry.Telemetry); pass None to stop.
+    """
+    global _telemetry
+    _telemetry = telemetry
+
+
+def get_telemetry():
+    return _telemetry
+
+
+def _create(api, **request):
+    backend = _llm_backend
+    # answers of a local model are cached apart from those of the API model of the same name
+    key = request_key(api.__name__ if backend is None else f'{api.__name__}@{backend.name}', request)
+    cassette = _cassette
+    telemetry = _telemetry
+    # how the call was answered, filled in by _fetch and _send
+    trace = dict(source='coalesced', queue_wait=0.0, attempts=0)
+    started = time.monotonic()
+    try:
+        if cassette is not None and cassette.replaying:
+            trace['source'] = 'cassette'
+            openai_output = cassette.replay(key, request)
+        else:
+            openai_output = _fetch(api, key, request, trace)
+    except Exception:
+        if telemetry is not None:
+            telemetry.record(
+                request.get('model'), trace['source'], time.monotonic() - started, trace['queue_wait'],
+                retries=max(0, trace['attempts'] - 1), error=True,
+            )
+        raise
+    latency = time.monotonic() - started
+    if telemetry is not None:
+        telemetry.record(
+            request.get('model'), trace['source'], latency, trace['queue_wait'],
+            retries=max(0, trace['attempts'] - 1), usage=openai_output.get('usage'),
+        )
+    if cassette is not None and not cassette.replaying:
+        cassette.record(key, api.__name__, request, openai_output, latency)
+    return openai_output
+
+
+def _fetch(api, key, request, trace):
+    cache = _llm_cache
+    if cache is not None:
+        cached_output = cache.get(key)
+        if cached_output is not None:
+            trace['source'] = 'cache'
+            return cached_output
+    single_flight = _single_flight
+    if single_flight is None:
+        return _send(api, key, request, trace)
+    return single_flight.do(key, lambda: _send(api, key, request, trace))
+
+
+def _send(api, key, request, trace):
+    cache = _llm_cache
+    if cache is not None and not cache.bypass and cache.contains(key):
+        # answered by an identical call that finished between our cache lookup and now
+        trace['source'] = 'cache'
+        return cache.get(key)
+    trace['source'] = 'network'
+    rate_limiter = _rate_limiter
+    endpoint_pool = _endpoint_pool
+    concurrency_limiter = _concurrency_limiter
+    backend = _llm_backend
+    hedging = _hedging
+    estimated_tokens = estimate_request_tokens(request)
+    # concurrency slot and endpoint taken for the coming attempt, given back once the attempt is over
+    held = dict(started=None, endpoint=None)
+
+    def acquire():
+        waiting = time.monotonic()
+        try:
+            take_slots()
+        finally:
+            trace['queue_wait'] += time.monotonic() - waiting
+
+    def take_slots():
+        if concurrency_limiter is not None:
+            held['started'] = concurrency_limiter.acquire()
+        if endpoint_pool is not None:
+            endpoint = held['endpoint'] = endpoint_pool.acquire()
+            if endpoint.rate_limiter is not None:
+                endpoint.rate_limiter.acquire(request['model'], estimated_tokens)
+        if rate_limiter is not None:
+            rate_limiter.acquire(request['model'], estimated_tokens)
+
+    def release(error_class=None, sent=True):
+        started, endpoint = held['started'], held['endpoint']
+        held.update(started=None, endpoint=None)
+        if started is not None:
+            concurrency_limiter.release(started, error_class, sent=sent)
+        if endpoint is not None:
+            endpoint_pool.release(endpoint, error_class, sent=sent)
+        return endpoint
+
+    def send_once(routing):
+        if backend is not None:
+            return backend.create(api.__name__, request, timeout=routing.get('request_timeout'))
+        return api.create(**routing, **request)
+
+    def attempt(timeout):
+        trace['attempts'] += 1
+        routing = dict()
+        endpoint = held['endpoint']
+        if endpoint is not None:
+            routing = {'api_base': endpoint.api_base, 'api_key': endpoint.api_key}
+        if timeout is not None:
+            routing['request_timeout'] = timeout
+        try:
+            if hedging is not None:
+                # only the request itself is hedged, after the limiters let it through: their waits and the
+                # retry backoff are not latency of the upstream
+                openai_output = hedging.call(lambda: send_once(routing))
+            else:
+                openai_output = send_once(routing)
+        except Exception as error:
+            release(classify_error(error))
+            raise
+        release()
+        usage = openai_output.get('usage') or {}
+        if endpoint is not None and endpoint.rate_limiter is not None:
+            endpoint.rate_limiter.reconcile(request['model'], estimated_tokens, usage.get('total_tokens'))
+        if rate_limiter is not None:
+            rate_limiter.reconcile(request['model'], estimated_tokens, usage.get('total_tokens'))
+        return openai_output
+
+    retry_policy = _retry_policy
+    try:
+        if retry_policy is not None:
+            openai_output, _ = retry_policy.call(attempt, prepare=acquire)
+        else:
+            acquire()
+            openai_output = attempt(None)
+    finally:
+        release(sent=False)
+    if cache is not None:
+        cache.put(key, openai_output)
+    return openai_output
+
+
+def chatgpt_request(prompt, model="gpt-3.5-turbo", role="system", profile=None):
+    """
+    API resource and request of openai_chatgpt, shared with the offline batch mode so both send the same body.
+    ``profile`` names the generation profile (max_tokens, stop, temperature) of the stage, see generation_profiles.
+    A prompt_layout.LayeredPrompt is sent as a shared system prefix followed by its per-mention part.
+    """
+    request = dict(
                 model=model,
-                messages=[
-                {"role": "system", "content": prompt},
-                ]
+                messages=chat_messages(prompt, role),
+                **generation_params(profile),
+                **prefix_params(prompt),
             )
+    return openai.ChatCompletion, request
+
+
+def openai_chatgpt(prompt, model="gpt-3.5-turbo", role="system", profile=None):
+    api, request = chatgpt_request(prompt, model=model, role=role, profile=profile)
+    openai_output = _create(api, **request)
     complete_output = openai_output["choices"][0]["message"]['content']
     return complete_output
 
 
-def openai_completion(prompt, model="text-davinci-003"):
-    openai_output = openai.Completion.create(
+def completion_request(prompt, model="text-davinci-003", profile=None):
+    """
+    API resource and request of openai_completion, shared with the offline batch mode so both send the same body.
+    """
+    request = dict(
         model=model,
         prompt=prompt,
-        max_tokens=100, # default is set to 16, too short
+        max_tokens=DEFAULT_COMPLETION_MAX_TOKENS,
     )
+    request.update(generation_params(profile))
+    return openai.Completion, request
+
+
+def openai_completion(prompt, model="text-davinci-003", profile=None):
+    api, request = completion_request(prompt, model=model, profile=profile)
+    openai_output = _create(api, **request)
     complete_output = openai_output["choices"][0]['text']
     return complete_output
 
 
+def chatgpt_logprobs_request(prompt, model="gpt-3.5-turbo", role="system", profile='single_token', top_logprobs=20):
+    """
+    Request of openai_chatgpt_logprobs: a chat request that also returns the top logprobs of each token.
+    """
+    api, request = chatgpt_request(prompt, model=model, role=role, profile=profile)
+    request.update(logprobs=True, top_logprobs=top_logprobs)
+    return api, request
+
+
+def openai_chatgpt_logprobs(prompt, model="gpt-3.5-turbo", role="system", profile='single_token', top_logprobs=20):
+    """
+    Reply of the chat model and the top logprobs of its first token, as a list of (token, logprob).
+    """
+    api, request = chatgpt_logprobs_request(
+        prompt, model=model, role=role, profile=profile, top_logprobs=top_logprobs,
+    )
+    openai_output = _create(api, **request)
+    choice = openai_output["choices"][0]
+    token_logprobs = (choice.get("logprobs") or {}).get("content") or []
+    top_logprobs = [(top["token"], top["logprob"]) for top in token_logprobs[0]["top_logprobs"]] if token_logprobs else []
+    return choice["message"]['content'], top_logprobs
+
+
+def completion_logprobs_request(prompt, model="text-davinci-003", profile='single_token', top_logprobs=5):
+    """
+    Request of openai_completion_logprobs; the completion API returns at most 5 top logprobs.
+    """
+    api, request = completion_request(prompt, model=model, profile=profile)
+    request.update(logprobs=top_logprobs)
+    return api, request
+
+
+def openai_completion_logprobs(prompt, model="text-davinci-003", profile='single_token', top_logprobs=5):
+    """
+    Completion and the top logprobs of its first token, as a list of (token, logprob).
+    """
+    api, request = completion_logprobs_request(prompt, model=model, profile=profile, top_logprobs=top_logprobs)
+    openai_output = _create(api, **request)
+    choice = openai_output["choices"][0]
+    top_logprobs = ((choice.get("logprobs") or {}).get("top_logprobs") or [{}])[0]
+    return choice['text'], sorted(top_logprobs.items(), key=lambda item: -item[1])
+
+
+def chatgpt_structured_request(prompt, model="gpt-3.5-turbo", role="system", profile=None, schema='choice', history=()):
+    """
+    Request of openai_chatgpt_structured: a chat request asking for an answer of ``schema`` (see structured_output),
+    followed by the ``history`` of the previous malformed replies and re-asks, if any.
+    """
+    api, request = chatgpt_request(prompt, model=model, role=role, profile=profile)
+    request['messages'] += list(history)
+    request.update(response_format_params(schema))
+    return api, request
+
+
+def openai_chatgpt_structured(prompt, model="gpt-3.5-turbo", role="system", profile=None, schema='choice'):
+    """
+    Reply of the chat model and its answer parsed against ``schema``, as (reply, dict). A malformed reply is asked
+    again, pointing at its error, as many times as set by structured_output.set_structured_output; the answer is
+    None if it is still malformed.
+    """
+    max_reasks = structured_output.get_max_reasks()
+    history = []
+    for reask in range(max_reasks + 1):
+        api, request = chatgpt_structured_request(
+            prompt, model=model, role=role, profile=profile, schema=schema, history=history,
+        )
+        openai_output = _create(api, **request)
+        complete_output = openai_output["choices"][0]["message"]['content']
+        structured_output.count('replies')
+        try:
+            return complete_output, parse_structured(schema, complete_output)
+        except StructuredOutputError as error:
+            structured_output.count('malformed')
+            if reask < max_reasks:
+                structured_output.count('reasks')
+                history += [
+                    {"role": "assistant", "content": complete_output},
+                    {"role": role, "content": reask_message(schema, error)},
+                ]
+    structured_output.count('failed')
+    return complete_output, None
+
+
+# request builder of each LLM function, used to submit the same requests through the Batch API
+REQUEST_BUILDERS = {
+    openai_chatgpt: chatgpt_request,
+    openai_completion: completion_request,
+    openai_chatgpt_logprobs: chatgpt_logprobs_request,
+    openai_completion_logprobs: completion_logprobs_request,
+    openai_chatgpt_structured: chatgpt_structured_request,
+}
+
+
 if __name__ == '__main__':
     from in_context_el.openai_key import OPENAI_API_KEY
     prompt = 'it is just a test'
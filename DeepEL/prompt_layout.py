@@ -0,0 +1,69 @@
+"""
+Prefix-first prompt layout.
+
+Providers and local engines reuse the work done on a prompt prefix they have seen recently, but only if the
+prompts really start with the same text. A LayeredPrompt keeps the content shared by many prompts (instructions,
+document text, candidate block) in front of the per-mention content, and remembers where the shared prefix ends:
+the request builders send the prefix as its own leading system message, optionally tagged with a
+``prompt_cache_key`` so the provider routes prompts of the same prefix to the same cache.
+
+Hosted APIs only cache prefixes of at least PROVIDER_MIN_PREFIX_TOKENS tokens. A shorter prefix, such as the
+instructions alone that Make_initial_choice and Reselect share between their prompts, gains nothing there and only
+helps local engines caching short prefixes. The prefix of Self_validation holds the document and its entity
+descriptions, and reaches it on long documents.
+
+A LayeredPrompt is a plain ``str`` (prefix + suffix) everywhere else, so stages store and print it as before.
+"""
+import hashlib
+
+# shortest prefix the prompt caches of the hosted APIs reuse
+PROVIDER_MIN_PREFIX_TOKENS = 1024
+
+# tag chat requests with the prompt_cache_key of their prefix, see set_prompt_cache_keys
+_prompt_cache_keys = False
+
+
+class LayeredPrompt(str):
+    """
+    Prompt made of a prefix shared with other prompts and a per-mention suffix.
+    """
+
+    def __new__(cls, prefix, suffix):
+        prompt = super().__new__(cls, prefix + suffix)
+        prompt.prefix_length = len(prefix)
+        return prompt
+
+    @property
+    def prefix(self):
+        return str(self[:self.prefix_length])
+
+    @property
+    def suffix(self):
+        return str(self[self.prefix_length:])
+
+
+def set_prompt_cache_keys(enabled):
+    """
+    Send the ``prompt_cache_key`` of the prefix with every layered chat request (for providers supporting it).
+    """
+    global _prompt_cache_keys
+    _prompt_cache_keys = enabled
+
+
+def chat_messages(prompt, role):
+    """
+    Messages of a chat request: a LayeredPrompt becomes a system message with its prefix followed by a ``role``
+    message with its suffix, any other prompt a single ``role`` message.
+    """
+    if not isinstance(prompt, LayeredPrompt) or not prompt.prefix_length:
+        return [{"role": role, "content": str(prompt)}]
+    return [{"role": "system", "content": prompt.prefix}, {"role": role, "content": prompt.suffix}]
+
+
+def prefix_params(prompt):
+    """
+    Extra request parameters tagging the prefix of a LayeredPrompt, {} when disabled or not layered.
+    """
+    if not _prompt_cache_keys or not isinstance(prompt, LayeredPrompt) or not prompt.prefix_length:
+        return {}
+    return {'prompt_cache_key': hashlib.sha256(prompt.prefix.encode('utf-8')).hexdigest()[:32]}
@@ -0,0 +1,102 @@
+"""
+Packing of many short prompts into one request.
+
+On sentence-level benchmarks (KORE50, OKE 2015/2016, RSS-500) every document is one short sentence with one to
+three mentions, and the fixed cost of a request dominates. Packing sends several prompts, of one or several
+documents, as numbered questions of one request, up to a token budget, and asks for a structured answer per
+question (schema ``answers`` of structured_output). The answers are unpacked in the order of the prompts; the
+questions missing from the answer are asked again together, then one by one with their own prompt.
+"""
+import threading
+from collections import Counter
+from DeepEL.generation_profiles import GENERATION_PROFILES
+from DeepEL.structured_output import schema_instructions
+from DeepEL.token_budget import get_prompt_budget
+
+# most questions of one request, so that the answer stays short enough to be reliable
+MAX_PACK_ITEMS = 20
+# completion tokens of the JSON around each answer
+ANSWER_OVERHEAD_TOKENS = 16
+
+# packed requests, packed prompts and prompts asked on their own, see packing_stats
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def pack_prompts(prompts, max_tokens, max_items=MAX_PACK_ITEMS):
+    """
+    Group the prompts, in order, into packs of at most ``max_tokens`` prompt tokens and ``max_items`` prompts;
+    a prompt longer than ``max_tokens`` is a pack of its own. Returns lists of prompt indices.
+    """
+    count = get_prompt_budget().count
+    packs = []
+    tokens = 0
+    for index, prompt in enumerate(prompts):
+        size = count(str(prompt))
+        if packs and tokens + size <= max_tokens and len(packs[-1]) < max_items:
+            packs[-1].append(index)
+            tokens += size
+        else:
+            packs.append([index])
+            tokens = size
+    return packs
+
+
+def packed_prompt(prompts, ids):
+    """
+    One prompt asking the questions ``prompts``, numbered with ``ids``.
+    """
+    questions = '\n\n'.join(f'### Question {item_id}\n{str(prompt).strip()}' for item_id, prompt in zip(ids, prompts))
+    return (
+        'Answer each of the following questions on its own, as if it had been asked alone.\n\n'
+        + questions + '\n\n' + schema_instructions('answers')
+    )
+
+
+def packed_profile(profile, num_items):
+    """
+    Generation parameters of a request packing ``num_items`` prompts of generation profile ``profile``: room for
+    every answer, and no stop sequence (it would cut the JSON after the first answer).
+    """
+    params = dict(GENERATION_PROFILES[profile]) if profile is not None else {}
+    params.pop('stop', None)
+    if params.get('max_tokens'):
+        params['max_tokens'] = num_items * (params['max_tokens'] + ANSWER_OVERHEAD_TOKENS)
+    return params
+
+
+def ask_packed(prompts, ask, ask_single, profile=None, max_reasks=1):
+    """
+    Answers of ``prompts``, in order, asked in one packed request.
+
+    :param ask: function(prompt, profile) -> (reply, answer), e.g. openai_chatgpt_structured with schema='answers'
+    :param ask_single: function(prompt) -> answer, for the prompts still missing after ``max_reasks`` packed
+        requests of the missing ones only
+    :param profile: generation profile of one answer
+    """
+    answers = dict()
+    ids = list(range(1, len(prompts) + 1))
+    for reask in range(max_reasks + 1):
+        missing = [item_id for item_id in ids if item_id not in answers]
+        if not missing:
+            break
+        _, answer = ask(
+            packed_prompt([prompts[item_id - 1] for item_id in missing], missing),
+            packed_profile(profile, len(missing)),
+        )
+        for item in (answer or {}).get('answers', []):
+            if item['id'] in missing and item['answer'].strip():
+                answers[item['id']] = item['answer'].strip()
+    missing = [item_id for item_id in ids if item_id not in answers]
+    for item_id in missing:
+        answers[item_id] = ask_single(prompts[item_id - 1])
+    with _stats_lock:
+        _stats['packs'] += 1
+        _stats['prompts'] += len(prompts)
+        _stats['asked_alone'] += len(missing)
+    return [answers[item_id] for item_id in ids]
+
+
+def packing_stats():
+    with _stats_lock:
+        return {event: _stats[event] for event in ('packs', 'prompts', 'asked_alone')}
@@ -0,0 +1,124 @@
+"""
+Token-bucket rate limiter enforcing requests-per-minute (RPM) and tokens-per-minute (TPM) budgets per model.
+
+Limits are read from a JSON file mapping model names to budgets, with "*" as the fallback for other models::
+
+    {
+        "gpt-4": {"rpm": 500, "tpm": 30000},
+        "*": {"rpm": 3500, "tpm": 90000}
+    }
+
+A budget of 0 (or a missing key) means unlimited.
+"""
+import json
+import time
+import threading
+
+# completion tokens charged up front when a request does not set max_tokens
+DEFAULT_COMPLETION_TOKENS = 256
+
+
+def estimate_request_tokens(request):
+    """
+    Rough token count of a request before it is sent: ~4 characters per prompt token plus the completion budget.
+    """
+    if 'messages' in request:
+        text = ''.join(message.get('content') or '' for message in request['messages'])
+    else:
+        prompt = request.get('prompt', '')
+        text = prompt if isinstance(prompt, str) else ''.join(prompt)
+    return len(text) // 4 + 1 + (request.get('max_tokens') or DEFAULT_COMPLETION_TOKENS)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled continuously at ``rate_per_minute``, holding at most ``capacity`` tokens.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(capacity if capacity is not None else rate_per_minute)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, amount=1):
+        """
+        Block until ``amount`` tokens are available and take them. Requests larger than the capacity wait for a
+        full bucket instead of blocking forever. Returns the time spent waiting, in seconds.
+        """
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return waited
+                delay = (amount - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def adjust(self, amount):
+        """
+        Give back (positive) or charge (negative) tokens once the real cost of a request is known.
+        """
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens + amount)
+
+
+class RateLimiter:
+    """
+    RPM and TPM buckets per model.
+
+    :param limits: dict, model -> {"rpm": int, "tpm": int}; "*" applies to models without their own entry
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+        self._buckets = dict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, file):
+        with open(file) as reader:
+            return cls(json.load(reader))
+
+    def _model_buckets(self, model):
+        with self._lock:
+            if model not in self._buckets:
+                limit = self.limits.get(model, self.limits.get('*', {}))
+                rpm = limit.get('rpm', 0)
+                tpm = limit.get('tpm', 0)
+                self._buckets[model] = (
+                    TokenBucket(rpm) if rpm else None,
+                    TokenBucket(tpm) if tpm else None,
+                )
+            return self._buckets[model]
+
+    def acquire(self, model, tokens):
+        """
+        Wait until one request of ``tokens`` estimated tokens fits the budgets of ``model``.
+        Returns the time spent waiting, in seconds.
+        """
+        request_bucket, token_bucket = self._model_buckets(model)
+        waited = 0.0
+        if request_bucket is not None:
+            waited += request_bucket.acquire(1)
+        if token_bucket is not None:
+            waited += token_bucket.acquire(tokens)
+        return waited
+
+    def reconcile(self, model, estimated_tokens, used_tokens):
+        """
+        Correct the TPM bucket of ``model`` with the token usage reported by the API.
+        """
+        _, token_bucket = self._model_buckets(model)
+        if token_bucket is not None and used_tokens is not None:
+            token_bucket.adjust(estimated_tokens - used_tokens)
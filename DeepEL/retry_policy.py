@@ -0,0 +1,161 @@
+"""
+Retry policy of the LLM client: typed error classification, exponential backoff with full jitter, Retry-After
+support and a total deadline per call.
+"""
+import time
+import random
+import threading
+import email.utils
+from collections import Counter
+import openai
+
+RATE_LIMIT = 'rate_limit'
+SERVER_ERROR = 'server_error'
+TIMEOUT = 'timeout'
+CONNECTION = 'connection'
+BAD_REQUEST = 'bad_request'
+AUTHENTICATION = 'authentication'
+UNKNOWN = 'unknown'
+
+RETRYABLE_ERRORS = {RATE_LIMIT, SERVER_ERROR, TIMEOUT, CONNECTION}
+
+
+def classify_error(error):
+    """
+    Map an exception raised by an LLM call to one of the error classes of this module.
+    """
+    if isinstance(error, openai.error.RateLimitError):
+        return RATE_LIMIT
+    if isinstance(error, (openai.error.Timeout, TimeoutError)):
+        return TIMEOUT
+    if isinstance(error, (openai.error.AuthenticationError, openai.error.PermissionError)):
+        return AUTHENTICATION
+    if isinstance(error, openai.error.InvalidRequestError):
+        return BAD_REQUEST
+    if isinstance(error, (openai.error.APIConnectionError, ConnectionError)):
+        return CONNECTION
+    if isinstance(error, openai.error.ServiceUnavailableError):
+        return SERVER_ERROR
+    http_status = getattr(error, 'http_status', None)
+    if http_status is not None:
+        if http_status == 429:
+            return RATE_LIMIT
+        if http_status in (408, 504):
+            return TIMEOUT
+        if http_status >= 500:
+            return SERVER_ERROR
+        if http_status in (401, 403):
+            return AUTHENTICATION
+        if http_status >= 400:
+            return BAD_REQUEST
+    if isinstance(error, openai.error.APIError):
+        # the legacy client raises APIError without a status for malformed or truncated server responses
+        return SERVER_ERROR
+    return UNKNOWN
+
+
+def retry_after_seconds(error):
+    """
+    Seconds the server asked us to wait (Retry-After / retry-after-ms headers), or None.
+    """
+    headers = getattr(error, 'headers', None) or {}
+    try:
+        value = headers.get('retry-after-ms')
+        if value is not None:
+            return max(0.0, float(value) / 1000)
+        value = headers.get('retry-after')
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            retry_at = email.utils.parsedate_to_datetime(value)
+            return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+class RetryPolicy:
+    """
+    Retry an LLM call on transient errors.
+
+    :param max_retries: maximum number of retries after the first attempt
+    :param base_delay: backoff of the first retry, in seconds; doubled on every retry
+    :param max_delay: cap of a single backoff, in seconds
+    :param deadline: total time budget of one call including all retries, in seconds (0 disables it)
+    :param request_timeout: timeout of a single attempt, in seconds (0 keeps the client default)
+    """
+
+    def __init__(self, max_retries=6, base_delay=1.0, max_delay=60.0, deadline=300.0, request_timeout=60.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.request_timeout = request_timeout
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.errors = Counter()
+        self._lock = threading.Lock()
+
+    def backoff(self, retry, error):
+        """
+        Delay before retry number ``retry`` (0-based): the server's Retry-After if given, full jitter otherwise.
+        """
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+
+    def call(self, function, prepare=None):
+        """
+        Call ``function(timeout)`` until it succeeds, a non-retryable error occurs, the retries are used up or
+        the deadline is reached. ``timeout`` is the time left for this attempt, or None without a limit.
+
+        :param prepare: optional callable run before every attempt (e.g. waiting on the rate limiter); the time
+            it takes counts against the deadline of the call
+        :return: (result, number of retries)
+        """
+        started = time.monotonic()
+        with self._lock:
+            self.calls += 1
+        retry = 0
+        while True:
+            try:
+                if prepare is not None:
+                    prepare()
+                timeout = self.request_timeout or None
+                if self.deadline:
+                    remaining = self.deadline - (time.monotonic() - started)
+                    if remaining <= 0:
+                        raise openai.error.Timeout(f'deadline of {self.deadline}s exceeded before the request was sent')
+                    timeout = min(timeout, remaining) if timeout else remaining
+                return function(timeout), retry
+            except Exception as error:
+                error_class = classify_error(error)
+                with self._lock:
+                    self.errors[error_class] += 1
+                delay = self.backoff(retry, error)
+                elapsed = time.monotonic() - started
+                if (
+                    error_class not in RETRYABLE_ERRORS
+                    or retry >= self.max_retries
+                    or (self.deadline and elapsed + delay >= self.deadline)
+                ):
+                    with self._lock:
+                        self.failures += 1
+                    raise
+                print(f"LLM call failed ({error_class}: {error}), retry {retry + 1} in {delay:.1f}s")
+                with self._lock:
+                    self.retries += 1
+                time.sleep(delay)
+                retry += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'retries': self.retries,
+                'failures': self.failures,
+                'errors': dict(self.errors),
+            }
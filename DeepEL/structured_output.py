@@ -0,0 +1,246 @@
+"""
+Structured answers of the LLM stages.
+
+Instead of fishing a number or a "yes" out of free text, a stage names the schema of the answer it expects
+(``choice``: index of a candidate and a confidence, ``verdict``: yes / no, a confidence and a short reason). The
+request carries the schema as ``response_format`` and the prompt ends with the matching instructions; the reply is
+parsed and validated against the schema, and only a malformed reply is asked again, with the error it made.
+
+Answers stored by earlier runs (free text) are still read by choice_index and is_positive_verdict.
+"""
+import re
+import json
+import threading
+from collections import Counter
+
+SCHEMAS = {
+    # index of a candidate entity, 0 when none matches (Make_initial_choice, Reselect)
+    'choice': {
+        'instructions': 'Reply with a JSON object only, of the form '
+                        '{"answer": <number of the candidate, 0 if none matches>, "confidence": <number between 0 and 1>}.',
+        'schema': {
+            'type': 'object',
+            'properties': {
+                'answer': {'type': 'integer', 'minimum': 0},
+                'confidence': {'type': 'number', 'minimum': 0, 'maximum': 1},
+            },
+            'required': ['answer', 'confidence'],
+            'additionalProperties': False,
+        },
+    },
+    # judgment of a replacement (Self_validation)
+    'verdict': {
+        'instructions': 'Reply with a JSON object only, of the form '
+                        '{"verdict": "yes" or "no", "confidence": <number between 0 and 1>, "reason": "<one short sentence>"}.',
+        'schema': {
+            'type': 'object',
+            'properties': {
+                'verdict': {'type': 'string', 'enum': ['yes', 'no']},
+                'confidence': {'type': 'number', 'minimum': 0, 'maximum': 1},
+                'reason': {'type': 'string'},
+            },
+            'required': ['verdict', 'confidence', 'reason'],
+            'additionalProperties': False,
+        },
+    },
+    # descriptions of several marked mentions asked in one request (Chat_change), see mention_descriptions
+    'descriptions': {
+        'instructions': 'Reply with a JSON object only, of the form '
+                        '{"descriptions": [{"id": <id of the mention>, "description": "<what the mention refers to>"}]}.',
+        'schema': {
+            'type': 'object',
+            'properties': {
+                'descriptions': {
+                    'type': 'array',
+                    'items': {
+                        'type': 'object',
+                        'properties': {'id': {'type': 'integer'}, 'description': {'type': 'string'}},
+                        'required': ['id', 'description'],
+                        'additionalProperties': False,
+                    },
+                },
+            },
+            'required': ['descriptions'],
+            'additionalProperties': False,
+        },
+    },
+    # answers of several prompts packed in one request, see prompt_packing
+    'answers': {
+        'instructions': 'Reply with a JSON object only, of the form '
+                        '{"answers": [{"id": <number of the question>, "answer": "<your answer to that question>"}]}.',
+        'schema': {
+            'type': 'object',
+            'properties': {
+                'answers': {
+                    'type': 'array',
+                    'items': {
+                        'type': 'object',
+                        'properties': {'id': {'type': 'integer'}, 'answer': {'type': 'string'}},
+                        'required': ['id', 'answer'],
+                        'additionalProperties': False,
+                    },
+                },
+            },
+            'required': ['answers'],
+            'additionalProperties': False,
+        },
+    },
+}
+
+RESPONSE_FORMATS = ('json_schema', 'json_object')
+
+# response_format sent with the structured requests and re-asks of a malformed reply, see set_structured_output
+_response_format = 'json_schema'
+_max_reasks = 1
+# replies, malformed replies, re-asks and answers given up on, see structured_stats
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+class StructuredOutputError(ValueError):
+    """
+    A reply does not follow the schema it was asked for.
+    """
+
+
+def set_structured_output(response_format='json_schema', max_reasks=1):
+    """
+    :param response_format: 'json_schema' sends the schema itself (strict structured outputs), 'json_object' only
+        asks for JSON, for endpoints without schema support; the instructions of the prompt describe the schema
+        either way
+    :param max_reasks: how many times a malformed reply is asked again
+    """
+    global _response_format, _max_reasks
+    if response_format not in RESPONSE_FORMATS:
+        raise ValueError(f'unknown response format {response_format!r}, expected one of {RESPONSE_FORMATS}')
+    _response_format = response_format
+    _max_reasks = max_reasks
+
+
+def get_max_reasks():
+    return _max_reasks
+
+
+def _schema(name):
+    if name not in SCHEMAS:
+        raise ValueError(f'unknown answer schema {name!r}, expected one of {sorted(SCHEMAS)}')
+    return SCHEMAS[name]
+
+
+def schema_instructions(name):
+    return _schema(name)['instructions']
+
+
+def response_format_params(name):
+    """
+    Request parameters asking for an answer of schema ``name``.
+    """
+    schema = _schema(name)['schema']
+    if _response_format == 'json_object':
+        return {'response_format': {'type': 'json_object'}}
+    return {'response_format': {'type': 'json_schema', 'json_schema': {'name': name, 'schema': schema, 'strict': True}}}
+
+
+def _check(value, schema, path):
+    kind = schema.get('type')
+    if kind == 'object':
+        if not isinstance(value, dict):
+            raise StructuredOutputError(f'{path} must be a JSON object')
+        for key in schema.get('required', []):
+            if key not in value:
+                raise StructuredOutputError(f'"{key}" is missing')
+        properties = schema.get('properties', {})
+        for key, item in value.items():
+            if key in properties:
+                _check(item, properties[key], f'"{key}"')
+            elif schema.get('additionalProperties') is False:
+                raise StructuredOutputError(f'"{key}" is not a field of the answer')
+        return
+    if kind == 'array':
+        if not isinstance(value, list):
+            raise StructuredOutputError(f'{path} must be a JSON array')
+        for item in value:
+            _check(item, schema['items'], f'an item of {path}')
+        return
+    if kind == 'integer' and (isinstance(value, bool) or not isinstance(value, int)):
+        raise StructuredOutputError(f'{path} must be an integer')
+    if kind == 'number' and (isinstance(value, bool) or not isinstance(value, (int, float))):
+        raise StructuredOutputError(f'{path} must be a number')
+    if kind == 'string' and not isinstance(value, str):
+        raise StructuredOutputError(f'{path} must be a string')
+    if 'enum' in schema and value not in schema['enum']:
+        raise StructuredOutputError(f'{path} must be one of {", ".join(json.dumps(item) for item in schema["enum"])}')
+    if 'minimum' in schema and value < schema['minimum']:
+        raise StructuredOutputError(f'{path} must be at least {schema["minimum"]}')
+    if 'maximum' in schema and value > schema['maximum']:
+        raise StructuredOutputError(f'{path} must be at most {schema["maximum"]}')
+
+
+def parse_structured(name, reply):
+    """
+    Answer of a reply as a dict following schema ``name``; raises StructuredOutputError when it does not.
+    Code fences and text around the JSON object are ignored, the verdict is case-insensitive.
+    """
+    start, end = reply.find('{'), reply.rfind('}')
+    if start < 0 or end < start:
+        raise StructuredOutputError('the reply is not a JSON object')
+    try:
+        answer = json.loads(reply[start:end + 1])
+    except json.JSONDecodeError as error:
+        raise StructuredOutputError(f'the reply is not valid JSON ({error.msg})') from error
+    if isinstance(answer, dict) and isinstance(answer.get('verdict'), str):
+        answer['verdict'] = answer['verdict'].strip().lower()
+    _check(answer, _schema(name)['schema'], 'the reply')
+    return answer
+
+
+def reask_message(name, error):
+    """
+    Follow-up message asking again after a malformed reply, pointing at what was wrong.
+    """
+    return f'Your reply is not valid: {error}. {schema_instructions(name)}'
+
+
+def count(event, value=1):
+    with _stats_lock:
+        _stats[event] += value
+
+
+def structured_stats():
+    with _stats_lock:
+        return {event: _stats[event] for event in ('replies', 'malformed', 'reasks', 'failed')}
+
+
+def choice_index(result):
+    """
+    Candidate number of a stored selection result, 0 for "none", None if there is no answer: a structured reply,
+    a bare number, or (free text of earlier runs) the first number of the text.
+    """
+    if not result:
+        return None
+    try:
+        return parse_structured('choice', result)['answer']
+    except StructuredOutputError:
+        pass
+    text = result.strip().strip('().').lower()
+    if text.isdigit():
+        return int(text)
+    if text == 'none':
+        return 0
+    match = re.search(r'\d+', result)
+    return int(match.group(0)) if match else None
+
+
+def is_positive_verdict(reply):
+    """
+    Whether a validation reply says yes: the verdict of a structured reply, otherwise the first word of a free
+    text reply ("Yes. ..."), and only when neither is there, whether "yes" appears in it.
+    """
+    try:
+        return parse_structured('verdict', reply)['verdict'] == 'yes'
+    except StructuredOutputError:
+        pass
+    words = re.findall(r'[a-z]+', reply.lower())
+    if words and words[0] in ('yes', 'no'):
+        return words[0] == 'yes'
+    return 'yes' in reply.lower()
@@ -0,0 +1,174 @@
+"""
+Per-call telemetry of the LLM client: latency and queue-wait histograms, retries, token usage and estimated
+cost, per model, summarized at the end of a stage.
+
+Histograms are HDR-style: values are counted in logarithmic buckets of fixed relative width, so percentiles are
+accurate to ``precision`` whatever the range, in constant memory.
+"""
+import json
+import math
+import time
+import threading
+from collections import defaultdict
+
+# USD per 1K prompt / completion tokens; models missing here are reported without cost
+MODEL_PRICES = {
+    'gpt-3.5-turbo': (0.0005, 0.0015),
+    'gpt-4': (0.03, 0.06),
+    'gpt-4o-mini': (0.00015, 0.0006),
+    'gpt-4o': (0.0025, 0.01),
+    'text-davinci-003': (0.02, 0.02),
+    'text-curie-001': (0.002, 0.002),
+}
+
+
+class Histogram:
+    """
+    Log-bucketed histogram of positive values (seconds) with a relative precision of ``precision``.
+    """
+
+    def __init__(self, precision=0.01, lowest=1e-4):
+        self.lowest = lowest
+        self._log_base = math.log1p(precision)
+        self.buckets = defaultdict(int)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        index = 0 if value <= self.lowest else int(math.log(value / self.lowest) / self._log_base) + 1
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def _bucket_value(self, index):
+        # upper edge of the bucket, so percentiles are never under-reported
+        return self.lowest if index == 0 else self.lowest * math.exp(index * self._log_base)
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(self.count * percent / 100))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(self._bucket_value(index), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class _ModelStats:
+
+    def __init__(self):
+        self.calls = 0
+        self.network_calls = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latency = Histogram()
+        self.queue_wait = Histogram()
+
+
+class Telemetry:
+    """
+    Thread-safe collector of the calls of one stage.
+
+    :param stage: stage name written to the summary
+    :param prices: dict, model -> (USD per 1K prompt tokens, USD per 1K completion tokens)
+    """
+
+    def __init__(self, stage=None, prices=None):
+        self.stage = stage
+        self.prices = dict(MODEL_PRICES, **(prices or {}))
+        self.started = time.monotonic()
+        self._models = defaultdict(_ModelStats)
+        self._lock = threading.Lock()
+
+    def record(self, model, source, latency, queue_wait=0.0, retries=0, usage=None, error=False):
+        """
+        Record one call.
+
+        :param source: 'network', 'cache', 'coalesced' (answered by an identical in-flight call) or 'cassette'
+        :param latency: seconds from the call to its answer
+        :param queue_wait: seconds spent waiting for a concurrency slot, an endpoint or the rate limits
+        :param usage: ``usage`` of the response (prompt_tokens, completion_tokens)
+        """
+        usage = usage or {}
+        with self._lock:
+            stats = self._models[model]
+            stats.calls += 1
+            stats.retries += retries
+            if error:
+                stats.errors += 1
+            if source == 'cache':
+                stats.cache_hits += 1
+            elif source == 'coalesced':
+                stats.coalesced += 1
+            elif source == 'network':
+                stats.network_calls += 1
+                stats.latency.record(latency)
+                stats.queue_wait.record(queue_wait)
+                if not error:
+                    stats.prompt_tokens += usage.get('prompt_tokens') or 0
+                    stats.completion_tokens += usage.get('completion_tokens') or 0
+
+    def _cost(self, model, stats):
+        price = self.prices.get(model)
+        if price is None:
+            return None
+        return stats.prompt_tokens / 1000 * price[0] + stats.completion_tokens / 1000 * price[1]
+
+    def summary(self):
+        with self._lock:
+            elapsed = max(time.monotonic() - self.started, 1e-9)
+            models = dict()
+            for model, stats in self._models.items():
+                models[model] = {
+                    'calls': stats.calls,
+                    'network_calls': stats.network_calls,
+                    'cache_hits': stats.cache_hits,
+                    'coalesced': stats.coalesced,
+                    'errors': stats.errors,
+                    'retries': stats.retries,
+                    'prompt_tokens': stats.prompt_tokens,
+                    'completion_tokens': stats.completion_tokens,
+                    'latency': stats.latency.summary(),
+                    'queue_wait': stats.queue_wait.summary(),
+                    'estimated_cost_usd': self._cost(model, stats),
+                }
+        calls = sum(stats['calls'] for stats in models.values())
+        tokens = sum(stats['prompt_tokens'] + stats['completion_tokens'] for stats in models.values())
+        costs = [stats['estimated_cost_usd'] for stats in models.values() if stats['estimated_cost_usd'] is not None]
+        return {
+            'stage': self.stage,
+            'elapsed_seconds': elapsed,
+            'calls': calls,
+            'calls_per_second': calls / elapsed,
+            'tokens': tokens,
+            'tokens_per_second': tokens / elapsed,
+            'estimated_cost_usd': sum(costs) if costs else None,
+            'models': models,
+        }
+
+    def write_summary(self, path, extra=None):
+        """
+        Write the summary as JSON, with the ``extra`` sections (dict) of other components of the client.
+        """
+        summary = dict(self.summary(), **(extra or {}))
+        with open(path, 'w') as writer:
+            json.dump(summary, writer, indent=4)
+        return summary
@@ -0,0 +1,204 @@
+"""
+Offline token counting and per-stage prompt budgets.
+
+Stages build their prompts from a fixed part (instructions, entity names) and trimmable parts (context,
+explanations, candidate descriptions). With a budget, the trimmable parts are cut longest-first until the prompt
+fits, so a long AIDA document cannot blow up latency and cost. Token counts of every prompt are reported per
+stage, with the prompts still over the budget (their fixed part alone does not fit).
+
+Tokenizers are pluggable: ``chars`` (about 4 characters per token, no dependency), ``tiktoken`` (exact counts of
+the OpenAI models, ``pip install tiktoken``), or any object with ``count(text)`` and ``truncate(text, max_tokens)``
+registered in TOKENIZERS.
+"""
+import os
+import hashlib
+import tempfile
+import threading
+
+# where tiktoken downloads an encoding from on first use, see tiktoken_cached
+TIKTOKEN_ENCODING_URL = 'https://openaipublic.blob.core.windows.net/encodings/{}.tiktoken'
+
+
+class CharTokenizer:
+    """
+    Dependency-free approximation: one token per 4 characters.
+    """
+    name = 'chars'
+    chars_per_token = 4
+
+    def __init__(self, model=None):
+        pass
+
+    def count(self, text):
+        return (len(text) + self.chars_per_token - 1) // self.chars_per_token
+
+    def truncate(self, text, max_tokens):
+        return text[:max_tokens * self.chars_per_token]
+
+
+class TiktokenTokenizer:
+    """
+    Exact token counts of the OpenAI models.
+    """
+    name = 'tiktoken'
+
+    def __init__(self, model='gpt-3.5-turbo'):
+        try:
+            import tiktoken
+        except ImportError as error:
+            raise ImportError('the tiktoken tokenizer needs tiktoken: pip install tiktoken') from error
+        try:
+            self.encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            self.encoding = tiktoken.get_encoding('cl100k_base')
+
+    def count(self, text):
+        return len(self.encoding.encode(text))
+
+    def truncate(self, text, max_tokens):
+        tokens = self.encoding.encode(text)
+        return text if len(tokens) <= max_tokens else self.encoding.decode(tokens[:max_tokens])
+
+
+TOKENIZERS = {
+    'chars': CharTokenizer,
+    'tiktoken': TiktokenTokenizer,
+}
+
+
+def tiktoken_cached(model='gpt-3.5-turbo'):
+    """
+    Whether tiktoken is installed and the encoding of ``model`` is in its local cache, i.e. loads without a
+    download.
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        return False
+    try:
+        encoding_name = tiktoken.encoding_name_for_model(model)
+    except (KeyError, AttributeError):
+        encoding_name = 'cl100k_base'
+    # the cache directory and file name tiktoken uses, see tiktoken.load.read_file_cached
+    cache_dir = os.environ.get(
+        'TIKTOKEN_CACHE_DIR',
+        os.environ.get('DATA_GYM_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'data-gym-cache')),
+    )
+    if not cache_dir:
+        return False
+    cache_key = hashlib.sha1(TIKTOKEN_ENCODING_URL.format(encoding_name).encode()).hexdigest()
+    return os.path.exists(os.path.join(cache_dir, cache_key))
+
+
+def make_tokenizer(name='auto', model='gpt-3.5-turbo'):
+    """
+    Tokenizer of a name in TOKENIZERS; 'auto' is tiktoken when it is installed and its encoding is cached, chars
+    otherwise, so that counting never downloads anything in offline or mock runs.
+    """
+    if name == 'auto':
+        return TiktokenTokenizer(model) if tiktoken_cached(model) else CharTokenizer(model)
+    if name not in TOKENIZERS:
+        raise ValueError(f'unknown tokenizer {name!r}, expected one of {sorted(TOKENIZERS)}')
+    return TOKENIZERS[name](model)
+
+
+class PromptBudget:
+    """
+    Token budget of the prompts of a stage, with the token accounting of the stage.
+
+    :param max_tokens: maximum prompt tokens, 0 means unlimited (prompts are only counted)
+    :param tokenizer: object with count(text) and truncate(text, max_tokens)
+    """
+
+    def __init__(self, max_tokens=0, tokenizer=None):
+        self.max_tokens = max_tokens
+        self.tokenizer = tokenizer or CharTokenizer()
+        self.prompts = 0
+        self.tokens = 0
+        self.max_prompt_tokens = 0
+        self.trimmed = 0
+        self.over_budget = 0
+        self._warned = False
+        self._lock = threading.Lock()
+
+    def count(self, text):
+        return self.tokenizer.count(text)
+
+    def fit(self, trimmable, fixed=''):
+        """
+        Trim the texts of ``trimmable`` so that, with the ``fixed`` text of the prompt, they fit in the budget.
+        The longest texts are cut first (every text keeps at least as many tokens as the cut ones). Returns the
+        list of (possibly) trimmed texts; when the fixed text alone is over the budget, they are all cut and the
+        prompt is still over it (counted by account).
+        """
+        trimmable = list(trimmable)
+        if not self.max_tokens:
+            return trimmable
+        fixed_tokens = self.count(fixed)
+        if fixed_tokens > self.max_tokens:
+            with self._lock:
+                warn, self._warned = not self._warned, True
+            if warn:
+                print(
+                    f'Warning: the fixed part of a prompt is {fixed_tokens} tokens, over the {self.max_tokens}-token '
+                    f'budget; such prompts are sent over budget'
+                )
+        available = max(0, self.max_tokens - fixed_tokens)
+        lengths = [self.count(text) for text in trimmable]
+        if sum(lengths) <= available:
+            return trimmable
+        # largest per-text cap keeping the sum within the budget
+        cap = 0
+        remaining = available
+        ordered = sorted(lengths)
+        for position, length in enumerate(ordered):
+            share = remaining // (len(ordered) - position)
+            if length > share:
+                cap = share
+                break
+            remaining -= length
+        with self._lock:
+            self.trimmed += 1
+        return [
+            self.tokenizer.truncate(text, cap) if length > cap else text
+            for text, length in zip(trimmable, lengths)
+        ]
+
+    def account(self, prompt):
+        """
+        Count the tokens of a final prompt.
+        """
+        tokens = self.count(prompt)
+        with self._lock:
+            self.prompts += 1
+            self.tokens += tokens
+            self.max_prompt_tokens = max(self.max_prompt_tokens, tokens)
+            if self.max_tokens and tokens > self.max_tokens:
+                self.over_budget += 1
+        return tokens
+
+    def stats(self):
+        with self._lock:
+            return {
+                'tokenizer': self.tokenizer.name,
+                'budget': self.max_tokens,
+                'prompts': self.prompts,
+                'tokens': self.tokens,
+                'mean_tokens': self.tokens / self.prompts if self.prompts else 0.0,
+                'max_tokens': self.max_prompt_tokens,
+                'trimmed': self.trimmed,
+                'over_budget': self.over_budget,
+            }
+
+
+# budget of the prompts of the running stage, see set_prompt_budget
+_prompt_budget = PromptBudget()
+
+
+def set_prompt_budget(prompt_budget):
+    global _prompt_budget
+    _prompt_budget = prompt_budget
+
+
+def get_prompt_budget():
+    return _prompt_budget
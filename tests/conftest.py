@@ -0,0 +1,50 @@
+import openai
+import pytest
+from DeepEL import cascade, openai_async, openai_function, prompt_layout, structured_output, token_budget
+from DeepEL.retry_policy import RetryPolicy
+
+
+@pytest.fixture
+def llm_client(monkeypatch):
+    """
+    LLM client of the tests: no response cache, no coalescing of identical requests, fast retries.
+    Tests needing one of them set it again with monkeypatch.
+    """
+    monkeypatch.setattr(openai_function, '_llm_cache', None)
+    monkeypatch.setattr(openai_function, '_single_flight', None)
+    monkeypatch.setattr(openai_function, '_retry_policy', RetryPolicy(base_delay=0.01, max_delay=0.01))
+
+
+@pytest.fixture
+def llm_config(monkeypatch):
+    """
+    The client state set by configure_llm, and the API settings of the openai module, are restored after the test.
+    """
+    for module in (cascade, openai_async, openai_function, prompt_layout, structured_output, token_budget):
+        for name, value in list(vars(module).items()):
+            if name.startswith('_') and not name.startswith('__') and not callable(value) and name != '_stats_lock':
+                monkeypatch.setattr(module, name, value)
+    for name in ('api_key', 'api_base', 'proxy', 'requestssession'):
+        monkeypatch.setattr(openai, name, getattr(openai, name))
+
+
+@pytest.fixture
+def fake_api(llm_client, monkeypatch):
+    """
+    Answer the chat requests with ``answer(request)`` instead of the API: a reply text, or a whole response.
+
+    Use as ``requests = fake_api(answer)``; ``requests`` lists the requests sent, in order.
+    """
+    requests = []
+
+    def install(answer):
+        def create(request_timeout=None, **request):
+            requests.append(request)
+            response = answer(request)
+            if isinstance(response, str):
+                response = {'choices': [{'message': {'role': 'assistant', 'content': response}}]}
+            return response
+
+        monkeypatch.setattr(openai.ChatCompletion, 'create', staticmethod(create))
+        return requests
+    return install
@@ -0,0 +1,56 @@
+import time
+import threading
+import openai
+from DeepEL import openai_function
+from DeepEL.adaptive_concurrency import AdaptiveConcurrencyLimiter
+from DeepEL.retry_policy import RetryPolicy, RATE_LIMIT, SERVER_ERROR
+from DeepEL.openai_async import openai_chatgpt_batch
+
+
+def test_limit_grows_additively_and_is_cut_once_per_window():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=4, max_limit=8)
+    for _ in range(4):
+        limiter.release(limiter.acquire())
+    assert 4.9 < limiter.limit < 5.1
+
+    # two throttled requests of the same window make a single cut
+    first, second = limiter.acquire(), limiter.acquire()
+    limiter.release(first, RATE_LIMIT)
+    limiter.release(second, RATE_LIMIT)
+    assert int(limiter.limit) == 2
+    assert limiter.stats()['decreases'] == 1
+
+    # server errors are not a sign of congestion
+    limiter.release(limiter.acquire(), SERVER_ERROR)
+    assert int(limiter.limit) == 2
+
+
+def test_throttling_upstream_settles_below_its_capacity(monkeypatch, fake_api):
+    capacity = 3
+    lock = threading.Lock()
+    in_flight = [0]
+
+    def answer(request):
+        with lock:
+            in_flight[0] += 1
+            throttled = in_flight[0] > capacity
+        try:
+            if throttled:
+                raise openai.error.RateLimitError('too many requests', http_status=429)
+            time.sleep(0.01)
+            return 'ok'
+        finally:
+            with lock:
+                in_flight[0] -= 1
+
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=16, max_limit=16)
+    fake_api(answer)
+    monkeypatch.setattr(openai_function, '_retry_policy', RetryPolicy(max_retries=20, base_delay=0.01, max_delay=0.05))
+    monkeypatch.setattr(openai_function, '_concurrency_limiter', limiter)
+
+    results = openai_chatgpt_batch([f'p{index}' for index in range(200)], max_in_flight=16)
+
+    assert results == ['ok'] * 200
+    stats = limiter.stats()
+    assert stats['decreases'] >= 1 and stats['lowest_limit'] <= capacity
+    assert stats['in_flight'] == 0
@@ -0,0 +1,113 @@
+import os
+import json
+import threading
+import openai
+import pytest
+from DeepEL import openai_function
+from DeepEL.llm_cache import LLMCache
+from DeepEL.batch_api import BatchClient, prefill_cache_with_batch_api
+from DeepEL.local_batch_server import make_server
+from DeepEL.openai_async import run_batch_by_document
+from DeepEL.openai_function import openai_chatgpt
+
+
+def fake_responder(line):
+    content = line['body']['messages'][-1]['content']
+    if content == 'fail':
+        return 500, {'error': {'message': 'upstream failed'}}
+    return 200, {'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': 'batch ' + content}}]}
+
+
+@pytest.fixture
+def batch_server():
+    server = make_server(port=0, responder=fake_responder)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(batch_server):
+    return BatchClient(api_base=f'http://127.0.0.1:{batch_server.server_address[1]}/v1', api_key='test')
+
+
+@pytest.fixture
+def llm_cache(tmp_path):
+    cache = LLMCache(str(tmp_path / 'llm_cache.sqlite'))
+    openai_function.set_llm_cache(cache)
+    yield cache
+    openai_function.set_llm_cache(None)
+    cache.close()
+
+
+@pytest.fixture
+def realtime_calls(monkeypatch):
+    calls = []
+
+    def create(**request):
+        content = request['messages'][-1]['content']
+        calls.append(content)
+        return {'choices': [{'message': {'role': 'assistant', 'content': 'realtime ' + content}}]}
+
+    monkeypatch.setattr(openai.ChatCompletion, 'create', staticmethod(create))
+    return calls
+
+
+def test_batch_results_are_folded_back_per_document(tmp_path, client, llm_cache, realtime_calls):
+    doc_name2prompts = {'doc1': ['p1', 'p2'], 'doc2': ['p1', 'fail'], 'doc3': []}
+    prompts = [prompt for doc_prompts in doc_name2prompts.values() for prompt in doc_prompts]
+
+    num_submitted, num_answered = prefill_cache_with_batch_api(
+        openai_chatgpt, prompts, str(tmp_path / 'batch_api'), client=client, poll_interval=0.05,
+    )
+    # the duplicated p1 is submitted once, the failed line is not cached
+    assert (num_submitted, num_answered) == (3, 2)
+    assert realtime_calls == []
+
+    doc_name2results = dict()
+    run_batch_by_document(
+        openai_chatgpt,
+        doc_name2prompts,
+        lambda doc_name, results: doc_name2results.update({doc_name: results}),
+        max_in_flight=4,
+    )
+    assert doc_name2results == {
+        'doc1': ['batch p1', 'batch p2'],
+        'doc2': ['batch p1', 'realtime fail'],
+        'doc3': [],
+    }
+    # only the line the batch could not answer falls back to a real-time call
+    assert realtime_calls == ['fail']
+
+
+def test_dead_batch_is_submitted_again(tmp_path, batch_server, client, llm_cache, realtime_calls):
+    batch_dir = str(tmp_path / 'batch_api')
+    prefill_cache_with_batch_api(openai_chatgpt, ['p1'], batch_dir, client=client, poll_interval=0.05)
+    state_file = [name for name in os.listdir(batch_dir) if name.endswith('.state.json')][0]
+    with open(os.path.join(batch_dir, state_file)) as reader:
+        dead_batch_id = json.load(reader)['batch_id']
+    batch = batch_server.batch_store.batches[dead_batch_id]
+    batch['status'] = 'expired'
+    batch['output_file_id'] = None
+
+    other_cache = LLMCache(str(tmp_path / 'other_cache.sqlite'))
+    openai_function.set_llm_cache(other_cache)
+    num_submitted, num_answered = prefill_cache_with_batch_api(
+        openai_chatgpt, ['p1'], batch_dir, client=client, poll_interval=0.05,
+    )
+    other_cache.close()
+
+    assert (num_submitted, num_answered) == (1, 1)
+    with open(os.path.join(batch_dir, state_file)) as reader:
+        assert json.load(reader)['batch_id'] != dead_batch_id
+
+
+def test_batch_without_any_answer_falls_back_to_realtime_calls(tmp_path, client, llm_cache, realtime_calls):
+    num_submitted, num_answered = prefill_cache_with_batch_api(
+        openai_chatgpt, ['fail'], str(tmp_path / 'batch_api'), client=client, poll_interval=0.05,
+    )
+    assert (num_submitted, num_answered) == (1, 0)
+
+    assert openai_chatgpt('fail') == 'realtime fail'
+    assert realtime_calls == ['fail']
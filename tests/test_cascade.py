@@ -0,0 +1,47 @@
+import math
+from DeepEL.cascade import Cascade
+
+
+def test_only_untrustworthy_answers_are_escalated():
+    cascade = Cascade('fast', min_confidence=0.7, min_margin=0.2, escalate_on_disagreement=True)
+
+    assert cascade.choice_reason('1', num_choices=3) is None
+    assert cascade.choice_reason('It was founded in the year', num_choices=3) == 'malformed'
+    assert cascade.choice_reason('7', num_choices=3) == 'malformed'
+    assert cascade.choice_reason(('{}', {'answer': 1, 'confidence': 0.4}), num_choices=3) == 'low_confidence'
+    assert cascade.choice_reason(('{}', {'answer': 2, 'confidence': 0.9}), num_choices=3) == 'disagreement'
+    assert cascade.choice_reason(('1', [('1', math.log(0.5)), ('2', math.log(0.4))]), num_choices=3) == 'low_confidence'
+    assert cascade.choice_reason(('1', [('1', math.log(0.9)), ('2', math.log(0.05))]), num_choices=3) is None
+
+    assert cascade.verdict_reason('Yes. Both are the capital.') is None
+    assert cascade.verdict_reason('No, but I am not sure.') == 'uncertain'
+    assert cascade.verdict_reason('The entity is the city.') == 'malformed'
+    assert cascade.description_reason("I don't know what Paris refers to here.") == 'uncertain'
+
+
+def test_the_strong_model_is_asked_only_on_escalation():
+    asked = []
+
+    def describe(prompt, model, profile=None):
+        asked.append(model)
+        return '' if prompt == 'hard' else f'{prompt} is a city'
+
+    cascade = Cascade('fast')
+    cascaded = cascade.wrap(describe, lambda prompt, reply: cascade.description_reason(reply))
+
+    assert cascaded('Paris', model='strong', profile='describe') == 'Paris is a city'
+    assert cascaded('hard', model='strong', profile='describe') == ''
+    assert asked == ['fast', 'fast', 'strong']
+    assert cascade.stats() == {
+        'fast_model': 'fast', 'calls': 2, 'escalations': 1, 'escalation_rate': 0.5, 'reasons': {'malformed': 1},
+    }
+
+
+def test_document_descriptions_are_escalated_when_one_is_unsure():
+    cascade = Cascade('fast')
+    answer = {'descriptions': [{'id': 1, 'description': 'Paris is a city'}]}
+    unsure = {'descriptions': [{'id': 1, 'description': 'Paris is a city'}, {'id': 2, 'description': ''}]}
+
+    assert cascade.descriptions_reason(('{}', answer)) is None
+    assert cascade.descriptions_reason(('{}', unsure)) == 'malformed'
+    assert cascade.descriptions_reason(('not json', None)) == 'malformed'
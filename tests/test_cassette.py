@@ -0,0 +1,42 @@
+import time
+import pytest
+from DeepEL import openai_function
+from DeepEL.cassette import Cassette, CassetteMissError, RECORD, REPLAY
+from DeepEL.openai_function import openai_chatgpt
+
+
+@pytest.fixture
+def network(fake_api):
+    calls = []
+
+    def answer(request):
+        content = request['messages'][-1]['content']
+        calls.append(content)
+        time.sleep(0.05)
+        return 'answer to ' + content
+
+    fake_api(answer)
+    yield calls
+    openai_function.set_cassette(None)
+
+
+def test_recorded_run_is_replayed_without_the_network(tmp_path, network):
+    path = str(tmp_path / 'run.cassette')
+    openai_function.set_cassette(Cassette(path, mode=RECORD))
+    assert [openai_chatgpt('p1'), openai_chatgpt('p2')] == ['answer to p1', 'answer to p2']
+    openai_function.get_cassette().close()
+
+    openai_function.set_cassette(Cassette(path, mode=REPLAY))
+    started = time.monotonic()
+    assert [openai_chatgpt('p2'), openai_chatgpt('p1')] == ['answer to p2', 'answer to p1']
+    assert time.monotonic() - started < 0.05
+    assert network == ['p1', 'p2']
+
+    with pytest.raises(CassetteMissError, match='p3'):
+        openai_chatgpt('p3')
+    assert openai_function.get_cassette().stats()['missing'] == 1
+
+    openai_function.set_cassette(Cassette(path, mode=REPLAY, replay_latency=True))
+    started = time.monotonic()
+    openai_chatgpt('p1')
+    assert time.monotonic() - started >= 0.05
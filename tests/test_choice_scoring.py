@@ -0,0 +1,28 @@
+import math
+import pytest
+from DeepEL.choice_scoring import choice_probabilities
+from DeepEL.openai_function import openai_chatgpt_logprobs
+
+
+def test_top_logprobs_become_a_distribution_over_the_candidates():
+    top_logprobs = [('2', math.log(0.6)), (' 1', math.log(0.2)), ('none', math.log(0.1)), ('The', math.log(0.05))]
+
+    probabilities = choice_probabilities(top_logprobs, num_choices=3)
+
+    assert probabilities == pytest.approx([0.1 / 0.9, 0.2 / 0.9, 0.6 / 0.9, 0.0])
+    # out-of-range indices and non-answers only
+    assert choice_probabilities([('7', -0.1), ('Sure', -1.0)], num_choices=3) is None
+
+
+def test_chat_logprobs_are_requested_and_parsed(fake_api):
+    requests = fake_api(lambda request: {'choices': [{
+        'message': {'role': 'assistant', 'content': '2'},
+        'logprobs': {'content': [{'token': '2', 'logprob': -0.1, 'top_logprobs': [
+            {'token': '2', 'logprob': -0.1}, {'token': '1', 'logprob': -2.5},
+        ]}]},
+    }]})
+
+    reply, top_logprobs = openai_chatgpt_logprobs('Which one? Answer with the number only.')
+
+    assert (reply, top_logprobs) == ('2', [('2', -0.1), ('1', -2.5)])
+    assert (requests[0]['max_tokens'], requests[0]['logprobs'], requests[0]['top_logprobs']) == (1, True, 20)
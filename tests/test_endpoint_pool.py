@@ -0,0 +1,47 @@
+import openai
+import pytest
+from DeepEL import openai_function
+from DeepEL.endpoint_pool import Endpoint, EndpointPool
+from DeepEL.openai_async import openai_chatgpt_batch
+
+
+@pytest.fixture
+def routed_api(fake_api):
+    calls = []
+
+    def answer(request):
+        calls.append(request['api_base'])
+        if request['api_base'] == 'http://down/v1':
+            raise openai.error.APIError('bad gateway', http_status=502)
+        return request['api_key']
+
+    fake_api(answer)
+    return calls
+
+
+def test_requests_fail_over_to_the_healthy_endpoint(monkeypatch, routed_api):
+    pool = EndpointPool(
+        [Endpoint('http://down/v1', 'key-down'), Endpoint('http://up/v1', 'key-up')],
+        failure_threshold=2,
+    )
+    monkeypatch.setattr(openai_function, '_endpoint_pool', pool)
+
+    results = openai_chatgpt_batch([f'p{index}' for index in range(20)], max_in_flight=1)
+
+    assert results == ['key-up'] * 20
+    down, up = pool.stats()
+    # the failing endpoint is ejected after two errors and gets no further traffic
+    assert (down['failures'], down['ejections'], down['healthy']) == (2, 1, False)
+    assert routed_api.count('http://down/v1') == 2
+    assert up['requests'] == 20 and up['failures'] == 0
+    assert all(endpoint.outstanding == 0 for endpoint in pool.endpoints)
+
+
+def test_outstanding_requests_follow_the_weights():
+    heavy, light = Endpoint('http://heavy/v1', 'a', weight=3), Endpoint('http://light/v1', 'b', weight=1)
+    pool = EndpointPool([heavy, light])
+
+    for _ in range(8):
+        pool.acquire()
+
+    assert (heavy.outstanding, light.outstanding) == (6, 2)
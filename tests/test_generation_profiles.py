@@ -0,0 +1,41 @@
+import json
+import pytest
+from DeepEL import generation_profiles
+from DeepEL.generation_profiles import load_generation_profiles
+from DeepEL.llm_cache import request_key
+from DeepEL.openai_function import chatgpt_request, completion_request
+
+
+def test_profiles_shape_the_request():
+    _, request = chatgpt_request('which one?', profile='choice')
+    assert (request['max_tokens'], request['temperature']) == (16, 0)
+
+    _, request = chatgpt_request('what is it?', profile='describe')
+    assert 'max_tokens' not in request
+
+    _, request = completion_request('what is it?')
+    assert request['max_tokens'] == generation_profiles.DEFAULT_COMPLETION_MAX_TOKENS
+
+    with pytest.raises(ValueError):
+        chatgpt_request('which one?', profile='unknown')
+
+
+def test_profiles_can_be_overridden_from_a_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(generation_profiles, 'GENERATION_PROFILES', {'choice': {'max_tokens': 16}})
+    profiles_file = tmp_path / 'profiles.json'
+    profiles_file.write_text(json.dumps({'choice': {'max_tokens': 4, 'stop': ['\n']}}))
+
+    load_generation_profiles(str(profiles_file))
+
+    _, request = chatgpt_request('which one?', profile='choice')
+    assert (request['max_tokens'], request['stop']) == (4, ['\n'])
+    # answers cached under another profile are not reused
+    assert request_key('ChatCompletion', request) != request_key('ChatCompletion', chatgpt_request('which one?')[1])
+
+
+def test_capped_descriptions_stop_early(monkeypatch):
+    monkeypatch.setitem(generation_profiles.GENERATION_PROFILES, 'short_describe', {'stop': ['\n\n'], 'max_tokens': 45})
+
+    _, request = chatgpt_request('What does Paris refer to? Answer in at most 150 characters.', profile='short_describe')
+
+    assert (request['max_tokens'], request['stop']) == (45, ['\n\n'])
@@ -0,0 +1,85 @@
+import time
+import threading
+from DeepEL import openai_function
+from DeepEL.hedging import Hedging
+from DeepEL.telemetry import Telemetry
+from DeepEL.openai_function import openai_chatgpt
+
+
+def test_slow_call_is_answered_by_its_hedge(monkeypatch, fake_api):
+    lock = threading.Lock()
+    attempts = []
+
+    def answer(request):
+        content = request['messages'][-1]['content']
+        with lock:
+            attempts.append(content)
+            first_attempt = attempts.count(content) == 1
+        time.sleep(2 if content == 'slow' and first_attempt else 0.01)
+        return 'answer to ' + content
+
+    hedging = Hedging(percentile=90, max_hedge_rate=0.5, min_samples=10)
+    telemetry = Telemetry(stage='test')
+    fake_api(answer)
+    monkeypatch.setattr(openai_function, '_hedging', hedging)
+    monkeypatch.setattr(openai_function, '_telemetry', telemetry)
+
+    for index in range(10):
+        openai_chatgpt(f'p{index}')
+    started = time.monotonic()
+    assert openai_chatgpt('slow') == 'answer to slow'
+
+    assert time.monotonic() - started < 1
+    assert attempts.count('slow') == 2
+    assert hedging.stats()['hedges'] == 1 and hedging.stats()['hedge_wins'] == 1
+    # the two copies are one attempt of one call
+    stats = telemetry.summary()['models']['gpt-3.5-turbo']
+    assert (stats['calls'], stats['network_calls'], stats['retries']) == (11, 11, 0)
+    hedging.shutdown()
+
+
+class SlowRateLimiter:
+    """
+    Rate limiter making the request of one prompt wait.
+    """
+
+    def __init__(self):
+        self.throttled = False
+
+    def acquire(self, model, tokens):
+        if self.throttled:
+            time.sleep(0.3)
+        return 0.0
+
+    def reconcile(self, model, estimated_tokens, used_tokens):
+        pass
+
+
+def test_waiting_on_the_rate_limiter_is_not_hedged(monkeypatch, fake_api):
+    hedging = Hedging(percentile=90, max_hedge_rate=0.5, min_samples=10)
+    rate_limiter = SlowRateLimiter()
+    attempts = fake_api(lambda request: 'ok')
+    monkeypatch.setattr(openai_function, '_hedging', hedging)
+    monkeypatch.setattr(openai_function, '_rate_limiter', rate_limiter)
+
+    for index in range(10):
+        openai_chatgpt(f'p{index}')
+    rate_limiter.throttled = True
+    assert openai_chatgpt('throttled') == 'ok'
+
+    assert len(attempts) == 11
+    assert hedging.stats()['hedges'] == 0
+    # the latencies the threshold is computed on are those of the requests alone
+    assert hedging.threshold() < 0.3
+    hedging.shutdown()
+
+
+def test_hedges_are_capped():
+    hedging = Hedging(percentile=50, max_hedge_rate=0.1, min_samples=1)
+    hedging.call(lambda: time.sleep(0.01))
+    for _ in range(5):
+        hedging.call(lambda: time.sleep(0.05))
+
+    # 6 calls allow no hedge at a 10% rate
+    assert hedging.stats()['hedges'] == 0
+    hedging.shutdown()
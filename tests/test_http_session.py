@@ -0,0 +1,64 @@
+import argparse
+import pytest
+import openai
+import requests
+from DeepEL import openai_function
+from DeepEL.http_session import PooledSession
+from DeepEL.llm_config import add_llm_arguments, configure_llm
+
+
+@pytest.fixture
+def configure(llm_config):
+    """
+    configure_llm on the given options; the client state it sets is restored after the test.
+    """
+    def configure(*options):
+        parser = argparse.ArgumentParser()
+        add_llm_arguments(parser)
+        args = parser.parse_args(['--llm_cache', ''] + list(options))
+        configure_llm(args)
+        return args
+    return configure
+
+
+def test_the_pooled_session_is_installed(configure):
+    configure('--max_in_flight', '8')
+
+    session = openai.requestssession
+    adapter = session.get_adapter('https://api.openai.com/v1')
+    assert isinstance(session, PooledSession)
+    assert adapter._pool_maxsize == 8 and adapter._pool_block
+    assert session.get_adapter('http://localhost:8000/v1') is adapter
+
+    configure('--max_in_flight', '8', '--http_pool_size', '20')
+    assert openai.requestssession.get_adapter('https://api.openai.com/v1')._pool_maxsize == 20
+
+
+def test_the_pool_has_room_for_the_hedges(configure):
+    configure('--max_in_flight', '8', '--hedge_percentile', '95')
+
+    assert openai.requestssession.get_adapter('https://api.openai.com/v1')._pool_maxsize == 16
+    openai_function.get_hedging().shutdown()
+
+
+def test_the_pooled_session_keeps_openai_proxy(configure, monkeypatch):
+    monkeypatch.setattr(openai, 'proxy', 'http://proxy.local:3128')
+    configure()
+
+    assert openai.requestssession.proxies == {'http': 'http://proxy.local:3128', 'https': 'http://proxy.local:3128'}
+
+    monkeypatch.setattr(openai, 'proxy', {'https': 'http://secure.local:3128'})
+    configure()
+    assert openai.requestssession.proxies == {'https': 'http://secure.local:3128'}
+
+
+def test_the_connect_timeout_is_kept_apart_from_the_read_timeout(monkeypatch):
+    sent = dict()
+    session = PooledSession(connect_timeout=3)
+    monkeypatch.setattr(requests.Session, 'request', lambda self, method, url, **kwargs: sent.update(kwargs))
+
+    session.request('POST', 'https://api.openai.com/v1/chat/completions', timeout=60)
+    assert sent['timeout'] == (3, 60)
+    # the legacy client closing its sessions does not drop the shared pool
+    session.close()
+    assert session.adapters
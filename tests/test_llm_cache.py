@@ -0,0 +1,69 @@
+import itertools
+import pytest
+from DeepEL import llm_cache
+from DeepEL.llm_cache import LLMCache, request_key
+
+RESPONSE = {'choices': [{'message': {'role': 'assistant', 'content': 'x' * 100}}]}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # every access gets a later timestamp, so that the LRU order does not depend on the resolution of the clock
+    ticks = itertools.count(1)
+    monkeypatch.setattr(llm_cache.time, 'time', lambda: float(next(ticks)))
+
+
+def test_request_key_ignores_key_order_and_transport_params():
+    request = {'model': 'gpt-4', 'messages': [{'role': 'user', 'content': 'Paris?'}], 'temperature': 0}
+    reordered = {'temperature': 0, 'request_timeout': 30, 'messages': request['messages'], 'model': 'gpt-4'}
+
+    assert request_key('ChatCompletion', request) == request_key('ChatCompletion', reordered)
+    assert request_key('ChatCompletion', request) != request_key('Completion', request)
+    assert request_key('ChatCompletion', request) != request_key('ChatCompletion', dict(request, temperature=1))
+
+
+def test_responses_are_stored_and_counted(tmp_path):
+    cache = LLMCache(str(tmp_path / 'cache.sqlite'))
+
+    assert cache.get('a') is None
+    cache.put('a', RESPONSE)
+
+    assert cache.contains('a') and not cache.contains('b')
+    assert cache.get('a') == RESPONSE
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+    cache.close()
+    assert LLMCache(str(tmp_path / 'cache.sqlite')).get('a') == RESPONSE
+
+
+def test_bypass_skips_lookups_but_stores(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    cache = LLMCache(path, bypass=True)
+    cache.put('a', RESPONSE)
+
+    assert cache.get('a') is None
+    assert cache.contains('a')
+    assert cache.stats()['misses'] == 1
+    assert LLMCache(path).get('a') == RESPONSE
+
+
+def test_least_recently_used_entries_are_evicted_beyond_the_size_cap(tmp_path, clock):
+    size = len(llm_cache.json.dumps(RESPONSE).encode('utf-8'))
+    cache = LLMCache(str(tmp_path / 'cache.sqlite'), max_size_mb=3.5 * size / (1024 * 1024))
+    for key in 'abc':
+        cache.put(key, RESPONSE)
+    # reading 'a' makes 'b' the least recently used entry
+    cache.get('a')
+    cache.put('d', RESPONSE)
+
+    assert not cache.contains('b')
+    assert all(cache.contains(key) for key in 'acd')
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['size_mb'] * 1024 * 1024 <= cache.max_size
+
+
+def test_replacing_an_entry_does_not_count_its_size_twice(tmp_path):
+    cache = LLMCache(str(tmp_path / 'cache.sqlite'))
+    cache.put('a', RESPONSE)
+    cache.put('a', RESPONSE)
+
+    assert cache.stats()['size_mb'] * 1024 * 1024 == len(llm_cache.json.dumps(RESPONSE).encode('utf-8'))
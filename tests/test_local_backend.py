@@ -0,0 +1,57 @@
+import threading
+import pytest
+from DeepEL import openai_function
+from DeepEL.llm_cache import LLMCache, request_key
+from DeepEL.local_backend import LocalBackend, _openai_response
+from DeepEL.openai_async import openai_chatgpt_batch
+
+
+class FakeEngine:
+    name = 'fake-model'
+
+    def __init__(self):
+        self.batches = []
+        self.release = threading.Event()
+
+    def generate(self, kind, requests):
+        # hold the first batch until the test has queued the others
+        self.release.wait()
+        prompts = [request['messages'][-1]['content'] for request in requests]
+        self.batches.append(prompts)
+        return [_openai_response(kind, self.name, 'local ' + prompt, 1, 1, 'stop') for prompt in prompts]
+
+
+@pytest.fixture
+def local_backend(monkeypatch, llm_client):
+    engine = FakeEngine()
+    backend = LocalBackend(engine, max_batch_size=4)
+    monkeypatch.setattr(openai_function, '_llm_backend', backend)
+    return backend
+
+
+def test_concurrent_requests_are_generated_in_batches(local_backend):
+    engine = local_backend.engine
+    threading.Timer(0.2, engine.release.set).start()
+
+    results = openai_chatgpt_batch(['b', 'a', 'd', 'c', 'e'], max_in_flight=8, profile='choice')
+
+    assert results == ['local b', 'local a', 'local d', 'local c', 'local e']
+    assert sum(len(batch) for batch in engine.batches) == 5
+    assert max(len(batch) for batch in engine.batches) <= 4 and len(engine.batches) < 5
+    # prompts of a batch are sorted so that shared prefixes are adjacent
+    assert all(batch == sorted(batch) for batch in engine.batches)
+    assert local_backend.stats()['requests'] == 5
+
+
+def test_local_answers_are_cached_apart_from_the_api(local_backend, tmp_path):
+    cache = LLMCache(str(tmp_path / 'llm_cache.sqlite'))
+    openai_function.set_llm_cache(cache)
+    local_backend.engine.release.set()
+    try:
+        openai_function.openai_chatgpt('p1')
+        openai_function.set_llm_backend(None)
+        api, request = openai_function.chatgpt_request('p1')
+        assert not cache.contains(request_key(api.__name__, request))
+    finally:
+        openai_function.set_llm_cache(None)
+        cache.close()
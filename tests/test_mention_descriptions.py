@@ -0,0 +1,96 @@
+import importlib
+import json
+import re
+import sys
+import jsonlines
+import pytest
+from DeepEL.mention_descriptions import describe_mentions, mention_signature, mentions_prompt, split_sections
+from DeepEL.structured_output import parse_structured
+
+
+def test_long_documents_are_split_at_mention_boundaries():
+    sentence = 'Washington met Paris officials. ' + 'x' * 100 + ' Later Berlin replied.'
+    starts = [sentence.index(name) for name in ('Berlin', 'Washington', 'Paris')]
+    ends = [start + len(name) for start, name in zip(starts, ('Berlin', 'Washington', 'Paris'))]
+
+    sections = split_sections(sentence, starts, ends, context_characters=10, max_characters=60)
+
+    assert [indices for _, _, indices in sections] == [[1, 2], [0]]
+    assert sentence[sections[1][0]:sections[1][1]] == 'xxx Later Berlin replied.'
+
+
+def test_only_the_missing_mentions_are_asked_again():
+    blocks = [('Washington met Paris officials in Berlin.', [(0, 0, 10), (1, 15, 20), (2, 34, 40)])]
+    prompts = []
+    replies = iter([
+        '{"descriptions": [{"id": 0, "description": "The US government."}, {"id": 2, "description": " "}]}',
+        '{"descriptions": [{"id": 1, "description": "The French government."}, {"id": 2, "description": "Germany."}]}',
+    ])
+
+    def ask(prompt):
+        prompts.append(prompt)
+        reply = next(replies)
+        return reply, parse_structured('descriptions', reply)
+
+    descriptions = describe_mentions(blocks, ask, max_reasks=1)
+
+    assert descriptions == {0: 'The US government.', 1: 'The French government.', 2: 'Germany.'}
+    assert prompts[0].startswith('[Washington](#0) met [Paris](#1) officials in [Berlin](#2).')
+    assert prompts[1] == mentions_prompt(blocks, asked=[1, 2])
+    assert '#0: Washington' not in prompts[1] and '#2: Berlin' in prompts[1]
+
+
+@pytest.fixture
+def chat_change(llm_config, fake_api, monkeypatch):
+    """
+    Run Chat_change on the given documents and options against the fake API: (output, requests sent).
+    """
+    # the stage script sets the API key and base of the openai module when imported
+    module = importlib.import_module('DeepEL.DeepEL_codes.Change_sentence.Chat_change')
+
+    def run(tmp_path, documents, *options):
+        with jsonlines.open(tmp_path / 'input.jsonl', 'w') as writer:
+            for doc_name, (sentence, mentions) in documents.items():
+                starts = [sentence.index(mention) for mention in mentions]
+                writer.write({'doc_name': doc_name, 'sentence': sentence, 'entities': {
+                    'entity_mentions': mentions, 'starts': starts,
+                    'ends': [start + len(mention) for start, mention in zip(starts, mentions)],
+                }})
+
+        def describe(request):
+            prompt = request['messages'][-1]['content']
+            return json.dumps({'descriptions': [
+                {'id': int(item_id), 'description': f'{mention} as described in request {len(requests)}'}
+                for item_id, mention in re.findall(r'^#(\d+): (.+)$', prompt, re.M)
+            ]})
+
+        requests = fake_api(describe)
+        monkeypatch.setattr(sys, 'argv', [
+            'Chat_change.py', '--mode', 'jsonl', '--input_file', str(tmp_path / 'input.jsonl'),
+            '--output_dir', str(tmp_path), '--output_file', 'output.json', '--llm_cache', '', *options,
+        ])
+        module.main()
+        with open(tmp_path / 'output.json') as reader:
+            return json.load(reader), requests
+    return run
+
+
+def test_boilerplate_mentions_are_described_once_for_the_corpus(chat_change, tmp_path):
+    documents = {
+        'doc0': ('WASHINGTON  1996-08-22 (Reuters) - The talks resumed in Paris.', ['WASHINGTON', 'Paris']),
+        'doc1': ('Washington 1997-01-03 (Reuters) - The talks resumed in Berlin.', ['Washington', 'Berlin']),
+        'doc2': ('Washington 1997-01-04 (Reuters) - The talks resumed.', ['Washington']),
+    }
+
+    output, requests = chat_change(
+        tmp_path, documents, '--describe_mode', 'document', '--dedup_mentions', '--dedup_context_characters', '20',
+    )
+
+    # the dateline is asked in the first document only, and the last document needs no request
+    prompts = [request['messages'][-1]['content'] for request in requests]
+    assert len(prompts) == 2
+    assert [len(re.findall(r'^#\d+: Washington$', prompt, re.M | re.I)) for prompt in prompts] in ([1, 0], [0, 1])
+    shared = output['doc0']['entities']['prompt_results'][0]
+    assert shared.startswith('WASHINGTON as described')
+    assert [output[doc_name]['entities']['prompt_results'][0] for doc_name in ('doc1', 'doc2')] == [shared, shared]
+    assert output['doc1']['entities']['prompt_results'][1].startswith('Berlin')
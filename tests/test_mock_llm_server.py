@@ -0,0 +1,35 @@
+import threading
+import openai
+import pytest
+from DeepEL import openai_function
+from DeepEL.mock_llm_server import MockLLM, make_server
+from DeepEL.retry_policy import RetryPolicy
+from DeepEL.openai_async import openai_chatgpt_batch
+
+
+@pytest.fixture
+def mock_api(monkeypatch, llm_client):
+    mock = MockLLM(seed=7, latency='uniform:0,0.01', rate_limit_rate=0.2, server_error_rate=0.1, retry_after=0.01)
+    server = make_server(port=0, mock=mock)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(openai, 'api_base', f'http://127.0.0.1:{server.server_address[1]}/v1')
+    monkeypatch.setattr(openai, 'api_key', 'test')
+    monkeypatch.setattr(openai_function, '_retry_policy', RetryPolicy(max_retries=20, base_delay=0.01, max_delay=0.02))
+    yield mock
+    server.shutdown()
+    server.server_close()
+
+
+def test_answers_are_deterministic_under_injected_faults(mock_api):
+    prompts = ['Which of the following entities is Paris in this sentence?', 'Where is Paris?'] * 10
+
+    results = openai_chatgpt_batch(prompts, max_in_flight=8)
+
+    assert results[0] == '1'
+    assert results == [results[0], results[1]] * 10
+    assert MockLLM(seed=7).reply('Where is Paris?') == results[1]
+    # every injected 429 and 500 was retried
+    counts = mock_api.counts
+    assert counts['rate_limited'] + counts['server_errors'] > 0
+    assert counts['requests'] == 20 + counts['rate_limited'] + counts['server_errors']
+    assert openai_function.get_retry_policy().stats()['retries'] == counts['rate_limited'] + counts['server_errors']
@@ -0,0 +1,77 @@
+import random
+import threading
+import time
+import pytest
+from DeepEL import openai_async
+from DeepEL.openai_async import run_batch, run_batch_by_document
+
+
+def test_longest_documents_are_dispatched_first(monkeypatch):
+    doc_name2prompts = {
+        'short': ['Paris?'],
+        'giant': ['Washington met Paris officials in Berlin. ' * 20] * 3,
+        'medium': ['Washington met Paris officials in Berlin.'],
+    }
+    dispatched = []
+    completed = []
+
+    def answer(prompt):
+        dispatched.append(prompt)
+        return len(prompt)
+
+    def on_document(doc_name, results):
+        completed.append(doc_name)
+
+    monkeypatch.setattr(openai_async, '_schedule', 'longest_first')
+    run_batch_by_document(answer, doc_name2prompts, on_document, max_in_flight=1)
+
+    assert dispatched == doc_name2prompts['giant'] + doc_name2prompts['medium'] + doc_name2prompts['short']
+    assert completed == ['giant', 'medium', 'short']
+
+    dispatched.clear()
+    monkeypatch.setattr(openai_async, '_schedule', 'document_order')
+    run_batch_by_document(answer, doc_name2prompts, on_document, max_in_flight=1)
+    assert dispatched[0] == 'Paris?'
+
+
+def test_results_keep_the_order_of_the_prompts():
+    def answer(prompt):
+        time.sleep(random.random() / 100)
+        return prompt * 2
+
+    prompts = list(range(40))
+    completed = []
+    results = run_batch(answer, prompts, max_in_flight=8, on_result=lambda index, result: completed.append(index))
+
+    assert results == [prompt * 2 for prompt in prompts]
+    assert sorted(completed) == prompts
+
+
+def test_at_most_max_in_flight_calls_run_at_once():
+    lock = threading.Lock()
+    running = {'now': 0, 'most': 0}
+
+    def answer(prompt):
+        with lock:
+            running['now'] += 1
+            running['most'] = max(running['most'], running['now'])
+        time.sleep(0.01)
+        with lock:
+            running['now'] -= 1
+        return prompt
+
+    run_batch(answer, range(30), max_in_flight=3)
+
+    assert running['most'] == 3
+
+
+def test_an_error_of_one_call_propagates():
+    def answer(prompt):
+        if prompt == 5:
+            raise RuntimeError('the request failed')
+        return prompt
+
+    with pytest.raises(RuntimeError, match='the request failed'):
+        run_batch(answer, range(10), max_in_flight=4)
+    with pytest.raises(ValueError):
+        run_batch(answer, range(10), max_in_flight=0)
@@ -0,0 +1,28 @@
+import json
+from DeepEL import prompt_layout
+from DeepEL.llm_cache import request_key
+from DeepEL.openai_function import chatgpt_request
+from DeepEL.prompt_layout import LayeredPrompt
+
+
+def test_layered_prompts_share_their_system_prefix(monkeypatch):
+    document = 'Original sentence: Washington met Paris officials.\n'
+    prompts = [LayeredPrompt(document, f'Is {entity} right?') for entity in ('Washington', 'Paris')]
+
+    requests = [chatgpt_request(prompt, role='user')[1] for prompt in prompts]
+
+    assert [request['messages'][0] for request in requests] == [{'role': 'system', 'content': document}] * 2
+    assert requests[1]['messages'][1] == {'role': 'user', 'content': 'Is Paris right?'}
+    assert 'prompt_cache_key' not in requests[0]
+    # stages keep storing the whole prompt as a string
+    assert json.loads(json.dumps(prompts[0])) == document + 'Is Washington right?'
+
+    monkeypatch.setattr(prompt_layout, '_prompt_cache_keys', True)
+    tagged = [chatgpt_request(prompt, role='user')[1] for prompt in prompts]
+    assert tagged[0]['prompt_cache_key'] == tagged[1]['prompt_cache_key']
+    assert request_key('ChatCompletion', tagged[0]) == request_key('ChatCompletion', requests[0])
+
+
+def test_plain_prompts_are_sent_as_before():
+    _, request = chatgpt_request('What does Paris refer to?')
+    assert request['messages'] == [{'role': 'system', 'content': 'What does Paris refer to?'}]
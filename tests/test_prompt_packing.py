@@ -0,0 +1,81 @@
+import json
+from DeepEL import openai_async, openai_function
+from DeepEL.openai_async import run_batch_by_document
+from DeepEL.prompt_packing import ask_packed, pack_prompts, packed_profile, packed_prompt
+from DeepEL.structured_output import parse_structured
+
+
+def test_prompts_are_packed_up_to_the_token_budget():
+    prompts = ['What is Paris?', 'What is Berlin?', 'Washington met Paris officials in Berlin. ' * 10, 'Rome?']
+
+    packs = pack_prompts(prompts, max_tokens=20)
+
+    assert packs == [[0, 1], [2], [3]]
+    assert pack_prompts(prompts[:2] * 3, max_tokens=1000, max_items=4) == [[0, 1, 2, 3], [4, 5]]
+
+
+def test_packed_requests_have_room_for_every_answer():
+    assert packed_profile('choice', 3) == {'max_tokens': 3 * (16 + 16), 'temperature': 0}
+    assert packed_profile('short_describe', 3) == {}
+    assert packed_profile(None, 3) == {}
+
+
+def test_only_the_missing_answers_are_asked_again():
+    prompts = ['What is Paris?', 'What is Berlin?', 'What is Rome?']
+    asked = []
+    replies = iter([
+        '{"answers": [{"id": 1, "answer": "The capital of France."}, {"id": 3, "answer": " "}]}',
+        '{"answers": [{"id": 2, "answer": "The capital of Germany."}]}',
+    ])
+
+    def ask(prompt, profile):
+        asked.append(prompt)
+        reply = next(replies)
+        return reply, parse_structured('answers', reply)
+
+    answers = ask_packed(prompts, ask, lambda prompt: 'alone: ' + prompt, max_reasks=1)
+
+    assert answers == ['The capital of France.', 'The capital of Germany.', 'alone: What is Rome?']
+    assert asked[0] == packed_prompt(prompts, [1, 2, 3])
+    assert asked[1] == packed_prompt(prompts[1:], [2, 3])
+
+
+def test_documents_share_packed_requests(monkeypatch):
+    doc_name2prompts = {'first': ['What is Paris?', 'What is Berlin?'], 'second': ['What is Rome?']}
+    requests = []
+
+    def structured(prompt, schema, **kwargs):
+        requests.append(prompt)
+        questions = prompt.split('### Question ')[1:]
+        reply = json.dumps({'answers': [
+            {'id': int(question.split('\n')[0]), 'answer': question.split('\n')[1].upper()} for question in questions
+        ]})
+        return reply, parse_structured(schema, reply)
+
+    monkeypatch.setattr(openai_async, 'openai_chatgpt_structured', structured)
+    monkeypatch.setattr(openai_async, '_pack_tokens', 1000)
+    results = dict()
+    calls = run_batch_by_document(
+        openai_function.openai_chatgpt, doc_name2prompts, lambda doc_name, answers: results.update({doc_name: answers}),
+    )
+
+    assert calls == 1 and len(requests) == 1
+    assert results == {'first': ['WHAT IS PARIS?', 'WHAT IS BERLIN?'], 'second': ['WHAT IS ROME?']}
+
+
+def test_prompts_that_cannot_be_packed_are_sent_alone_with_a_warning(monkeypatch, capsys):
+    monkeypatch.setattr(openai_async, '_pack_tokens', 1000)
+    asked = []
+
+    def structured(prompt, **kwargs):
+        asked.append(prompt)
+        return prompt, None
+
+    results = dict()
+    calls = run_batch_by_document(
+        structured, {'first': ['What is Paris?', 'What is Berlin?']},
+        lambda doc_name, answers: results.update({doc_name: answers}),
+    )
+
+    assert calls == 2 and asked == ['What is Paris?', 'What is Berlin?']
+    assert 'Warning: --pack_tokens only packs the free-text chat prompts' in capsys.readouterr().out
@@ -0,0 +1,94 @@
+import threading
+import pytest
+from DeepEL import rate_limiter
+from DeepEL.rate_limiter import RateLimiter, TokenBucket
+
+
+class FakeTime:
+    """
+    Clock of the rate limiter: sleeping moves it forward instead of waiting.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self._lock = threading.Lock()
+
+    def monotonic(self):
+        with self._lock:
+            return self.now
+
+    def sleep(self, seconds):
+        with self._lock:
+            self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(rate_limiter, 'time', clock)
+    return clock
+
+
+def test_the_bucket_refills_at_its_rate(clock):
+    bucket = TokenBucket(60)
+
+    assert bucket.acquire(60) == 0
+    # one token per second
+    assert bucket.acquire(3) == pytest.approx(3)
+    clock.now += 30
+    assert bucket.acquire(30) == 0
+    # never more than the capacity, however long it stayed unused
+    clock.now += 3600
+    assert bucket.acquire(61) == 0
+    assert bucket.acquire(1) == pytest.approx(1)
+
+
+def test_a_request_larger_than_the_bucket_waits_for_a_full_bucket(clock):
+    bucket = TokenBucket(600)
+    bucket.acquire(600)
+
+    assert bucket.acquire(10000) == pytest.approx(60)
+
+
+def test_rpm_and_tpm_are_enforced_separately(clock):
+    limiter = RateLimiter({'gpt-4': {'rpm': 2, 'tpm': 1000}, '*': {'tpm': 60}})
+
+    # the token budget of gpt-4 is not the limit, its number of requests is
+    assert limiter.acquire('gpt-4', 10) == 0
+    assert limiter.acquire('gpt-4', 10) == 0
+    assert limiter.acquire('gpt-4', 10) == pytest.approx(30)
+    # other models only have a token budget
+    assert limiter.acquire('gpt-3.5-turbo', 60) == 0
+    assert limiter.acquire('gpt-3.5-turbo', 30) == pytest.approx(30)
+    assert RateLimiter({}).acquire('gpt-4', 10 ** 6) == 0
+
+
+def test_reconcile_gives_back_the_unused_tokens(clock):
+    limiter = RateLimiter({'*': {'tpm': 600}})
+    limiter.acquire('gpt-4', 600)
+    limiter.reconcile('gpt-4', 600, 100)
+
+    assert limiter.acquire('gpt-4', 500) == 0
+
+
+def test_every_waiting_thread_gets_through_at_the_rate(clock):
+    bucket = TokenBucket(60, capacity=2)
+    granted = []
+    lock = threading.Lock()
+
+    def worker():
+        bucket.acquire(1)
+        with lock:
+            granted.append(clock.monotonic())
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+
+    assert not any(thread.is_alive() for thread in threads)
+    assert len(granted) == 8
+    # two at once from the full bucket, then one more per second at most
+    for position, at in enumerate(sorted(granted)):
+        assert at >= position - 2 - 1e-9
@@ -0,0 +1,36 @@
+import importlib
+import openai
+import pytest
+
+
+@pytest.fixture
+def reselect(monkeypatch):
+    # the stage script sets the API key and base of the openai module when imported
+    monkeypatch.setattr(openai, 'api_key', openai.api_key)
+    monkeypatch.setattr(openai, 'api_base', openai.api_base)
+    return importlib.import_module('DeepEL.DeepEL_codes.Reselect.Reselect_after_validation')
+
+
+def test_structured_reselections_keep_their_confidence(reselect):
+    # the initial choice was not structured: there are no confidences yet
+    entities = {'multi_choice_prompts': ['p0', 'p1', 'p2'], 'multi_choice_prompt_results': ['1', '2', '1']}
+    validation = {'entity': 'Paris', 'validation_result': 'No'}
+
+    reselect.save_reselections(
+        entities, [(validation, 1, 'new p1')], [('{"answer": 3, "confidence": 0.9}', {'answer': 3, 'confidence': 0.9})],
+        structured=True,
+    )
+
+    assert entities['multi_choice_prompt_results'] == ['1', '3', '1']
+    assert entities['multi_choice_prompts'] == ['p0', 'new p1', 'p2']
+    assert entities['multi_choice_confidences'] == [None, 0.9, None]
+    assert validation['validation_result'] == 'Yes'
+
+
+def test_free_text_reselections_add_no_confidences(reselect):
+    entities = {'multi_choice_prompts': ['p0'], 'multi_choice_prompt_results': ['1']}
+
+    reselect.save_reselections(entities, [({'entity': 'Paris'}, 0, 'new p0')], ['2'])
+
+    assert entities['multi_choice_prompt_results'] == ['2']
+    assert 'multi_choice_confidences' not in entities
@@ -0,0 +1,141 @@
+import pytest
+import openai
+from DeepEL import retry_policy
+from DeepEL.retry_policy import RetryPolicy, classify_error, retry_after_seconds
+
+
+class FakeTime:
+    """
+    Clock of the retry policy: sleeping moves it forward and is recorded instead of waiting.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(retry_policy, 'time', clock)
+    return clock
+
+
+def failing(*errors, result='ok'):
+    """
+    Function of RetryPolicy.call raising ``errors`` one after the other, then returning ``result``.
+    """
+    errors = list(errors)
+    timeouts = []
+
+    def function(timeout):
+        timeouts.append(timeout)
+        if errors:
+            raise errors.pop(0)
+        return result
+    function.timeouts = timeouts
+    return function
+
+
+def rate_limit(retry_after=None):
+    return openai.error.RateLimitError(
+        'slow down', http_status=429, headers={'retry-after': retry_after} if retry_after else {}
+    )
+
+
+def test_errors_are_classified():
+    assert classify_error(rate_limit()) == retry_policy.RATE_LIMIT
+    assert classify_error(openai.error.Timeout('slow')) == retry_policy.TIMEOUT
+    assert classify_error(openai.error.APIConnectionError('reset')) == retry_policy.CONNECTION
+    assert classify_error(openai.error.ServiceUnavailableError('busy')) == retry_policy.SERVER_ERROR
+    assert classify_error(openai.error.APIError('bad gateway', http_status=502)) == retry_policy.SERVER_ERROR
+    assert classify_error(openai.error.InvalidRequestError('too long', 'messages')) == retry_policy.BAD_REQUEST
+    assert classify_error(openai.error.AuthenticationError('no key')) == retry_policy.AUTHENTICATION
+    assert classify_error(KeyError('choices')) == retry_policy.UNKNOWN
+
+
+def test_retry_after_headers():
+    assert retry_after_seconds(rate_limit('7')) == 7
+    assert retry_after_seconds(openai.error.RateLimitError('', headers={'retry-after-ms': '1500'})) == 1.5
+    assert retry_after_seconds(rate_limit('soon')) is None
+    assert retry_after_seconds(rate_limit()) is None
+
+
+def test_transient_errors_are_retried(clock):
+    policy = RetryPolicy(max_retries=3, base_delay=1, deadline=0)
+    function = failing(rate_limit(), openai.error.ServiceUnavailableError('busy'))
+
+    assert policy.call(function) == ('ok', 2)
+    assert len(function.timeouts) == 3
+    assert policy.stats() == {
+        'calls': 1, 'retries': 2, 'failures': 0, 'errors': {'rate_limit': 1, 'server_error': 1},
+    }
+    # full jitter: the n-th backoff is at most base_delay * 2 ** n
+    assert 0 <= clock.sleeps[0] <= 1 and 0 <= clock.sleeps[1] <= 2
+
+
+def test_fatal_errors_are_not_retried(clock):
+    policy = RetryPolicy(max_retries=3, deadline=0)
+    function = failing(openai.error.InvalidRequestError('too long', 'messages'))
+
+    with pytest.raises(openai.error.InvalidRequestError):
+        policy.call(function)
+    assert len(function.timeouts) == 1 and clock.sleeps == []
+    assert policy.stats()['failures'] == 1
+
+
+def test_retries_are_used_up(clock):
+    policy = RetryPolicy(max_retries=2, deadline=0)
+    function = failing(*[rate_limit() for _ in range(5)])
+
+    with pytest.raises(openai.error.RateLimitError):
+        policy.call(function)
+    assert len(function.timeouts) == 3
+    assert policy.stats()['retries'] == 2
+
+
+def test_retry_after_is_honored(clock):
+    policy = RetryPolicy(max_retries=3, base_delay=0.5, max_delay=1, deadline=0)
+
+    assert policy.call(failing(rate_limit('20'))) == ('ok', 1)
+    # the server's delay, not the backoff capped at max_delay
+    assert 20 <= clock.sleeps[0] <= 20.5
+
+
+def test_the_deadline_stops_the_retries(clock):
+    policy = RetryPolicy(max_retries=10, base_delay=1, request_timeout=60, deadline=30)
+    function = failing(rate_limit('20'), rate_limit('20'))
+
+    with pytest.raises(openai.error.RateLimitError):
+        policy.call(function)
+    # a second wait of 20s would end after the deadline
+    assert len(function.timeouts) == 2 and len(clock.sleeps) == 1
+    # the attempt is given the time left before the deadline, not the full request timeout
+    assert function.timeouts[0] == 30 and function.timeouts[1] == pytest.approx(30 - clock.sleeps[0])
+
+
+def test_the_deadline_counts_the_waits_of_prepare(clock):
+    policy = RetryPolicy(max_retries=10, request_timeout=60, deadline=30)
+
+    def wait_for_the_rate_limiter():
+        clock.sleep(25)
+
+    function = failing()
+    assert policy.call(function, prepare=wait_for_the_rate_limiter) == ('ok', 0)
+    assert function.timeouts == [5]
+
+    function = failing(rate_limit())
+    with pytest.raises(openai.error.Timeout):
+        policy.call(function, prepare=wait_for_the_rate_limiter)
+    # the first attempt failed, and the second wait used up the deadline before the request was sent
+    assert len(function.timeouts) == 1
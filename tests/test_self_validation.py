@@ -0,0 +1,34 @@
+import pytest
+from DeepEL import token_budget
+from DeepEL.token_budget import CharTokenizer, PromptBudget
+from DeepEL.DeepEL_codes.Validation.Self_validation import build_validation_items
+
+
+def document():
+    return {
+        'sentence': 'Washington met Paris officials.',
+        'new_sentence': 'United States government met Government of France officials.',
+        'entities': {
+            'entity_mentions': ['Washington', 'Paris'],
+            'processed_entity_names': ['United States government', 'Government of France'],
+            'predict_entity_names': ['United States government', 'Government of France'],
+            'entity_candidates_descriptions': [['The federal government of the United States. ' * 20], ['The French government. ' * 20]],
+            'multi_choice_prompt_results': ['1', '1'],
+        },
+    }
+
+
+@pytest.mark.parametrize('prefix_first', [False, True])
+@pytest.mark.parametrize('structured', [False, True])
+def test_validation_prompts_fit_the_budget(monkeypatch, prefix_first, structured):
+    budget = PromptBudget(max_tokens=300, tokenizer=CharTokenizer())
+    monkeypatch.setattr(token_budget, '_prompt_budget', budget)
+
+    items = build_validation_items(document(), prefix_first=prefix_first, structured=structured)
+
+    prompts = [prompt for _, _, prompt in items]
+    assert len(prompts) == 2 and all(prompts)
+    # the descriptions were trimmed, and the whole prompt, question and answer format included, is within budget
+    assert budget.stats()['trimmed'] >= 1
+    assert max(budget.count(prompt) for prompt in prompts) <= 300
+    assert budget.stats()['over_budget'] == 0
@@ -0,0 +1,58 @@
+import time
+import threading
+import pytest
+from DeepEL import openai_function
+from DeepEL.single_flight import SingleFlight
+from DeepEL.openai_async import openai_chatgpt_batch
+
+
+@pytest.fixture
+def slow_api(monkeypatch, fake_api):
+    calls = []
+    lock = threading.Lock()
+
+    def answer(request):
+        content = request['messages'][-1]['content']
+        with lock:
+            calls.append(content)
+        time.sleep(0.2)
+        return 'answer to ' + content
+
+    fake_api(answer)
+    monkeypatch.setattr(openai_function, '_single_flight', SingleFlight())
+    return calls
+
+
+def test_identical_concurrent_prompts_share_one_request(slow_api):
+    results = openai_chatgpt_batch(['p1', 'p2', 'p1', 'p1'], max_in_flight=4)
+
+    assert results == ['answer to p1', 'answer to p2', 'answer to p1', 'answer to p1']
+    assert sorted(slow_api) == ['p1', 'p2']
+    assert openai_function.get_single_flight().stats() == {'calls': 2, 'coalesced': 2}
+
+
+def test_errors_are_shared_with_waiting_callers():
+    single_flight = SingleFlight()
+    started = threading.Event()
+    errors = []
+
+    def fail():
+        started.set()
+        time.sleep(0.1)
+        raise ValueError('upstream failed')
+
+    def follower():
+        started.wait()
+        try:
+            single_flight.do('key', fail)
+        except ValueError as error:
+            errors.append(error)
+
+    thread = threading.Thread(target=follower)
+    thread.start()
+    with pytest.raises(ValueError):
+        single_flight.do('key', fail)
+    thread.join()
+
+    assert len(errors) == 1
+    assert single_flight.stats() == {'calls': 1, 'coalesced': 1}
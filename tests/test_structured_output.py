@@ -0,0 +1,37 @@
+import pytest
+from DeepEL import structured_output
+from DeepEL.openai_function import openai_chatgpt_structured
+from DeepEL.structured_output import StructuredOutputError, choice_index, is_positive_verdict, parse_structured
+
+
+def test_replies_are_validated_against_the_schema():
+    assert parse_structured('choice', '```json\n{"answer": 2, "confidence": 0.8}\n```') == {'answer': 2, 'confidence': 0.8}
+    assert parse_structured('verdict', '{"verdict": "No", "confidence": 1, "reason": "Not founded in 1999."}')['verdict'] == 'no'
+
+    for reply in ('The answer is 2', '{"answer": "2", "confidence": 0.8}', '{"answer": 2}', '{"answer": -1, "confidence": 0.5}'):
+        with pytest.raises(StructuredOutputError):
+            parse_structured('choice', reply)
+
+
+def test_stored_answers_are_not_misread():
+    assert choice_index('{"answer": 3, "confidence": 0.9}') == 3
+    assert choice_index(' (2). ') == 2
+    assert choice_index('none') == 0
+    assert is_positive_verdict('{"verdict": "no", "confidence": 0.9, "reason": "yes, it was renamed"}') is False
+    assert is_positive_verdict('No. Saying yes would confuse the city with the state.') is False
+    assert is_positive_verdict('Yes. Both refer to the capital.') is True
+
+
+def test_only_malformed_replies_are_asked_again(monkeypatch, fake_api):
+    replies = iter(['It is the second one, founded in 1999.', '{"answer": 2, "confidence": 0.6}'])
+    requests = fake_api(lambda request: next(replies))
+    monkeypatch.setattr(structured_output, '_stats', structured_output.Counter())
+
+    reply, answer = openai_chatgpt_structured('Which one?', schema='choice')
+
+    assert answer == {'answer': 2, 'confidence': 0.6}
+    assert requests[0]['response_format']['json_schema']['name'] == 'choice'
+    # the re-ask carries the malformed reply and what was wrong with it
+    assert requests[1]['messages'][1] == {'role': 'assistant', 'content': 'It is the second one, founded in 1999.'}
+    assert 'not a JSON object' in requests[1]['messages'][2]['content']
+    assert structured_output.structured_stats() == {'replies': 2, 'malformed': 1, 'reasks': 1, 'failed': 0}
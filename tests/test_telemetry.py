@@ -0,0 +1,48 @@
+import json
+import openai
+import pytest
+from DeepEL import openai_function
+from DeepEL.single_flight import SingleFlight
+from DeepEL.telemetry import Histogram, Telemetry
+from DeepEL.openai_async import openai_chatgpt_batch
+
+
+def test_histogram_percentiles_are_within_precision():
+    histogram = Histogram(precision=0.01)
+    for millisecond in range(1, 1001):
+        histogram.record(millisecond / 1000)
+
+    assert histogram.percentile(50) == pytest.approx(0.5, rel=0.01)
+    assert histogram.percentile(99) == pytest.approx(0.99, rel=0.01)
+    assert histogram.summary()['max'] == 1.0
+    assert len(histogram.buckets) < 1000
+
+
+def test_calls_are_recorded_per_model(monkeypatch, tmp_path, fake_api):
+    failures = {'p2': 1}
+
+    def answer(request):
+        content = request['messages'][-1]['content']
+        if failures.get(content):
+            failures[content] -= 1
+            raise openai.error.RateLimitError('slow down', http_status=429)
+        return {
+            'choices': [{'message': {'role': 'assistant', 'content': 'ok'}}],
+            'usage': {'prompt_tokens': 1000, 'completion_tokens': 100, 'total_tokens': 1100},
+        }
+
+    telemetry = Telemetry(stage='test', prices={'gpt-4': (0.03, 0.06)})
+    fake_api(answer)
+    monkeypatch.setattr(openai_function, '_single_flight', SingleFlight())
+    monkeypatch.setattr(openai_function, '_telemetry', telemetry)
+
+    openai_chatgpt_batch(['p1', 'p2'], model='gpt-4', max_in_flight=2)
+    summary = telemetry.write_summary(str(tmp_path / 'out.llm_summary.json'))
+
+    stats = summary['models']['gpt-4']
+    assert (stats['calls'], stats['network_calls'], stats['retries'], stats['errors']) == (2, 2, 1, 0)
+    assert (stats['prompt_tokens'], stats['completion_tokens']) == (2000, 200)
+    assert stats['estimated_cost_usd'] == pytest.approx(2 * (0.03 + 0.006))
+    assert stats['latency']['count'] == 2
+    with open(tmp_path / 'out.llm_summary.json') as reader:
+        assert json.load(reader)['stage'] == 'test'
@@ -0,0 +1,46 @@
+from DeepEL.token_budget import CharTokenizer, PromptBudget, make_tokenizer, tiktoken_cached
+
+
+def test_longest_texts_are_trimmed_first():
+    budget = PromptBudget(max_tokens=30, tokenizer=CharTokenizer())
+    explanation, short, long = 'e' * 80, 's' * 12, 'l' * 60
+
+    trimmed = budget.fit([explanation, short, long], fixed='f' * 20)
+
+    # 25 tokens left for the texts: the short one is kept, the two long ones share the rest
+    assert trimmed == ['e' * 44, short, 'l' * 44]
+    assert sum(budget.count(text) for text in trimmed) + budget.count('f' * 20) <= 30
+    assert budget.stats()['trimmed'] == 1
+
+
+def test_prompts_are_only_counted_without_a_budget():
+    budget = PromptBudget(max_tokens=0, tokenizer=CharTokenizer())
+    texts = ['x' * 400, 'y' * 400]
+
+    assert budget.fit(texts, fixed='question') == texts
+    budget.account('x' * 40)
+    budget.account('x' * 80)
+
+    stats = budget.stats()
+    assert (stats['prompts'], stats['tokens'], stats['mean_tokens'], stats['max_tokens']) == (2, 30, 15, 20)
+    assert stats['trimmed'] == 0
+
+
+def test_prompts_whose_fixed_part_is_over_budget_are_counted(capsys):
+    budget = PromptBudget(max_tokens=10, tokenizer=CharTokenizer())
+
+    for _ in range(2):
+        context = budget.fit(['c' * 40], fixed='f' * 60)
+        budget.account('f' * 60 + ''.join(context))
+
+    assert context == ['']
+    assert budget.stats()['over_budget'] == 2
+    # warned once, not for every prompt
+    assert capsys.readouterr().out.count('over the 10-token budget') == 1
+
+
+def test_auto_counts_offline_without_a_cached_encoding(monkeypatch, tmp_path):
+    monkeypatch.setenv('TIKTOKEN_CACHE_DIR', str(tmp_path))
+
+    assert not tiktoken_cached()
+    assert isinstance(make_tokenizer('auto'), CharTokenizer)